@@ -1,4 +1,3 @@
-import yaml
 import getpass
 import socket
 import urllib
@@ -189,6 +188,8 @@ class Accession(object):
                 - ssh://user@hostname.edu/path/to/file/10_M_S40_R2_001.fastq.gz
         """
         accessions = []
+        import yaml
+
         with open(yaml_file, "r") as IN:
             for name, v in yaml.safe_load(IN).items():
                 files = v["files"] if "files" in v else []
@@ -0,0 +1,782 @@
+"""A content addressed store for the frozen files of Freezable datasets."""
+
+import io
+import os
+import json
+import uuid
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from pathlib import Path
+from contextlib import contextmanager
+
+from .Checksum import BUFFER_SIZE, file_hash
+from .Chunking import iter_chunks
+from .Compression import CODECS, resolve_codec, is_compressible, compressor, decompressor
+from .Packs import PackIndex, PackWriter
+from .Tools import write_text
+
+__all__ = ["BlobStore", "SharedBlobStore", "link_file", "LINK_MODES", "LAYOUTS"]
+
+log = logging.getLogger("minus80")
+
+# The ways a file can be placed into (freeze) or out of (thaw) the store
+LINK_MODES = ("copy", "reflink", "hardlink")
+
+# ioctl request to clone a file on Linux (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# How blobs are laid out in a store:
+# * flat - root/<checksum>
+# * sharded - root/<checksum[:2]>/<checksum[2:4]>/<checksum>
+LAYOUTS = ("flat", "sharded")
+
+
+def reflink(src, dest):
+    """
+    Create dest as a copy-on-write clone of src. Raises an
+    OSError if the filesystem does not support reflinks.
+    """
+    import fcntl
+
+    with open(src, "rb") as IN, open(dest, "wb") as OUT:
+        fcntl.ioctl(OUT.fileno(), FICLONE, IN.fileno())
+
+
+def link_file(src, dest, mode="copy"):
+    """
+    Place a copy of src at dest using the cheapest method allowed
+    by mode, falling back to a plain copy.
+
+    Parameters
+    ----------
+    src : str or Path
+        The source file
+    dest : str or Path
+        The destination, which must not exist
+    mode : str, default="copy"
+        One of LINK_MODES:
+        * copy - always copy the data
+        * reflink - clone the file if the filesystem supports it
+        * hardlink - clone the file if possible, otherwise hard link it.
+          Hard linked files share their contents with the store and
+          **must not** be modified in place.
+
+    Returns
+    -------
+    str
+        The method that was actually used
+    """
+    if mode not in LINK_MODES:
+        raise ValueError(f"link mode must be one of: {LINK_MODES}")
+    if mode in ("reflink", "hardlink"):
+        try:
+            reflink(src, dest)
+            return "reflink"
+        except (OSError, ImportError) as e:
+            if os.path.exists(dest):
+                os.unlink(dest)
+            log.debug(f"Cannot reflink {src}: {e}")
+    if mode == "hardlink":
+        try:
+            os.link(src, dest)
+            return "hardlink"
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            log.debug(f"Cannot hard link {src}: {e}")
+    shutil.copyfile(src, dest)
+    return "copy"
+
+
+class BlobStore(object):
+    """
+    A BlobStore is a directory of files (blobs) named by the
+    SHA-256 checksum of their contents.
+
+    Blobs are always written to a temporary file inside the store
+    and renamed to their content address, so a blob is either
+    complete or missing, never partially written. Stored blobs are
+    read-only.
+
+    Files of at least chunk_threshold bytes are split into content
+    defined chunks (see `minus80.Chunking`) that are stored as blobs
+    themselves. The file is stored as a recipe (<checksum>.chunks)
+    listing its chunks, so a new version of a large file only adds
+    the chunks that changed.
+
+    With a compression codec, copied files (and chunks) that pass a
+    quick compressibility probe are stored compressed, with the codec
+    suffix (e.g. <checksum>.zst). Checksums are always those of the
+    uncompressed contents.
+
+    Small files can be bundled into pack files (see `packer`) so
+    datasets with very many files do not need a blob per file.
+
+    New stores shard blobs into two levels of sub-directories (see
+    LAYOUTS) to keep directories small. Stores created with the flat
+    layout keep it until they are converted with `migrate`. The layout
+    is recorded in the .layout file of the store.
+    """
+
+    _tmp_prefix = ".incoming-"
+    _recipe_suffix = ".chunks"
+
+    def __init__(self, root, chunk_threshold=None, compression=None):
+        self.root = Path(root)
+        self.chunk_threshold = chunk_threshold
+        self.compression = resolve_codec(compression)
+        # The ways a blob can be stored, by file suffix
+        self._suffixes = ("", *CODECS.values(), self._recipe_suffix)
+        os.makedirs(self.root, exist_ok=True)
+        self.packs = PackIndex(self.root / "packs")
+        self.layout = self._read_layout()
+
+    def _read_layout(self):
+        """
+        The layout of the store, new stores are sharded
+        """
+        marker = self.root / ".layout"
+        try:
+            return marker.read_text().strip()
+        except FileNotFoundError:
+            pass
+        # Stores from before layouts were recorded are flat
+        for _ in self._loose_files("flat"):
+            return "flat"
+        write_text(marker, "sharded\n")
+        return "sharded"
+
+    def _blob_path(self, name, layout=None):
+        """
+        The path of a file in the store (a checksum plus suffix)
+        """
+        if (layout or self.layout) == "sharded":
+            return self.root / name[:2] / name[2:4] / name
+        return self.root / name
+
+    def _loose_files(self, layout=None):
+        """
+        The (name, path) of the blob files (i.e. not packed)
+        stored with a layout
+        """
+        layout = layout or self.layout
+        if layout == "flat":
+            dirs = [self.root]
+        else:
+            dirs = (
+                Path(level2.path)
+                for level1 in os.scandir(self.root)
+                if level1.is_dir() and len(level1.name) == 2
+                for level2 in os.scandir(level1.path)
+                if level2.is_dir()
+            )
+        for directory in dirs:
+            for entry in os.scandir(directory):
+                if entry.is_file() and not entry.name.startswith("."):
+                    yield entry.name, Path(entry.path)
+
+    def migrate(self, layout="sharded"):
+        """
+        Move the blobs of the store to a new layout. Callers must
+        hold the exclusive lock, an interrupted migration is
+        finished by running it again.
+
+        Returns
+        -------
+        int
+            The number of blobs moved
+        """
+        if layout not in LAYOUTS:
+            raise ValueError(f"layout must be one of: {LAYOUTS}")
+        moved = 0
+        old = "flat" if layout == "sharded" else "sharded"
+        self.layout = layout
+        for name, path in list(self._loose_files(old)):
+            self._move_in(path, name)
+            moved += 1
+        if old == "sharded":
+            # Remove the (now empty) shard directories
+            for name in os.listdir(self.root):
+                if len(name) == 2 and (self.root / name).is_dir():
+                    shutil.rmtree(self.root / name)
+        write_text(self.root / ".layout", f"{layout}\n")
+        log.info(f"Moved {moved} blobs in {self.root} to the {layout} layout")
+        return moved
+
+    def path(self, checksum):
+        """
+        The path of the blob for a checksum
+        """
+        return self._blob_path(checksum)
+
+    def recipe_path(self, checksum):
+        """
+        The path of the chunk list for a checksum
+        """
+        return self._blob_path(f"{checksum}{self._recipe_suffix}")
+
+    def locate(self, checksum):
+        """
+        The file storing a checksum: the plain blob, a compressed
+        blob or a chunk list. None if the checksum is not stored.
+        """
+        for suffix in self._suffixes:
+            path = self._blob_path(f"{checksum}{suffix}")
+            if path.exists():
+                return path
+        return None
+
+    def exists(self, checksum):
+        return self.locate(checksum) is not None or self.packs.get(checksum) is not None
+
+    def stat(self, checksum):
+        """
+        The stat of the file storing a checksum (for packed
+        blobs, the pack file)
+        """
+        path = self.locate(checksum)
+        if path is None:
+            packed = self.packs.get(checksum)
+            if packed is None:
+                raise FileNotFoundError(f"{checksum} is not in {self.root}")
+            path = self.packs.path(packed[0])
+        return os.stat(path)
+
+    @contextmanager
+    def open(self, checksum):
+        """
+        Open a (whole) blob for reading its uncompressed contents
+        """
+        path = self.locate(checksum)
+        if path is None:
+            if self.packs.get(checksum) is None:
+                raise FileNotFoundError(f"{checksum} is not in {self.root}")
+            yield io.BytesIO(self.packs.read(checksum))
+            return
+        codec = self._codec(path)
+        with open(path, "rb") as IN:
+            if codec is None:
+                yield IN
+            else:
+                with decompressor(codec, IN) as reader:
+                    yield reader
+
+    @contextmanager
+    def materialize(self, checksum):
+        """
+        The path of a file with the (uncompressed) contents of a blob,
+        for blobs that are compressed, chunked or packed the contents
+        are written to a temporary file for the duration of the context.
+        """
+        path = self.path(checksum)
+        if path.exists():
+            yield path
+            return
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dest = Path(tmpdir) / checksum
+            self.checkout(checksum, dest)
+            yield dest
+
+    def chunks(self, checksum):
+        """
+        The chunks of a chunked blob as a list of [checksum, size]
+        or None if the blob is stored whole
+        """
+        try:
+            with open(self.recipe_path(checksum), "r") as IN:
+                return json.load(IN)
+        except FileNotFoundError:
+            return None
+
+    def closure(self, checksums):
+        """
+        The checksums along with the checksums of their chunks
+        """
+        closure = set(checksums)
+        for checksum in checksums:
+            for chunk, _ in self.chunks(checksum) or ():
+                closure.add(chunk)
+        return closure
+
+    @contextmanager
+    def lock(self, exclusive=False):
+        """
+        Hold a lock on the store: shared for operations that add
+        blobs (freeze, pull) and exclusive for ones that remove them (gc)
+        """
+        import fcntl
+
+        with open(self.root / ".lock", "a") as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def __iter__(self):
+        """
+        Iterate over the checksums of the stored blobs
+        """
+        for name, _ in self._loose_files():
+            yield name.split(".", 1)[0]
+        yield from self.packs
+
+    def incoming(self):
+        """
+        The paths of temporary blobs that are (or were, if a freeze
+        was interrupted) being written
+        """
+        return [
+            Path(entry.path)
+            for entry in os.scandir(self.root)
+            if entry.name.startswith(self._tmp_prefix)
+        ]
+
+    def remove(self, checksum):
+        """
+        Delete a blob from the store
+
+        Returns
+        -------
+        int
+            The number of bytes freed (0 if the blob is still
+            hard linked elsewhere)
+        """
+        path = self.locate(checksum)
+        if path is None:
+            return self.packs.remove(checksum)
+        st = path.stat()
+        os.unlink(path)
+        return st.st_size if st.st_nlink == 1 else 0
+
+    def sweep(self, reachable, cutoff, dry_run=False):
+        """
+        Remove the blobs that are not reachable (the "sweep" phase of
+        garbage collection) along with left over temporary files and
+        packs, then rewrite packs that are mostly garbage.
+
+        Parameters
+        ----------
+        reachable : set
+            The checksums that are in use
+        cutoff : float
+            Files changed after this time (seconds) are kept
+        dry_run : bool, default=False
+            If True, only report what would be removed
+
+        Returns
+        -------
+        dict
+            blobs: the number of unreferenced blobs removed
+            bytes: the number of bytes reclaimed (estimated for packed blobs)
+            incoming: the number of stale temporary files removed
+            kept: the number of referenced blobs
+        """
+        report = {"blobs": 0, "bytes": 0, "incoming": 0, "kept": 0}
+        for checksum in list(self):
+            if checksum in reachable:
+                report["kept"] += 1
+                continue
+            st = self.stat(checksum)
+            # Links and renames update the ctime
+            if st.st_ctime > cutoff:
+                continue
+            report["blobs"] += 1
+            if not dry_run:
+                report["bytes"] += self.remove(checksum)
+            elif self.locate(checksum) is None:
+                report["bytes"] += self.packs.get(checksum)[2]
+            elif st.st_nlink == 1:
+                report["bytes"] += st.st_size
+        for path in self.incoming() + self.packs.orphans():
+            st = os.stat(path)
+            if st.st_ctime > cutoff:
+                continue
+            report["incoming"] += 1
+            report["bytes"] += st.st_size
+            if not dry_run:
+                os.unlink(path)
+        if not dry_run:
+            report["bytes"] += self.packs.repack()
+        return report
+
+    @contextmanager
+    def packer(self, min_files=0):
+        """
+        Bundle the small blobs added through the yielded PackWriter
+        into pack files. If fewer than min_files blobs are added they
+        are stored as regular blobs instead.
+        """
+        writer = PackWriter(self.packs, min_files=min_files, exists=self.exists)
+        try:
+            yield writer
+        except BaseException:
+            writer.abort()
+            raise
+        writer.flush()
+        for data, checksum in writer.pending:
+            with self._writer() as OUT:
+                OUT.write(data)
+            self._commit(OUT.name, checksum)
+
+    def ingest(self, src, mode="copy"):
+        """
+        Add a file to the store, reading it only once: the contents
+        are hashed while being written to a temporary blob which is
+        then renamed to its content address (or discarded if the
+        store already has that blob).
+
+        Parameters
+        ----------
+        src : str or Path
+            The file to add
+        mode : str, default="copy"
+            The link mode (see `link_file`). For modes other than
+            copy the file is hashed and then linked into the store.
+            Chunked and compressed files are always copied.
+
+        Returns
+        -------
+        str
+            The checksum of the file
+        """
+        if self._chunked(src):
+            return self._add_chunks(src)
+        if mode == "copy" and self._compressed(src):
+            return self._add_compressed(src)
+        if mode != "copy":
+            checksum = file_hash(src)
+            self.add(src, checksum, mode=mode)
+            return checksum
+        running_hash = hashlib.sha256()
+        with open(src, "rb") as IN, self._writer() as OUT:
+            buf = bytearray(BUFFER_SIZE)
+            view = memoryview(buf)
+            while True:
+                n = IN.readinto(buf)
+                if not n:
+                    break
+                running_hash.update(view[:n])
+                OUT.write(view[:n])
+        checksum = running_hash.hexdigest()
+        self._commit(OUT.name, checksum)
+        return checksum
+
+    def add(self, src, checksum, mode="copy"):
+        """
+        Add a file whose checksum is already known to the store.
+
+        Parameters
+        ----------
+        src : str or Path
+            The file to add
+        checksum : str
+            The checksum of the file
+        mode : str, default="copy"
+            The link mode (see `link_file`)
+        """
+        if self.exists(checksum):
+            return
+        if self._chunked(src):
+            self._add_chunks(src)
+            return
+        if mode == "copy" and self._compressed(src):
+            self._add_compressed(src)
+            return
+        tmp_path = self.root / f"{self._tmp_prefix}{uuid.uuid4().hex}"
+        try:
+            method = link_file(src, tmp_path, mode=mode)
+        except BaseException:
+            if tmp_path.exists():
+                os.unlink(tmp_path)
+            raise
+        # A hard linked blob is the source file, which is left writable
+        self._commit(tmp_path, checksum, readonly=method != "hardlink")
+
+    def checkout(self, checksum, dest, mode="copy"):
+        """
+        Write the contents of a blob to dest.
+
+        Parameters
+        ----------
+        checksum : str
+            The checksum of the blob
+        dest : str or Path
+            Where the file is written, it must not exist
+        mode : str, default="copy"
+            The link mode (see `link_file`)
+
+        Returns
+        -------
+        str
+            The method that was actually used, chunked and compressed
+            blobs are always copied
+        """
+        chunks = self.chunks(checksum)
+        if chunks is None:
+            chunks = [[checksum, None]]
+            if self.path(checksum).exists():
+                return link_file(self.path(checksum), dest, mode=mode)
+            if self.packs.get(checksum) is not None:
+                with open(dest, "wb") as OUT:
+                    OUT.write(self.packs.read(checksum))
+                return "copy"
+        with open(dest, "wb") as OUT:
+            for chunk, _ in chunks:
+                with self.open(chunk) as IN:
+                    shutil.copyfileobj(IN, OUT, BUFFER_SIZE)
+        return "copy"
+
+    def _codec(self, path):
+        """
+        The codec a blob was compressed with (None if uncompressed)
+        """
+        for codec, suffix in CODECS.items():
+            if path.name.endswith(suffix):
+                return codec
+        return None
+
+    def _compressed(self, src):
+        """
+        If a file should be stored compressed
+        """
+        return self.compression is not None and is_compressible(
+            src, os.path.getsize(src)
+        )
+
+    def _add_compressed(self, src):
+        """
+        Store a compressed copy of a file, hashing the uncompressed
+        contents while they are compressed.
+
+        Returns
+        -------
+        str
+            The checksum of the (uncompressed) file
+        """
+        running_hash = hashlib.sha256()
+        with open(src, "rb") as IN, self._writer() as OUT:
+            with compressor(self.compression, OUT) as Z:
+                buf = bytearray(BUFFER_SIZE)
+                view = memoryview(buf)
+                while True:
+                    n = IN.readinto(buf)
+                    if not n:
+                        break
+                    running_hash.update(view[:n])
+                    Z.write(view[:n])
+        checksum = running_hash.hexdigest()
+        self._commit(OUT.name, checksum, CODECS[self.compression])
+        return checksum
+
+    def _chunked(self, src):
+        """
+        If a file is big enough to be stored as chunks
+        """
+        return bool(self.chunk_threshold) and os.path.getsize(src) >= self.chunk_threshold
+
+    def _add_chunks(self, src):
+        """
+        Store a file as content defined chunks plus a chunk list,
+        only chunks that are not already stored are written.
+
+        Returns
+        -------
+        str
+            The checksum of the whole file
+        """
+        codec = self.compression if self._compressed(src) else None
+        running_hash = hashlib.sha256()
+        recipe = []
+        for chunk in iter_chunks(src):
+            running_hash.update(chunk)
+            digest = hashlib.sha256(chunk).hexdigest()
+            if not self.exists(digest):
+                with self._writer() as OUT:
+                    if codec is None:
+                        OUT.write(chunk)
+                    else:
+                        with compressor(codec, OUT) as Z:
+                            Z.write(chunk)
+                self._commit(OUT.name, digest, CODECS.get(codec, ""))
+            recipe.append([digest, len(chunk)])
+            chunk.release()
+        checksum = running_hash.hexdigest()
+        with self._writer() as OUT:
+            OUT.write(json.dumps(recipe).encode("utf-8"))
+        self._commit(OUT.name, checksum, self._recipe_suffix)
+        return checksum
+
+    @contextmanager
+    def _writer(self):
+        """
+        Open a temporary blob for writing, it is removed if
+        anything goes wrong while writing it.
+        """
+        handle = tempfile.NamedTemporaryFile(
+            "wb", dir=self.root, prefix=self._tmp_prefix, delete=False
+        )
+        try:
+            with handle:
+                yield handle
+        except BaseException:
+            os.unlink(handle.name)
+            raise
+
+    def _commit(self, tmp_path, checksum, suffix="", readonly=True):
+        """
+        Move a written temporary blob to its content address,
+        it is made read-only unless readonly is False
+        """
+        if self.exists(checksum):
+            log.debug(f"Blob already stored: {checksum}")
+            os.unlink(tmp_path)
+        else:
+            if readonly:
+                os.chmod(tmp_path, 0o444)
+            dest = self._blob_path(f"{checksum}{suffix}")
+            os.makedirs(dest.parent, exist_ok=True)
+            os.replace(tmp_path, dest)
+
+    def _move_in(self, src, name):
+        """
+        Move a blob file (e.g. from another store) into the store,
+        it is discarded if the store already has it
+        """
+        dest = self._blob_path(name)
+        if dest.exists():
+            os.unlink(src)
+            return
+        os.makedirs(dest.parent, exist_ok=True)
+        try:
+            os.replace(src, dest)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            tmp_path = self.root / f"{self._tmp_prefix}{uuid.uuid4().hex}"
+            shutil.copyfile(src, tmp_path)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, dest)
+            os.unlink(src)
+
+
+class SharedBlobStore(BlobStore):
+    """
+    A BlobStore shared by all of the datasets under a root directory,
+    so a file frozen in many datasets is only stored once.
+
+    The store keeps a reference table (.refs.sqlite) of which datasets
+    use it and which blobs each of them references. The references of
+    a dataset are replaced whenever its manifest changes, so the
+    reference count of a blob is the number of datasets with a tag
+    that contains it.
+    """
+
+    def __init__(self, root, **kwargs):
+        super().__init__(root, **kwargs)
+        from .RelationalDB import apsw
+
+        self.db = apsw.Connection(str(self.root / ".refs.sqlite"))
+        self.db.setbusytimeout(30000)
+        cur = self.db.cursor()
+        cur.execute("PRAGMA journal_mode = WAL").fetchall()
+        with self.db:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS datasets (
+                    slug TEXT PRIMARY KEY,
+                    basedir TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS refs (
+                    slug TEXT NOT NULL,
+                    checksum TEXT NOT NULL,
+                    PRIMARY KEY (slug, checksum)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS refs_checksum ON refs (checksum);
+            """
+            )
+
+    def register(self, slug, basedir):
+        """
+        Record that a dataset freezes into the store
+        """
+        with self.db:
+            self.db.cursor().execute(
+                "INSERT OR REPLACE INTO datasets (slug, basedir) VALUES (?, ?)",
+                (slug, str(basedir)),
+            )
+
+    def datasets(self):
+        """
+        The datasets using the store: slug -> basedir
+        """
+        return {
+            slug: Path(basedir)
+            for slug, basedir in self.db.cursor().execute(
+                "SELECT slug, basedir FROM datasets"
+            )
+        }
+
+    def set_refs(self, slug, checksums):
+        """
+        Replace the blobs referenced by a dataset
+        """
+        with self.db:
+            cur = self.db.cursor()
+            cur.execute("DELETE FROM refs WHERE slug = ?", (slug,))
+            cur.executemany(
+                "INSERT INTO refs (slug, checksum) VALUES (?, ?)",
+                ((slug, x) for x in checksums),
+            )
+
+    def forget(self, slug):
+        """
+        Drop a dataset (and its references) from the store
+        """
+        with self.db:
+            cur = self.db.cursor()
+            cur.execute("DELETE FROM refs WHERE slug = ?", (slug,))
+            cur.execute("DELETE FROM datasets WHERE slug = ?", (slug,))
+
+    def refcount(self, checksum):
+        """
+        The number of datasets that reference a blob
+        """
+        (count,) = (
+            self.db.cursor()
+            .execute("SELECT COUNT(*) FROM refs WHERE checksum = ?", (checksum,))
+            .fetchone()
+        )
+        return count
+
+    def referenced(self):
+        """
+        The checksums referenced by any dataset
+        """
+        return {x for (x,) in self.db.cursor().execute("SELECT DISTINCT checksum FROM refs")}
+
+    def adopt(self, store):
+        """
+        Move the blobs of another (per dataset) store into this one
+        """
+        moved = 0
+        for pack in store.packs.packs():
+            rows = store.packs.db.cursor().execute(
+                "SELECT checksum, pack, offset, size FROM objects WHERE pack = ?",
+                (pack,),
+            ).fetchall()
+            os.makedirs(self.packs.root, exist_ok=True)
+            shutil.move(store.packs.path(pack), self.packs.path(pack))
+            self.packs.add(rows)
+            moved += len(rows)
+        if store.packs:
+            store.packs.close()
+            shutil.rmtree(store.packs.root)
+        for name, src in list(store._loose_files()):
+            self._move_in(src, name)
+            moved += 1
+        return moved
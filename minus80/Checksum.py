@@ -0,0 +1,338 @@
+"""Checksum utilities used to track the contents of Freezable datasets."""
+
+import os
+import mmap
+import json
+import time
+import hashlib
+import logging
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from .Tools import write_json
+
+__all__ = [
+    "file_hash",
+    "hash_files",
+    "scan_files",
+    "default_workers",
+    "companion_stats",
+    "ChecksumCache",
+]
+
+log = logging.getLogger("minus80")
+
+# Size of the reads used to stream files through the hash
+BUFFER_SIZE = 1024 * 1024
+# Files at least this big are hashed straight from a memory map
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+
+def file_hash(filepath):
+    """
+    Calculate the SHA-256 checksum of a file.
+
+    Parameters
+    ----------
+    filepath : str or Path
+        The path to the file to hash
+
+    Returns
+    -------
+    str
+        The hex digest of the file contents
+    """
+    running_hash = hashlib.sha256()
+    with open(filepath, "rb") as IN:
+        size = os.fstat(IN.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            # hashlib releases the GIL while it digests the whole map
+            with mmap.mmap(IN.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                running_hash.update(mm)
+        else:
+            buf = bytearray(BUFFER_SIZE)
+            view = memoryview(buf)
+            while True:
+                n = IN.readinto(buf)
+                if not n:
+                    break
+                running_hash.update(view[:n])
+    return running_hash.hexdigest()
+
+
+def default_workers():
+    """
+    The default number of hashing workers: the `hash_workers` option
+    in ~/.minus80.conf if set, otherwise the number of CPUs (max 32)
+    """
+    from .Config import cf
+
+    workers = cf.options.get("hash_workers")
+    if workers is None:
+        workers = min(32, os.cpu_count() or 1)
+    return max(1, int(workers))
+
+
+def hash_files(paths, workers=None, hasher=file_hash):
+    """
+    Calculate the checksums of many files on a bounded thread pool.
+
+    Parameters
+    ----------
+    paths : list of str or Path
+        The files to hash
+    workers : int, default=None
+        The number of files hashed concurrently. Defaults
+        to `default_workers()`
+    hasher : callable, default=file_hash
+        The function that returns the checksum of a path
+
+    Returns
+    -------
+    list of str
+        The checksums, in the same order as paths
+    """
+    if workers is None:
+        workers = default_workers()
+    if workers <= 1 or len(paths) <= 1:
+        return [hasher(x) for x in paths]
+    with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+        return list(pool.map(hasher, paths))
+
+
+def scan_files(
+    directory,
+    cache=None,
+    workers=None,
+    hasher=file_hash,
+    pending=None,
+    exclude=(),
+    companions=None,
+):
+    """
+    Walk a directory and calculate the checksum and size
+    of every file in it.
+
+    Parameters
+    ----------
+    directory : str or Path
+        The directory to walk
+    cache : ChecksumCache, default=None
+        If provided, files whose stat has not changed are
+        served from the cache and new checksums are stored in it.
+    workers : int, default=None
+        The number of hashing workers (see `hash_files`)
+    hasher : callable, default=file_hash
+        The function used to hash files that are not cached,
+        e.g. `BlobStore.ingest` to store files while hashing them
+    pending : PendingFiles, default=None
+        Files of a lazy thaw that are not on disk yet, they are
+        listed with their recorded checksums as if they were
+    exclude : collection of str, default=()
+        Relative paths of files that are skipped
+    companions : dict, default=None
+        relative path -> relative paths of other files whose contents
+        are part of the file (e.g. the journals of a database). Their
+        stats are part of the cache key of the file.
+
+    Returns
+    -------
+    dict
+        relative path -> {"checksum": str, "size": int}, in
+        directory walk order
+    """
+    directory = str(directory)
+    files = {}
+    missing = []
+    skipped = 0
+    not_written = {} if pending is None else pending.by_directory()
+    for root, dirs, filenames in os.walk(directory):
+        rel_root = "" if root == directory else root.replace(directory + "/", "", 1)
+        on_disk = set(filenames)
+        # Pending files keep the place they would have in the walk
+        for file_path in sorted(on_disk | not_written.get(rel_root, set())):
+            full_path = os.path.join(root, file_path)
+            # Calculate a relative path to the directory
+            rel_path = full_path.replace(directory + "/", "")
+            if rel_path in exclude:
+                continue
+            if file_path not in on_disk:
+                entry = pending.get(rel_path)
+                files[rel_path] = {"checksum": entry["checksum"], "size": entry["size"]}
+                skipped += 1
+                continue
+            st = os.stat(full_path)
+            extra = companion_stats(directory, (companions or {}).get(rel_path, ()))
+            phash = None if cache is None else cache.get(rel_path, st, extra)
+            if phash is None:
+                missing.append((rel_path, full_path, st, extra))
+            files[rel_path] = {"checksum": phash, "size": st.st_size}
+    # Hash everything that could not be served from the cache
+    hashed_at = time.time_ns()
+    digests = hash_files([x[1] for x in missing], workers=workers, hasher=hasher)
+    for (rel_path, full_path, st, extra), phash in zip(missing, digests):
+        files[rel_path]["checksum"] = phash
+        if cache is not None:
+            cache.put(rel_path, st, phash, hashed_at, extra)
+    if cache is not None:
+        cache.hashed = len(missing)
+        cache.cached = len(files) - len(missing) - skipped
+    return files
+
+
+def companion_stats(directory, rel_paths):
+    """
+    The stats of the companion files of a file (None for the
+    ones that do not exist), see `ChecksumCache.get`
+    """
+    stats = []
+    for rel_path in rel_paths:
+        try:
+            stats.append(os.stat(os.path.join(str(directory), rel_path)))
+        except FileNotFoundError:
+            stats.append(None)
+    return stats
+
+
+class ChecksumCache(object):
+    """
+    A persistent cache of file checksums.
+
+    Entries are keyed by the relative path of a file and are only
+    served when the (size, mtime_ns, inode) of the file on disk still
+    matches the stat recorded when the file was hashed. Files that
+    were modified within RACY_WINDOW_NS of being hashed are never
+    served from the cache, since a coarse filesystem timestamp could
+    hide a write that happened right after hashing.
+
+    The contents of some files also depend on companion files, e.g.
+    a sqlite database commits transactions to its -wal or -journal
+    file. The stats of the companions are then part of the key.
+    """
+
+    VERSION = 1
+    # Filesystems like NFS/FAT have coarse timestamps
+    RACY_WINDOW_NS = 2 * 10**9
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        self.entries = {}
+        # Counters for the last round of lookups
+        self.hashed = 0
+        self.cached = 0
+        self._load()
+
+    @staticmethod
+    def stat_key(st):
+        """
+        The portion of a stat result that invalidates a cache entry
+        """
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    @classmethod
+    def cache_key(cls, st, companions=()):
+        """
+        The stat key of a file and its companions (None for the
+        companions that do not exist)
+        """
+        key = cls.stat_key(st)
+        for companion in companions:
+            key.append(None if companion is None else cls.stat_key(companion))
+        return key
+
+    def get(self, rel_path, st, companions=()):
+        """
+        Return the cached checksum for a file or None if the
+        entry is missing or stale.
+
+        Parameters
+        ----------
+        rel_path : str
+            The path of the file relative to the thawed directory
+        st : os.stat_result
+            The current stat of the file
+        companions : list of os.stat_result, default=()
+            The current stats of the companion files (None for
+            the ones that do not exist)
+        """
+        entry = self.entries.get(rel_path)
+        if entry is None:
+            return None
+        if entry["stat"] != self.cache_key(st, companions):
+            return None
+        newest = max(
+            [st.st_mtime_ns] + [c.st_mtime_ns for c in companions if c is not None]
+        )
+        if newest >= entry["hashed_at"] - self.RACY_WINDOW_NS:
+            return None
+        return entry["checksum"]
+
+    def put(self, rel_path, st, checksum, hashed_at=None, companions=()):
+        """
+        Store the checksum of a file along with the stat it was
+        calculated from.
+
+        Parameters
+        ----------
+        rel_path : str
+            The path of the file relative to the thawed directory
+        st : os.stat_result
+            The stat of the file taken *before* it was hashed
+        checksum : str
+            The checksum of the file contents
+        hashed_at : int, default=None
+            The time (ns) the file was hashed, defaults to now
+        companions : list of os.stat_result, default=()
+            The stats of the companion files taken *before* the
+            file was hashed
+        """
+        if hashed_at is None:
+            hashed_at = time.time_ns()
+        self.entries[rel_path] = {
+            "stat": self.cache_key(st, companions),
+            "checksum": checksum,
+            "hashed_at": hashed_at,
+        }
+
+    def prune(self, rel_paths):
+        """
+        Remove entries for files that no longer exist
+        """
+        rel_paths = set(rel_paths)
+        for rel_path in list(self.entries):
+            if rel_path not in rel_paths:
+                del self.entries[rel_path]
+
+    @property
+    def stats(self):
+        return {"hashed": self.hashed, "cached": self.cached}
+
+    def clear(self):
+        """
+        Drop all cache entries (on disk as well)
+        """
+        self.entries = {}
+        try:
+            os.unlink(self.filename)
+        except FileNotFoundError:
+            pass
+
+    def save(self):
+        """
+        Atomically write the cache to disk
+        """
+        write_json(self.filename, {"version": self.VERSION, "entries": self.entries})
+
+    def _load(self):
+        try:
+            with open(self.filename, "r") as IN:
+                data = json.load(IN)
+            if data["version"] == self.VERSION:
+                self.entries = data["entries"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError):
+            # A corrupt cache is simply discarded
+            log.warning(f"Discarding unreadable checksum cache: {self.filename}")
+            self.entries = {}
@@ -0,0 +1,126 @@
+"""Content defined chunking of large frozen files."""
+
+import os
+import mmap
+import logging
+
+from functools import lru_cache
+
+__all__ = ["chunk_boundaries", "iter_chunks", "CHUNK_THRESHOLD"]
+
+log = logging.getLogger("minus80")
+
+# Files at least this big are stored as chunks
+CHUNK_THRESHOLD = 64 * 1024 * 1024
+# Chunks are between MIN_CHUNK and MAX_CHUNK bytes, a chunk ends at
+# the first window after MIN_CHUNK whose hash has MASK_BITS zero bits
+# (on average MIN_CHUNK + 2**MASK_BITS bytes)
+MIN_CHUNK = 512 * 1024
+MAX_CHUNK = 8 * 1024 * 1024
+MASK_BITS = 20
+# The number of bytes the rolling hash is calculated over
+WINDOW = 64
+# The amount of data hashed with each round of numpy operations
+SEGMENT = 4 * 1024 * 1024
+
+_MASK = 2**MASK_BITS - 1
+
+
+@lru_cache(maxsize=None)
+def _gear():
+    """
+    A fixed random value for each byte, the rolling hash of a
+    window is the sum (mod 2**32) of the values of its bytes
+    """
+    import numpy as np
+
+    return np.random.default_rng(0x6D3830).integers(
+        0, 2**32, size=256, dtype=np.uint32
+    )
+
+
+def _candidates(data):
+    """
+    The offsets in data that end a window whose rolling hash
+    matches the chunk mask. Since the hash only depends on the
+    bytes in the window, the candidates move along with the
+    content when data is inserted or removed.
+    """
+    import numpy as np
+
+    gear = _gear()
+    mask = np.uint32(_MASK)
+    found = []
+    for start in range(0, len(data), SEGMENT):
+        lo = max(0, start - WINDOW)
+        segment = data[lo : start + SEGMENT]
+        if len(segment) < WINDOW:
+            break
+        # Differences of the (wrapping) running sum are window sums
+        sums = np.zeros(len(segment) + 1, dtype=np.uint32)
+        np.cumsum(gear[segment], out=sums[1:])
+        # The hash of the windows ending at lo + WINDOW .. lo + len(segment)
+        rolling = np.subtract(sums[WINDOW:], sums[:-WINDOW])
+        np.bitwise_and(rolling, mask, out=rolling)
+        ends = np.flatnonzero(rolling == 0) + lo + WINDOW
+        found.append(ends[ends > start])
+    if not found:
+        return np.array([], dtype=np.int64)
+    return np.concatenate(found)
+
+
+def chunk_boundaries(data):
+    """
+    Split data into content defined chunks.
+
+    Parameters
+    ----------
+    data : buffer
+        The contents to split (e.g. a memory map of a file)
+
+    Returns
+    -------
+    list of (int, int)
+        The (start, end) offsets of each chunk
+    """
+    import numpy as np
+
+    data = np.frombuffer(data, dtype=np.uint8)
+    size = len(data)
+    chunks = []
+    start = 0
+    for end in _candidates(data):
+        end = int(end)
+        while end - start > MAX_CHUNK:
+            chunks.append((start, start + MAX_CHUNK))
+            start += MAX_CHUNK
+        if end - start >= MIN_CHUNK:
+            chunks.append((start, end))
+            start = end
+    while size - start > MAX_CHUNK:
+        chunks.append((start, start + MAX_CHUNK))
+        start += MAX_CHUNK
+    if start < size:
+        chunks.append((start, size))
+    return chunks
+
+
+def iter_chunks(filename):
+    """
+    Iterate over the content defined chunks of a file
+
+    Yields
+    ------
+    memoryview
+        The contents of each chunk, in order
+    """
+    with open(filename, "rb") as IN:
+        if os.fstat(IN.fileno()).st_size == 0:
+            return
+        with mmap.mmap(IN.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                for start, end in chunk_boundaries(mm):
+                    yield view[start:end]
+            finally:
+                view.release()
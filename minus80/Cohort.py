@@ -1,14 +1,14 @@
 from functools import lru_cache
+from itertools import groupby, islice
 from collections import Counter, defaultdict, namedtuple
 
 from minus80 import Accession, Freezable
-from difflib import SequenceMatcher
+from minus80.Metadata import encode, decode
+from minus80.Query import Query
 
 
-import numbers
-import math
+import json
 import logging
-import asyncssh
 import urllib
 import os
 import getpass
@@ -29,6 +29,15 @@ def invalidates_AID_cache(fn):
     return wrapped
 
 
+def _trigrams(name):
+    """
+    The (case insensitive) trigrams of a name, as they are
+    indexed by the FTS5 trigram tokenizer
+    """
+    name = name.lower()
+    return {name[i : i + 3] for i in range(len(name) - 2)}
+
+
 class Cohort(Freezable):
     """
     A Cohort is a named set of accessions. Once cohorts are
@@ -38,6 +47,18 @@ class Cohort(Freezable):
 
     # This is a named tuple that will be populated by self.get_fileinfo
     fileinfo = None
+    # The number of Accessions built from each round of set based queries
+    HYDRATE_BATCH = 1000
+    # The version of the sqlite schema (PRAGMA user_version)
+    #   1: accessions, aliases, metadata and files
+    #   2: secondary indexes on metadata, aliases and aid_files
+    #   3: typed metadata values
+    #   4: trigram (FTS5) indexes of names, aliases and raw files
+    SCHEMA_VERSION = 4
+    # The number of index rows ANALYZE samples after bulk loads
+    ANALYZE_LIMIT = 1000
+    # The number of index candidates scored by a fuzzy search
+    FUZZY_CANDIDATES = 100
 
     def __init__(self, name, rootdir=None):
         # Initialize Minus80
@@ -143,7 +164,12 @@ class Cohort(Freezable):
 
     @property
     def _AID_mapping(self):
-        return {x.name: x["AID"] for x in self}
+        return {
+            name: AID
+            for name, AID in self.m80.db.cursor()
+            .execute("SELECT name, AID FROM accessions")
+            .fetchall()
+        }
 
     @property
     def num_files(self):
@@ -155,14 +181,17 @@ class Cohort(Freezable):
         except ImportError as e:  # pragma: no cover
             raise ImportError("Pandas must be installed to use this feature") from e
         long_form = pd.DataFrame(
-            self.m80.db.cursor()
-            .execute(
-                """
-            SELECT name,key,val FROM accessions acc 
-            JOIN metadata met on acc.AID = met.AID;
-        """
-            )
-            .fetchall(),
+            [
+                (name, key, decode(type, val))
+                for name, key, type, val in self.m80.db.cursor()
+                .execute(
+                    """
+                SELECT name,key,type,val FROM accessions acc 
+                JOIN metadata met on acc.AID = met.AID;
+            """
+                )
+                .fetchall()
+            ],
             columns=["name", "key", "val"],
         )
         return long_form.pivot(index="name", columns="key", values="val")
@@ -213,14 +242,15 @@ class Cohort(Freezable):
                     f"Only {len(self)} accessions in cohort. Cannot"
                     " get {n} samples. See replace parameter in help."
                 )
-            return (
-                self[name]
-                for (name,) in self.m80.db.cursor().execute(
+            return self._hydrate(
+                self.m80.db.cursor()
+                .execute(
                     """
-                    SELECT name from accessions ORDER BY RANDOM() LIMIT ?;
+                    SELECT AID, name from accessions ORDER BY RANDOM() LIMIT ?;
                 """,
                     (n,),
                 )
+                .fetchall()
             )
         else:
             return (self.random_accession() for _ in range(n))
@@ -279,18 +309,18 @@ class Cohort(Freezable):
             # Populate the metadata and files tables
             cur.executemany(
                 """
-                INSERT OR REPLACE INTO metadata (AID, key, val)
-                VALUES (?, ?, ?)
+                INSERT OR REPLACE INTO metadata (AID, key, type, val)
+                VALUES (?, ?, ?, ?)
             """,
                 (
-                    (AID_map[accession.name], k, v)
+                    (AID_map[accession.name], k, *encode(v))
                     for accession in accessions
                     for k, v in accession.metadata.items()
                 ),
             )
             cur.executemany(
                 """
-                INSERT OR REPLACE INTO files (AID, url) VALUES (?, ?)
+                INSERT OR IGNORE INTO files (AID, url) VALUES (?, ?)
             """,
                 (
                     (AID_map[accession.name], file)
@@ -298,7 +328,8 @@ class Cohort(Freezable):
                     for file in accession.files
                 ),
             )
-        return [self[x] for x in accessions]
+        self._analyze()
+        return self.get_many(accessions)
 
     def add_accession(self, accession):
         """
@@ -317,10 +348,10 @@ class Cohort(Freezable):
             # Populate the metadata and files tables
             cur.executemany(
                 """
-                INSERT OR REPLACE INTO metadata (AID, key, val)
-                VALUES (?, ?, ?)
+                INSERT OR REPLACE INTO metadata (AID, key, type, val)
+                VALUES (?, ?, ?, ?)
             """,
-                ((AID, k, v) for k, v in accession.metadata.items()),
+                ((AID, k, *encode(v)) for k, v in accession.metadata.items()),
             )
             cur.executemany(
                 """
@@ -358,6 +389,8 @@ class Cohort(Freezable):
         properties.
 
         """
+        import pandas as pd
+
         if name_col not in df.columns:
             raise ValueError(f"{name_col}S not a valid column name")
         # filter out rows with NaN name_col values
@@ -369,12 +402,11 @@ class Cohort(Freezable):
             d = dict(row)
             name = d[name_col]
             del d[name_col]
-            # Get rid of missing data
+            # Get rid of missing data, the types of the
+            # rest are inferred when they are added
             for k, v in list(d.items()):
-                if isinstance(v, numbers.Number) and math.isnan(v):
+                if pd.isnull(v):
                     del d[k]
-                else:
-                    d[k] = str(v)
             accessions.append(Accession(name, files=None, **d))
         self.add_accessions(accessions)
 
@@ -388,7 +420,7 @@ class Cohort(Freezable):
                 a: aid
                 for a, aid in cur.execute(
                     """
-                SELECT val,AID FROM metadata 
+                SELECT CAST(val AS TEXT),AID FROM metadata 
                 WHERE key = ?
             """,
                     (colname,),
@@ -413,6 +445,7 @@ class Cohort(Freezable):
             """,
                 unique_aliases,
             )
+        self._analyze()
 
     @invalidates_AID_cache
     def drop_aliases(self):  # pragma: no cover
@@ -437,8 +470,10 @@ class Cohort(Freezable):
         Take a list of files and assign them to Accessions
         """
         results = defaultdict(set)
+        files = list(files)
+        searches = self.batch_search_accessions([os.path.basename(f) for f in files])
         for f in files:
-            matches = self.search_accessions(os.path.basename(f))
+            matches = searches[os.path.basename(f)]
             if len(matches) == 0:
                 results["unmatched"].add(f)
             elif best_only:
@@ -480,65 +515,113 @@ class Cohort(Freezable):
 
     def search_files(self, url):
         """
-        Perform a search of files names (url/path)
+        Perform a search of files names (url/path). Substrings of
+        three or more characters are looked up in a trigram index.
         """
         cur = self.m80.db.cursor()
-        name = f"%{url}%"
         names = cur.execute(
-            "SELECT url FROM raw_files WHERE url LIKE ? and ignore != 1", (name,)
+            """
+            SELECT raw_files.url FROM raw_files_fts
+            JOIN raw_files ON raw_files.FID = raw_files_fts.rowid
+            WHERE raw_files_fts.url LIKE ? AND ignore != 1
+            ORDER BY raw_files.FID
+        """,
+            (f"%{url}%",),
         ).fetchall()
         return [x[0] for x in names]
 
     def search_accessions(self, name, include_scores=False, recurse=True):
         """
-        Performs a search of accession names
+        Performs a search of accession names and aliases.
+
+        Parameters
+        ----------
+        name : str
+            The (part of a) name to search for
+        include_scores : bool, default=False
+            If True, (name, score) tuples are returned
+        recurse : bool, default=True
+            If nothing contains name, return the names that share
+            the most trigrams with it instead (a fuzzy search). E.g.
+            M7956_Fat_shoulder_1.fastq matches M7956_Fat_shoulder_1
+
+        Returns
+        -------
+        list
+            The matches ranked by score (best first). A name containing
+            name scores the percentage of it that name covers (100 for
+            an exact match). Fuzzy matches score the percentage of
+            trigrams they share with name (the Dice coefficient).
         """
-        cur = self.m80.db.cursor()
-        sql_name = f"%{name}%"
-        names = cur.execute(
-            "SELECT name FROM accessions WHERE name LIKE ?", (sql_name,)
-        ).fetchall()
-        aliases = cur.execute(
-            "SELECT alias FROM aliases WHERE alias LIKE ?", (sql_name,)
-        ).fetchall()
-        results = [(x[0], 100) for x in names + aliases]
-        # Find and Subset matches. e.g. Fat_shoulder_1 would
-        # match 'M7956_Fat_shoulder_1'
-        if len(results) == 0 and recurse == True:  # pragma: no cover
-            matches = [
-                SequenceMatcher(None, name, x).find_longest_match(
-                    0, len(name), 0, len(x)
-                )
-                for x in self.names
-            ]
-            best = sorted(matches, key=lambda x: x.size, reverse=True)[0]
-            best = name[best.a : best.a + best.size]
-            best = self.search_accessions(best, include_scores=True, recurse=False)[0]
-            if len(best) > 0:
-                results.append(best)
-        results = sorted(results, key=lambda x: x[1], reverse=True)
-        if include_scores == False:
-            results = [x[0] for x in results]
+        return self.batch_search_accessions(
+            [name], include_scores=include_scores, recurse=recurse
+        )[name]
+
+    def batch_search_accessions(self, names, include_scores=False, recurse=True):
+        """
+        Search for many names at once, see `search_accessions`.
+        The searches run in a single read transaction and reuse
+        the same (cached) statements.
+
+        Returns
+        -------
+        dict
+            name -> the ranked matches of name
+        """
+        results = {}
+        with self.m80.db.db:
+            cur = self.m80.db.cursor()
+            for name in names:
+                if name in results:
+                    continue
+                matches = self._substring_matches(cur, name)
+                if len(matches) == 0 and recurse:
+                    matches = self._fuzzy_matches(cur, name)
+                # Ties keep their order: names before aliases, by AID
+                matches = sorted(matches, key=lambda x: x[1], reverse=True)
+                if include_scores == False:
+                    matches = [x[0] for x in matches]
+                results[name] = matches
         return results
 
-    def search_metadata(self, **kwargs):
-        """"""
-        n_crit = 0
-        criteria = []
-        for k, v in kwargs.items():
-            criteria.append(f"(key = '{k}' AND val = '{v}')")
-            n_crit += 1
-        criteria = " OR ".join(criteria)
-        # Build the query
-        query = f"""
-            SELECT AID FROM (
-                SELECT AID, COUNT(*) as count FROM metadata 
-                WHERE {criteria}
-                GROUP BY AID
-            )
-            WHERE count = {n_crit}
+    def query(self):
+        """
+        Start a search of the Accessions in the Cohort. The
+        search is refined by chaining methods and runs lazily
+        when it is iterated, see `minus80.Query.Query`.
+
+        Example
+        -------
+        >>> from minus80.Metadata import Meta
+        >>> q = cohort.query().where(Meta("age") > 30, tissue="leaf").limit(1000)
+        >>> ages = [x["age"] for x in q.select("age")]
+        """
+        return Query(self)
+
+    def search_metadata(self, *conditions, **kwargs):
+        """
+        Find the Accessions whose metadata meet all of the conditions.
+
+        Parameters
+        ----------
+        *conditions : Condition
+            Conditions built from `Meta`, e.g. `Meta("age") > 30`
+            or `Meta("age").between(20, 30) | (Meta("tissue") == "leaf")`
+        **kwargs : key=value
+            Metadata that must equal value, or be any of value
+            if it is a list, tuple or set
+
+        Returns
+        -------
+        list of Accessions
+            Ordered by AID
+
+        Example
+        -------
+        >>> from minus80.Metadata import Meta
+        >>> cohort.search_metadata(Meta("age") >= 30, tissue=["leaf", "root"])
         """
-        return [self[x] for (x,) in self.m80.db.cursor().execute(query).fetchall()]
+        return list(self.query().where(*conditions, **kwargs))
 
     async def crawl_host(
         self, hostname="localhost", path="/", username=None, glob="*.fastq"
@@ -546,6 +629,8 @@ class Cohort(Freezable):
         """
         Use SSH to crawl a host looking for raw files
         """
+        import asyncssh
+
         if username is None:
             username = getpass.getuser()
         find_command = f'find -L {path} ! -readable -prune -o -name "{glob}" '
@@ -635,31 +720,13 @@ class Cohort(Freezable):
             is an internal ID for accession
         """
         AID = self._get_AID(name)
-        cur = self.m80.db.cursor()
         # Get the name based on AID
-        (name,) = cur.execute(
-            "SELECT name FROM accessions WHERE AID = ?", (AID,)
-        ).fetchone()
-        metadata = {
-            k: v
-            for k, v in cur.execute(
-                """
-                SELECT key, val FROM metadata WHERE AID = ?;
-                """,
-                (AID,),
-            ).fetchall()
-        }
-        metadata["AID"] = AID
-        files = [
-            x[0]
-            for x in cur.execute(
-                """
-                SELECT url FROM files WHERE AID = ?;
-            """,
-                (AID,),
-            ).fetchall()
-        ]
-        return Accession(name, files=files, **metadata)
+        row = (
+            self.m80.db.cursor()
+            .execute("SELECT AID, name FROM accessions WHERE AID = ?", (AID,))
+            .fetchone()
+        )
+        return next(self._hydrate([row]))
 
     def __len__(self):
         return (
@@ -673,17 +740,7 @@ class Cohort(Freezable):
         )
 
     def __iter__(self):
-        for name in (
-            x[0]
-            for x in self.m80.db.cursor()
-            .execute(
-                """
-                SELECT name FROM accessions
-                """
-            )
-            .fetchall()
-        ):
-            yield self[name]
+        return iter(self.query())
 
     def __contains__(self, item):
         if isinstance(item, Accession):
@@ -703,79 +760,253 @@ class Cohort(Freezable):
 
     def _initialize_tables(self):
         cur = self.m80.db.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS accessions (
-                AID INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE
-            );
+        with self.m80.db.db:
+            (version,) = cur.execute("PRAGMA user_version").fetchone()
+            if version < 1:
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS accessions (
+                        AID INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT NOT NULL UNIQUE
+                    );
+                """
+                )
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS aliases (
+                        alias TEXT UNIQUE,
+                        AID INTEGER,
+                        FOREIGN KEY(AID) REFERENCES accessions(AID)
+                    );
+                """
+                )
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS metadata (
+                        AID NOT NULL,
+                        key TEXT NOL NULL,
+                        val TEXT NOT NULL,
+                        FOREIGN KEY(AID) REFERENCES accessions(AID)
+                        UNIQUE(AID, key, val)
+                    );
+                """
+                )
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS raw_files (
+                        -- Basic File Info
+                        FID INTEGER PRIMARY KEY AUTOINCREMENT,
+                        url TEXT NOT NULL UNIQUE,
+                        -- MetaData
+                        ignore INT DEFAULT 0,
+                        canonical_path TEXT DEFAULT NULL
+                    );
+                """
+                )
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS aid_files (
+                        AID INTEGER,
+                        FID INTEGER,
+                        PRIMARY KEY(AID,FID)
+                        FOREIGN KEY(AID) REFERENCES accessions(AID),
+                        FOREIGN KEY(FID) REFERENCES raw_files(FID)
+                    );
+                """
+                )
+                # Views ----------------------------------------------
+                cur.execute(
+                    """
+                    CREATE VIEW IF NOT EXISTS files AS 
+                    SELECT AID,url
+                    FROM aid_files 
+                    JOIN raw_files 
+                        ON aid_files.FID = raw_files.FID;
+                """
+                )
+                cur.execute(
+                    """
+                    CREATE TRIGGER IF NOT EXISTS assign_FID INSTEAD OF INSERT ON files
+                    FOR EACH ROW
+                    BEGIN
+                        INSERT OR IGNORE INTO raw_files (url) VALUES (NEW.url);
+                        INSERT INTO aid_files (AID,FID) 
+                          SELECT NEW.AID, FID
+                          FROM raw_files WHERE url=NEW.url;
+                    END;
+                """
+                )
+            if version < 2:
+                # search_metadata and columns are answered from this index
+                # alone. Lookups by AID use the UNIQUE (AID, key, ...) index.
+                cur.execute(
+                    """
+                    CREATE INDEX IF NOT EXISTS metadata_key_val
+                    ON metadata (key, val, AID);
+                """
+                )
+                cur.execute(
+                    "CREATE INDEX IF NOT EXISTS aliases_AID ON aliases (AID, alias);"
+                )
+                cur.execute(
+                    "CREATE INDEX IF NOT EXISTS aid_files_FID ON aid_files (FID, AID);"
+                )
+                self._analyze()
+            if version < 3:
+                self._migrate_typed_metadata(cur)
+            if version < 4:
+                self._create_search_indexes(cur)
+            cur.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    def _migrate_typed_metadata(self, cur):
         """
-        )
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS aliases (
-                alias TEXT UNIQUE,
-                AID INTEGER,
-                FOREIGN KEY(AID) REFERENCES accessions(AID)
-            );
+        Store metadata values with their type. The values, which were
+        all stored as text, have their type inferred like new values.
         """
+        self.m80.db.db.create_scalar_function(
+            "m80_metadata_type", lambda val: encode(val)[0], 1, deterministic=True
+        )
+        self.m80.db.db.create_scalar_function(
+            "m80_metadata_val", lambda val: encode(val)[1], 1, deterministic=True
         )
         cur.execute(
             """
-            CREATE TABLE IF NOT EXISTS metadata (
+            CREATE TABLE metadata_typed (
                 AID NOT NULL,
-                key TEXT NOL NULL,
-                val TEXT NOT NULL,
+                key TEXT NOT NULL,
+                -- One of integer, real, text, bool or date (see minus80.Metadata)
+                type TEXT NOT NULL,
+                -- No type affinity, values are stored as they are given
+                val NOT NULL,
                 FOREIGN KEY(AID) REFERENCES accessions(AID)
-                UNIQUE(AID, key, val)
+                UNIQUE(AID, key, val, type)
             );
+            INSERT OR IGNORE INTO metadata_typed (AID, key, type, val)
+            SELECT AID, key, m80_metadata_type(val), m80_metadata_val(val)
+            FROM metadata;
+            DROP TABLE metadata;
+            ALTER TABLE metadata_typed RENAME TO metadata;
+            -- Typed values are compared within their types
+            CREATE INDEX metadata_key_val ON metadata (key, val, type, AID);
         """
         )
-        cur.execute(
+        self._analyze()
+
+    def _substring_matches(self, cur, name):
+        """
+        The (name, score) of the names and aliases containing name
+        """
+        pattern = f"%{name}%"
+        matches = cur.execute(
             """
-            CREATE TABLE IF NOT EXISTS raw_files (
-                -- Basic File Info
-                FID INTEGER PRIMARY KEY AUTOINCREMENT,
-                url TEXT NOT NULL UNIQUE,
-                -- MetaData
-                ignore INT DEFAULT 0,
-                canonical_path TEXT DEFAULT NULL
-            );
+            SELECT name FROM accessions_fts WHERE name LIKE ? ORDER BY rowid
+        """,
+            (pattern,),
+        ).fetchall()
+        matches += cur.execute(
+            """
+            SELECT alias FROM aliases_fts WHERE alias LIKE ? ORDER BY rowid
+        """,
+            (pattern,),
+        ).fetchall()
+        return [(x, round(100 * len(name) / max(len(x), 1), 1)) for (x,) in matches]
+
+    def _fuzzy_matches(self, cur, name):
+        """
+        The (name, score) of the names and aliases sharing the most
+        trigrams with name. The FUZZY_CANDIDATES best ranked by the
+        index (bm25) are scored, and the best scoring are returned.
+        """
+        trigrams = _trigrams(name)
+        if len(trigrams) == 0:
+            return []
+        query = " OR ".join('"' + t.replace('"', '""') + '"' for t in sorted(trigrams))
+        candidates = []
+        for table, column in (("accessions_fts", "name"), ("aliases_fts", "alias")):
+            candidates += cur.execute(
+                f"""
+                SELECT {column} FROM {table} WHERE {table} MATCH ?
+                ORDER BY rank LIMIT ?
+            """,
+                (query, self.FUZZY_CANDIDATES),
+            ).fetchall()
+        scored = []
+        for (x,) in candidates:
+            shared = _trigrams(x)
+            score = 200 * len(trigrams & shared) / (len(trigrams) + len(shared))
+            scored.append((x, round(score, 1)))
+        if len(scored) == 0:
+            return []
+        best = max(score for _, score in scored)
+        return [(x, score) for x, score in scored if score == best]
+
+    def _create_search_indexes(self, cur):
+        """
+        Index the accession names, aliases and raw file urls by trigram
+        (so substring searches use the index) in FTS5 tables that are
+        kept in sync with their tables by triggers.
+
+        The indexes refer to rows by rowid, which VACUUM may renumber
+        unless it is an INTEGER PRIMARY KEY, so aliases get one first.
         """
-        )
         cur.execute(
             """
-            CREATE TABLE IF NOT EXISTS aid_files (
+            CREATE TABLE aliases_v4 (
+                ALID INTEGER PRIMARY KEY,
+                alias TEXT UNIQUE,
                 AID INTEGER,
-                FID INTEGER,
-                PRIMARY KEY(AID,FID)
-                FOREIGN KEY(AID) REFERENCES accessions(AID),
-                FOREIGN KEY(FID) REFERENCES raw_files(FID)
+                FOREIGN KEY(AID) REFERENCES accessions(AID)
             );
+            INSERT INTO aliases_v4 (alias, AID) SELECT alias, AID FROM aliases;
+            DROP TABLE aliases;
+            ALTER TABLE aliases_v4 RENAME TO aliases;
+            CREATE INDEX aliases_AID ON aliases (AID, alias);
         """
         )
-        # Views ----------------------------------------------
-        cur.execute(
+        for table, column, rowid in (
+            ("accessions", "name", "AID"),
+            ("aliases", "alias", "ALID"),
+            ("raw_files", "url", "FID"),
+        ):
+            fts = f"{table}_fts"
+            cur.execute(
+                f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                    {column}, content='{table}', content_rowid='{rowid}',
+                    tokenize='trigram'
+                );
+                CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table}
+                BEGIN
+                    INSERT INTO {fts} (rowid, {column})
+                    VALUES (NEW.{rowid}, NEW.{column});
+                END;
+                CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table}
+                BEGIN
+                    INSERT INTO {fts} ({fts}, rowid, {column})
+                    VALUES ('delete', OLD.{rowid}, OLD.{column});
+                END;
+                CREATE TRIGGER IF NOT EXISTS {fts}_update
+                AFTER UPDATE OF {rowid}, {column} ON {table}
+                BEGIN
+                    INSERT INTO {fts} ({fts}, rowid, {column})
+                    VALUES ('delete', OLD.{rowid}, OLD.{column});
+                    INSERT INTO {fts} (rowid, {column})
+                    VALUES (NEW.{rowid}, NEW.{column});
+                END;
+                INSERT INTO {fts} ({fts}) VALUES ('rebuild');
             """
-            CREATE VIEW IF NOT EXISTS files AS 
-            SELECT AID,url
-            FROM aid_files 
-            JOIN raw_files 
-                ON aid_files.FID = raw_files.FID;
+            )
+
+    def _analyze(self):
         """
-        )
-        cur.execute(
-            """
-            CREATE TRIGGER IF NOT EXISTS assign_FID INSTEAD OF INSERT ON files
-            FOR EACH ROW
-            BEGIN
-                INSERT OR IGNORE INTO raw_files (url) VALUES (NEW.url);
-                INSERT INTO aid_files (AID,FID) 
-                  SELECT NEW.AID, FID
-                  FROM raw_files WHERE url=NEW.url;
-            END;
+        Refresh the statistics the query planner uses to pick indexes,
+        after a bulk load changed the shape of the tables. Only
+        ANALYZE_LIMIT rows of each index are sampled, so this stays
+        cheap on large cohorts.
         """
-        )
+        cur = self.m80.db.cursor()
+        cur.execute(f"PRAGMA analysis_limit = {self.ANALYZE_LIMIT}")
+        cur.execute("ANALYZE")
 
     def get_name(self, name):
         """
@@ -799,6 +1030,120 @@ class Cohort(Freezable):
         ]
         return [self.get_name(name)] + aliases
 
+    def get_many(self, names):
+        """
+        Get many accessions at once. The names are resolved in a
+        single join against a temporary table rather than one
+        lookup per name.
+
+        Parameters
+        ----------
+        names : iterable
+            Names, aliases, Accessions or AIDs (as in __getitem__)
+
+        Returns
+        -------
+        list of Accessions
+            In the same order as names
+
+        Raises
+        ------
+        NameError
+            If any of the names is not in the Cohort
+        """
+        names = [x.name if isinstance(x, Accession) else x for x in names]
+        # A read, so the durability settings of a bulk transaction are not needed
+        with self.m80.db.db:
+            cur = self.m80.db.cursor()
+            cur.execute(
+                """
+                CREATE TEMP TABLE IF NOT EXISTS m80_lookup (
+                    pos INTEGER PRIMARY KEY,
+                    name
+                );
+                DELETE FROM m80_lookup;
+            """
+            )
+            cur.executemany(
+                "INSERT INTO m80_lookup (pos, name) VALUES (?, ?)", enumerate(names)
+            )
+            # Names take precedence over aliases, which take precedence over AIDs
+            rows = cur.execute(
+                """
+                SELECT lookup.name, acc.AID, acc.name
+                FROM m80_lookup lookup
+                LEFT JOIN accessions acc ON acc.AID = COALESCE(
+                    (SELECT AID FROM accessions WHERE name = lookup.name),
+                    (SELECT AID FROM aliases WHERE alias = lookup.name),
+                    (SELECT AID FROM accessions WHERE AID = lookup.name)
+                )
+                ORDER BY lookup.pos
+            """
+            ).fetchall()
+            cur.execute("DELETE FROM m80_lookup")
+        for name, AID, _ in rows:
+            if AID is None:
+                raise NameError(f"{name} not in Cohort")
+        return list(self._hydrate([(AID, name) for _, AID, name in rows]))
+
+    def _hydrate(self, rows, keys=None, files=True):
+        """
+        Build Accessions from (AID, name) rows. Each batch of
+        HYDRATE_BATCH rows takes one metadata and one files query,
+        both ordered by AID so they are grouped in a single pass.
+        Accessions are yielded in the order of rows.
+
+        Only the metadata keys in keys are read (all of them if keys
+        is None), and files are not read if files is False.
+        """
+        projection = ""
+        if keys is not None:
+            projection = "AND key IN (SELECT value FROM json_each(?))"
+            keys = json.dumps(list(keys))
+        cur = self.m80.db.cursor()
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, self.HYDRATE_BATCH))
+            if len(batch) == 0:
+                return
+            AIDs = json.dumps(sorted({AID for AID, _ in batch}))
+            metadata, urls = {}, {}
+            if keys != "[]":
+                metadata = {
+                    AID: {k: decode(type, v) for _, k, type, v in group}
+                    for AID, group in groupby(
+                        cur.execute(
+                            f"""
+                            SELECT AID, key, type, val FROM metadata
+                            WHERE AID IN (SELECT value FROM json_each(?))
+                            {projection}
+                            ORDER BY AID
+                        """,
+                            (AIDs,) if keys is None else (AIDs, keys),
+                        ).fetchall(),
+                        key=lambda x: x[0],
+                    )
+                }
+            if files:
+                urls = {
+                    AID: [url for _, url in group]
+                    for AID, group in groupby(
+                        cur.execute(
+                            """
+                            SELECT AID, url FROM files
+                            WHERE AID IN (SELECT value FROM json_each(?))
+                            ORDER BY AID
+                        """,
+                            (AIDs,),
+                        ).fetchall(),
+                        key=lambda x: x[0],
+                    )
+                }
+            for AID, name in batch:
+                meta = dict(metadata.get(AID, {}))
+                meta["AID"] = AID
+                yield Accession(name, files=urls.get(AID, []), **meta)
+
     @lru_cache(maxsize=32768)
     def _get_AID(self, name):
         """
@@ -1,13 +1,10 @@
 import os
-import h5py
-import numpy
-import pandas
-
-import pandas as pd
 
 from pathlib import Path
 
-__all__ = ["columnar_db"]
+from .Exceptions import TagReadOnlyError
+
+__all__ = ["columnar_db", "frozen_parquet_db", "lazy_parquet_db"]
 
 
 def columnar_db(rootdir, engine="parquet"):  # pragma: no cover
@@ -54,24 +51,115 @@ class parquet_db(ColumnarDB):
         os.remove(self._pqdir / f"{name}.pq") 
 
     def list(self):
-        return [pq.removesuffix(".pq") for pq in os.listdir(self._pqdir)]
+        return [
+            pq.removesuffix(".pq")
+            for pq in os.listdir(self._pqdir)
+            if pq.endswith(".pq") and not pq.startswith(".")
+        ]
 
     def __contains__(self, key):
         return f"{key}.pq" in os.listdir(self._pqdir)
 
     def __setitem__(self, name, val):
+        import numpy
+        import pandas as pd
+
         if isinstance(val, numpy.ndarray):
             val = pd.DataFrame({self._MAGICKEY: val})
-            val.to_parquet(self._pqdir / f"{name}.pq")
         # Handle data frames
-        elif isinstance(val, pandas.DataFrame):
-            val.to_parquet(self._pqdir / f"{name}.pq")
-        else:
+        elif not isinstance(val, pd.DataFrame):
             raise ValueError("Datatype must be either a numpy array or a dataframe")
+        # Write to a new file and swap it in so that an existing
+        # file (which might be linked to a frozen blob) is never
+        # modified in place
+        tmp = self._pqdir / f".{name}.pq.tmp"
+        val.to_parquet(tmp)
+        os.replace(tmp, self._pqdir / f"{name}.pq")
 
 
+    def _path(self, name):
+        return self._pqdir / f"{name}.pq"
+
     def __getitem__(self, name):
-        val = pd.read_parquet(self._pqdir / f"{name}.pq") 
+        import pandas as pd
+
+        val = pd.read_parquet(self._path(name))
         if '__MINUS80ARRAY__' in val.columns and val.columns[0] == '__MINUS80ARRAY__':
             return val['__MINUS80ARRAY__'].to_numpy()
         return val
+
+
+class frozen_parquet_db(parquet_db):
+    """
+    A read-only parquet_db over the parquet files of a frozen tag,
+    tables are read straight from their blobs.
+
+    Parameters
+    ----------
+    tables : dict
+        table name -> checksum of its parquet file
+    resolve : callable
+        Returns the path of the file for a checksum
+    """
+
+    def __init__(self, tables, resolve):
+        self._tables = tables
+        self._resolve = resolve
+
+    def _path(self, name):
+        if name not in self._tables:
+            raise KeyError(name)
+        return self._resolve(self._tables[name])
+
+    def list(self):
+        return list(self._tables)
+
+    def __contains__(self, key):
+        return key in self._tables
+
+    def __setitem__(self, name, val):
+        raise TagReadOnlyError("Frozen tags are read-only, thaw the tag to modify it")
+
+    def remove(self, name):
+        raise TagReadOnlyError("Frozen tags are read-only, thaw the tag to modify it")
+
+
+class lazy_parquet_db(parquet_db):
+    """
+    A parquet_db over a lazily thawed dataset: tables whose files
+    have not been thawed yet are listed, and written from the frozen
+    blobs when they are accessed.
+
+    Parameters
+    ----------
+    rootdir : str
+        The thawed directory
+    pending : callable
+        Returns the names of the tables that are not thawed yet
+    materialize : callable
+        Thaws the file of a table (if it is pending)
+    """
+
+    def __init__(self, rootdir, pending, materialize):
+        super().__init__(rootdir)
+        self._pending = pending
+        self._materialize = materialize
+
+    def list(self):
+        return sorted(set(super().list()) | set(self._pending()))
+
+    def __contains__(self, key):
+        return key in self._pending() or super().__contains__(key)
+
+    def __setitem__(self, name, val):
+        super().__setitem__(name, val)
+        # The pending file was replaced
+        self._materialize(name)
+
+    def __getitem__(self, name):
+        self._materialize(name)
+        return super().__getitem__(name)
+
+    def remove(self, name):
+        self._materialize(name)
+        super().remove(name)
@@ -0,0 +1,100 @@
+"""Compression codecs for frozen blobs."""
+
+import gzip
+import zlib
+import logging
+
+__all__ = ["CODECS", "resolve_codec", "is_compressible", "compressor", "decompressor"]
+
+log = logging.getLogger("minus80")
+
+# codec -> the suffix of the blobs it compressed
+CODECS = {"zstd": ".zst", "gzip": ".gz"}
+
+# The probe compresses PROBE_SAMPLES blocks of PROBE_BLOCK bytes spread
+# over a file, files are compressed if the samples shrink below PROBE_RATIO
+PROBE_SAMPLES = 4
+PROBE_BLOCK = 64 * 1024
+PROBE_RATIO = 0.9
+
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 6
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def resolve_codec(codec):
+    """
+    Turn a compression setting into a codec name.
+
+    Parameters
+    ----------
+    codec : str, bool or None
+        One of CODECS, True for the best available codec (zstd if the
+        optional zstandard package is installed, otherwise gzip) or
+        None/False for no compression.
+
+    Returns
+    -------
+    str or None
+    """
+    if codec is None or codec is False:
+        return None
+    if codec is True:
+        return "zstd" if _zstandard() is not None else "gzip"
+    if codec not in CODECS:
+        raise ValueError(f"compression must be one of: {list(CODECS)}")
+    if codec == "zstd" and _zstandard() is None:
+        log.warning("zstandard is not installed, compressing with gzip")
+        return "gzip"
+    return codec
+
+
+def is_compressible(path, size):
+    """
+    A fast probe of whether a file is worth compressing: a few
+    blocks spread over the file are compressed at the lowest level.
+    """
+    if size == 0:
+        return False
+    step = max(size // PROBE_SAMPLES, PROBE_BLOCK)
+    raw = compressed = 0
+    with open(path, "rb") as IN:
+        for offset in range(0, size, step):
+            IN.seek(offset)
+            block = IN.read(PROBE_BLOCK)
+            raw += len(block)
+            compressed += len(zlib.compress(block, 1))
+    return compressed < raw * PROBE_RATIO
+
+
+def compressor(codec, fileobj):
+    """
+    Wrap a binary file object so the data written to it is compressed,
+    closing the returned object flushes the compressed stream (but does
+    not close fileobj)
+    """
+    if codec == "zstd":
+        return _zstandard().ZstdCompressor(level=ZSTD_LEVEL).stream_writer(
+            fileobj, closefd=False
+        )
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=GZIP_LEVEL, mtime=0)
+    raise ValueError(f"compression must be one of: {list(CODECS)}")
+
+
+def decompressor(codec, fileobj):
+    """
+    Wrap a binary file object to stream its decompressed contents
+    """
+    if codec == "zstd":
+        return _zstandard().ZstdDecompressor().stream_reader(fileobj)
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    raise ValueError(f"compression must be one of: {list(CODECS)}")
@@ -1,7 +1,6 @@
 #!/usr/env/python3
 
 import os
-import yaml
 import pprint
 
 global cf
@@ -43,8 +42,30 @@ class Level(dict):
 
 class Config(object):
     def __init__(self, filename):
-        filename = os.path.expanduser(filename)
-        self.data = Level(yaml.safe_load(open(filename, "r")))
+        self.filename = os.path.expanduser(filename)
+        self._data = None
+
+    @property
+    def data(self):
+        # The config file is only read when an option is first used
+        if self._data is None:
+            self._data = self._load()
+        return self._data
+
+    def _load(self):
+        import yaml
+
+        # Check to see if there is a config file available
+        if not os.path.isfile(self.filename):  # pragma: no cover
+            with open(self.filename, "w") as CF:
+                print(default_config, file=CF)
+        with open(self.filename, "r") as IN:
+            data = Level(yaml.safe_load(IN))
+        # Create the Minus80 directories if they do not exist
+        rootdir = os.path.realpath(os.path.expanduser(data["options"]["rootdir"]))
+        for subdir in ("", "datasets", "tmp", "Raw"):
+            os.makedirs(os.path.join(rootdir, subdir), exist_ok=True)
+        return data
 
     def __getattr__(self, item):
         return self.data[item]
@@ -62,9 +83,4 @@ class Config(object):
 
 cf_file = os.path.expanduser("~/.minus80.conf")
 
-# Check to see if there is a config file available
-if not os.path.isfile(cf_file):  # pragma: no cover
-    with open(cf_file, "w") as CF:
-        print(default_config, file=CF)
-
 cf = Config(cf_file)
@@ -0,0 +1,110 @@
+"""Table level comparison of frozen sqlite and parquet files."""
+
+import hashlib
+import logging
+
+from .RelationalDB import relational_db
+
+__all__ = ["table_kind", "describe_tables", "diff_tables"]
+
+log = logging.getLogger("minus80")
+
+
+def table_kind(path):
+    """
+    The kind of table file at a (relative) path: "sqlite",
+    "parquet" or None for files that do not hold tables
+    """
+    if path.endswith((".sqlite", ".sqlite3", ".db")):
+        return "sqlite"
+    if path.endswith((".pq", ".parquet")):
+        return "parquet"
+    return None
+
+
+def describe_tables(kind, filename, name=None):
+    """
+    Describe the tables in a file, which is opened read-only.
+    A parquet file holds a single table, which is called name.
+
+    Returns
+    -------
+    dict
+        table name -> {"schema": str, "rows": int, "digest": str}
+        where digest is a checksum of the table contents
+    """
+    if kind == "sqlite":
+        return _sqlite_tables(filename)
+    if kind == "parquet":
+        return _parquet_tables(filename, name)
+    raise ValueError(f"Cannot read tables from {kind} files")
+
+
+def diff_tables(tables_a, tables_b):
+    """
+    Compare the tables described by `describe_tables`
+
+    Returns
+    -------
+    dict
+        table name -> {"change": "new", "changed" or "deleted",
+        "rows": [rows in a, rows in b]} for the tables that differ
+        (the rows of a missing table are None)
+    """
+    delta = {}
+    for name in sorted(set(tables_a) | set(tables_b)):
+        a = tables_a.get(name)
+        b = tables_b.get(name)
+        if a == b:
+            continue
+        if a is None:
+            change = "new"
+        elif b is None:
+            change = "deleted"
+        else:
+            change = "changed"
+        delta[name] = {
+            "change": change,
+            "rows": [a and a["rows"], b and b["rows"]],
+        }
+    return delta
+
+
+def _sqlite_tables(filename):
+    db = relational_db.open_readonly(filename)
+    try:
+        cur = db.cursor()
+        tables = cur.execute(
+            "SELECT name, sql FROM sqlite_master "
+            "WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        ).fetchall()
+        described = {}
+        for name, sql in tables:
+            quoted = '"' + name.replace('"', '""') + '"'
+            digest = hashlib.sha256()
+            rows = 0
+            # Tables are scanned in key order, so equal contents hash equally
+            for row in cur.execute(f"SELECT * FROM {quoted}"):
+                digest.update(repr(row).encode("utf-8"))
+                rows += 1
+            described[name] = {"schema": sql, "rows": rows, "digest": digest.hexdigest()}
+        return described
+    finally:
+        db.db.close()
+
+
+def _parquet_tables(filename, name):
+    import pandas as pd
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile(filename)
+    # Hash the values rather than the file, which depends on
+    # how the table was split into row groups and pages
+    values = pd.util.hash_pandas_object(parquet.read().to_pandas(), index=True)
+    return {
+        name: {
+            "schema": str(parquet.schema_arrow),
+            "rows": parquet.metadata.num_rows,
+            "digest": hashlib.sha256(values.to_numpy().tobytes()).hexdigest(),
+        }
+    }
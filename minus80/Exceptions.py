@@ -37,6 +37,14 @@ class TagInvalidError(M80Error):
     pass
 
 
+class TagInUseError(M80Error):
+    pass
+
+
+class TagReadOnlyError(M80Error):
+    pass
+
+
 # Cloud Exceptions
 class UserNotLoggedInError(M80Error):
     pass
@@ -2,7 +2,6 @@ import os
 import re
 import json
 import random
-import shutil
 import asyncio
 import aiohttp
 import logging
@@ -11,8 +10,6 @@ import pyrebase
 import aiofiles
 
 from tqdm import tqdm
-from pathlib import Path
-from tinydb import TinyDB, where
 from contextlib import AsyncExitStack
 from requests.exceptions import HTTPError
 
@@ -160,7 +157,9 @@ class FireBaseCloudData(BaseCloudData):
 
     async def push(self, dtype, name, tag, max_conc_upload=5, progress=True):
         """
-        Pushes frozen tag data to the cloud.
+        Pushes frozen tag data to the cloud. Files the cloud
+        is missing are uploaded whole, even when they are frozen
+        as chunks (the cloud does not store chunks yet).
 
         Parameters
         ----------
@@ -176,15 +175,8 @@ class FireBaseCloudData(BaseCloudData):
         progress : bool (True)
             If true, print progress bars
         """
-        manifest = TinyDB(
-            Path(cf.options.rootdir)
-            / "datasets"
-            / API_VERSION
-            / f"{dtype}.{name}"
-            / "MANIFEST.json"
-        )
         # Fetch the tag
-        tag_data = manifest.get(where("tag") == tag)
+        tag_data = FreezableAPI(dtype, name).manifest.get(tag)
         if tag_data is None:
             raise TagDoesNotExistError
         # Add the additional information
@@ -322,13 +314,8 @@ class FireBaseCloudData(BaseCloudData):
                 # await on the semaphore
                 await stack.enter_async_context(sem)
                 # You can use non async contexts too!
-                file_path = (
-                    Path(cf.options.rootdir)
-                    / "datasets"
-                    / API_VERSION
-                    / f"{dtype}.{name}"
-                    / "frozen"
-                    / checksum
+                file_path = stack.enter_context(
+                    FreezableAPI(dtype, name).blobs.materialize(checksum)
                 )
                 f = await stack.enter_async_context(aiofiles.open(file_path, "rb"))
                 self.log.debug(f"Uploading {checksum}")
@@ -484,88 +471,92 @@ class FireBaseCloudData(BaseCloudData):
             The tag of the frozen dataset
         """
         # Get the frozen object
-        frozen_dataset = FreezableAPI(dtype, name, basedir=basedir)
+        frozen_dataset = FreezableAPI(dtype, name, rootdir=basedir)
         if tag in frozen_dataset.tags:
             raise TagExistsError
-        frozen_files = [x.name for x in frozen_dataset.frozen_dir.glob("*")]
-        # Cross ref the frozen files with the web hub
-        headers = {
-            "content-type": "application/json",
-            "Authorization": f"Bearer {self.user['idToken']}",
-        }
-        data = {
-            "api_version": API_VERSION,
-            "dtype": dtype,
-            "name": name,
-            "tag": tag,
-            "frozen_files": frozen_files,
-        }
-        async with self:
-            resp = await self._session.post(
-                url=self.URL_BASE + "stage_pull",
-                headers=headers,
-                json=data,
-                ssl=self.VERIFY,  # here for debugging on localhost
-            )
-            resp_json = await resp.json()
-            # handle missing dataset/tags errors
-            if resp.status == 409:
-                if resp_json["message"] == "DATASET_DOES_NOT_EXIST":
-                    raise CloudDatasetDoesNotExistError(resp_json["message"])
-                elif resp_json["message"] == "TAG_DOES_NOT_EXIST":
-                    raise CloudTagDoesNotExistError(resp_json["message"])
-                else:
-                    raise Exception
-            elif resp.status != 200:
-                raise Exception
-            # If we get here, we have a status of 200 and
-            # should process the downloads
-
-            # create a dict of checksums and sizes
-            checksum_sizes = {
-                x["checksum"]: x["size"]
-                for x in resp_json["tag_data"]["files"].values()
+        # Blobs that are already frozen are not downloaded again and new
+        # ones are not referenced until the tag is inserted, hold off
+        # garbage collection until then
+        with frozen_dataset.lock():
+            frozen_files = list(frozen_dataset.blobs)
+            # Cross ref the frozen files with the web hub
+            headers = {
+                "content-type": "application/json",
+                "Authorization": f"Bearer {self.user['idToken']}",
             }
-            sem = asyncio.Semaphore(max_conc_download)
-            download_tasks = []
-            self.log.info(f'need to download {len(resp_json["files_to_download"])}')
-            # loop through files to download and create download tasks
-            for i, (checksum, url) in enumerate(resp_json["files_to_download"].items()):
-                # Set up the progress bars
-                if progress and self.log.getEffectiveLevel() > logging.DEBUG:
-                    pbar = tqdm(
-                        desc=f"{checksum[0:6]}"
-                        + f"({human_sizeof(checksum_sizes[checksum]):>6})",
-                        total=int(checksum_sizes[checksum]) + 1,
-                        bar_format="{l_bar}{bar}{postfix:>30}",  # float-right, pad 30 chars
-                        leave=True,
-                    )
-                    pbar.update(1)
-                    pbar.set_postfix(status="PENDING")
-                download_tasks.append(
-                    asyncio.create_task(
-                        self._download_file(
-                            frozen_dataset, checksum, url, sem, pbar=pbar
+            data = {
+                "api_version": API_VERSION,
+                "dtype": dtype,
+                "name": name,
+                "tag": tag,
+                "frozen_files": frozen_files,
+            }
+            async with self:
+                resp = await self._session.post(
+                    url=self.URL_BASE + "stage_pull",
+                    headers=headers,
+                    json=data,
+                    ssl=self.VERIFY,  # here for debugging on localhost
+                )
+                resp_json = await resp.json()
+                # handle missing dataset/tags errors
+                if resp.status == 409:
+                    if resp_json["message"] == "DATASET_DOES_NOT_EXIST":
+                        raise CloudDatasetDoesNotExistError(resp_json["message"])
+                    elif resp_json["message"] == "TAG_DOES_NOT_EXIST":
+                        raise CloudTagDoesNotExistError(resp_json["message"])
+                    else:
+                        raise Exception
+                elif resp.status != 200:
+                    raise Exception
+                # If we get here, we have a status of 200 and
+                # should process the downloads
+
+                # create a dict of checksums and sizes
+                checksum_sizes = {
+                    x["checksum"]: x["size"]
+                    for x in resp_json["tag_data"]["files"].values()
+                }
+                sem = asyncio.Semaphore(max_conc_download)
+                download_tasks = []
+                self.log.info(f'need to download {len(resp_json["files_to_download"])}')
+                # loop through files to download and create download tasks
+                for i, (checksum, url) in enumerate(resp_json["files_to_download"].items()):
+                    # Set up the progress bars
+                    if progress and self.log.getEffectiveLevel() > logging.DEBUG:
+                        pbar = tqdm(
+                            desc=f"{checksum[0:6]}"
+                            + f"({human_sizeof(checksum_sizes[checksum]):>6})",
+                            total=int(checksum_sizes[checksum]) + 1,
+                            bar_format="{l_bar}{bar}{postfix:>30}",  # float-right, pad 30 chars
+                            leave=True,
+                        )
+                        pbar.update(1)
+                        pbar.set_postfix(status="PENDING")
+                    download_tasks.append(
+                        asyncio.create_task(
+                            self._download_file(
+                                frozen_dataset, checksum, url, sem, pbar=pbar
+                            )
                         )
                     )
-                )
-            # Await the downloads
-            await asyncio.gather(*download_tasks, return_exceptions=True)
-        download_success = True
-        for task in download_tasks:
-            result = task.result()
-            if result["status"] == "SUCCESS":
-                self.log.debug(f'Success downloading {result["checksum"]}')
-            elif result["status"] == "FAIL":
-                self.log.debug(f'Failed downloading {result["checksum"]}')
-                download_success = False
-
-        if download_success == True:
-            # If we get here, all of the frozen files were downloaded,
-            # Its safe to add the tag to the project
-            frozen_dataset._manifest.insert(resp_json["tag_data"])
-        else:
-            raise CloudPullFailedError()
+                # Await the downloads
+                await asyncio.gather(*download_tasks, return_exceptions=True)
+            download_success = True
+            for task in download_tasks:
+                result = task.result()
+                if result["status"] == "SUCCESS":
+                    self.log.debug(f'Success downloading {result["checksum"]}')
+                elif result["status"] == "FAIL":
+                    self.log.debug(f'Failed downloading {result["checksum"]}')
+                    download_success = False
+
+            if download_success == True:
+                # If we get here, all of the frozen files were downloaded,
+                # Its safe to add the tag to the project
+                frozen_dataset.manifest.insert(resp_json["tag_data"])
+            else:
+                raise CloudPullFailedError()
 
     async def _download_file(
         self,
@@ -612,10 +603,7 @@ class FireBaseCloudData(BaseCloudData):
             # Move the file to the project
             if pbar is not None:
                 pbar.set_postfix(status="COPYING")
-            if os.path.getsize(tmpfile.name) == 0:
-                open(frozen_dataset.frozen_dir / checksum, "a").close()
-            else:
-                shutil.copyfile(tmpfile.name, frozen_dataset.frozen_dir / checksum)
+            frozen_dataset.blobs.add(tmpfile.name, checksum)
             status = {"status": "SUCCESS", "checksum": checksum}
             if pbar is not None:
                 pbar.set_postfix(status="DONE")
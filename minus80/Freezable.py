@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 import os
+import json
+import stat
+import time
 import shutil
 import hashlib
 import logging
@@ -8,10 +11,28 @@ import re
 
 from glob import glob
 from pathlib import Path
-from tinydb import TinyDB
 from datetime import datetime
+from contextlib import contextmanager
 
 from .Config import cf
+from .Checksum import (
+    ChecksumCache,
+    file_hash,
+    scan_files,
+    default_workers,
+    companion_stats,
+)
+from .BlobStore import BlobStore, SharedBlobStore, LINK_MODES
+from .Chunking import CHUNK_THRESHOLD
+from .Compression import resolve_codec
+from .Packs import PACK_MAX_SIZE, PACK_MIN_FILES
+from .Manifest import Manifest
+from .FrozenTag import FrozenTag
+from .LazyThaw import PendingFiles
+from .Watcher import DirtySet, start_watcher
+from .Verify import VerifyLog, verify_blobs
+from .Diff import table_kind, describe_tables, diff_tables
+from .Tools import write_json
 from .Exceptions import (
     TagInvalidError,
     FreezableNameInvalidError,
@@ -19,16 +40,14 @@ from .Exceptions import (
 
 from minus80 import API_VERSION
 
-
-from tinydb import where
-
 from minus80.RelationalDB import relational_db
-from minus80.ColumnDB import columnar_db
+from minus80.ColumnDB import columnar_db, lazy_parquet_db
 
 
 from .Exceptions import (
     TagExistsError,
     TagDoesNotExistError,
+    TagInUseError,
     UnsavedChangesInThawedError,
 )
 
@@ -67,6 +86,12 @@ class Freezable(object):
 class FreezableAPI(object):
 
     _slug_prefix = "MINUS80"
+    # Journals of the relational db, its snapshots already
+    # contain the transactions they hold
+    _db_journals = ("db.sqlite-journal", "db.sqlite-wal", "db.sqlite-shm")
+    # The journals that hold committed transactions, which are part
+    # of the contents of the relational db (and of its cache key)
+    _db_companions = ("db.sqlite-wal", "db.sqlite-journal")
 
     def __init__(self, dtype, name, rootdir=None):
         """
@@ -97,11 +122,25 @@ class FreezableAPI(object):
         os.makedirs(self.frozen_dir, exist_ok=True)
 
         # init the manifest
+        self._manifest = None
         self.manifest
 
         self._col = None
         self._db = None
         self._doc = None
+        self._checksum_cache = None
+        self._pending = None
+        self._blobs = None
+        # The watcher tracking changes to the thawed dir (see `watch`)
+        self._watcher = None
+        self._dirty = None
+        # checksum -> {"size", "digest"} of the db snapshots hashed
+        self._db_snapshots = {}
+        # The number of files hashed concurrently
+        self.hash_workers = default_workers()
+        # The number of files hashed/served from the cache by
+        # the last checksum calculation
+        self.checksum_stats = {"hashed": 0, "cached": 0}
 
 
     # Class Properties --------------------------------------------------
@@ -109,14 +148,28 @@ class FreezableAPI(object):
     @property
     def col(self):
         if self._col is None:
-            # Set up the columnar db
-            self._col = columnar_db(self.thawed_dir)
+            # Set up the columnar db, which always writes new files
+            # so it never modifies linked blobs in place
+            if len(self.pending):
+                self._col = lazy_parquet_db(
+                    self.thawed_dir,
+                    pending=lambda: [
+                        rel_path[len("pq/") : -len(".pq")]
+                        for rel_path in self.pending.select("pq")
+                        if rel_path.endswith(".pq")
+                    ],
+                    materialize=lambda name: self.materialize([f"pq/{name}.pq"]),
+                )
+            else:
+                self._col = columnar_db(self.thawed_dir)
         return self._col
 
     @property
     def db(self):
         if self._db is None:
             # set up the relational db
+            self.materialize(["db.sqlite"])
+            self._break_link(self.thawed_dir / "db.sqlite")
             self._db = relational_db(self.thawed_dir)
         return self._db
 
@@ -124,13 +177,89 @@ class FreezableAPI(object):
     def doc(self):
         if self._doc is None:
             # Set up a table
+            from tinydb import TinyDB
+
+            self.materialize(["documentDB.json"])
+            self._break_link(self.thawed_dir / "documentDB.json")
             self._doc = TinyDB(os.path.join(self.thawed_dir, "documentDB.json"))
         return self._doc
 
+    @property
+    def settings(self):
+        """
+        Per dataset settings, see `configure`
+        """
+        try:
+            with open(self.basedir / "SETTINGS.json", "r") as IN:
+                return json.load(IN)
+        except FileNotFoundError:
+            return {}
+
+    def configure(self, **kwargs):
+        """
+        Persist per dataset settings. Settings that are not set for
+        a dataset fall back to the ``options`` in ~/.minus80.conf.
+
+        Parameters
+        ----------
+        link_mode : str
+            How files are moved between the thawed and frozen
+            directories. One of: copy, reflink, hardlink.
+        chunk_threshold : int
+            Files at least this big (bytes) are frozen as content
+            defined chunks so new versions only store the chunks that
+            changed. 0 disables chunking.
+        compression : str or bool
+            Compress frozen files that pass a quick compressibility
+            probe: "zstd" (requires the zstandard package), "gzip" or
+            True for the best available codec. Files frozen with
+            reflink/hardlink link modes are not compressed.
+        pack_max_size : int
+            Files smaller than this (bytes) are bundled into pack
+            files when a freeze adds at least pack_min_files of them.
+            0 disables packing.
+        pack_min_files : int
+            The number of small files a freeze must add to pack them
+        shared_blobs : bool
+            If True, files are frozen into a store shared by all the
+            datasets in the root directory. Files that were already
+            frozen are moved into the shared store.
+        """
+        if "link_mode" in kwargs and kwargs["link_mode"] not in LINK_MODES:
+            raise ValueError(f"link_mode must be one of: {LINK_MODES}")
+        if "compression" in kwargs:
+            resolve_codec(kwargs["compression"])
+        settings = self.settings
+        settings.update(kwargs)
+        write_json(self.basedir / "SETTINGS.json", settings)
+        # The store may have changed
+        self._blobs = None
+
+    def _setting(self, key, default=None):
+        """
+        Look up a setting for the dataset, falling back to the config file
+        """
+        settings = self.settings
+        if key in settings:
+            return settings[key]
+        return cf.options.get(key, default)
+
+    @property
+    def link_mode(self):
+        """
+        The link mode used to freeze and thaw files (see `configure`)
+        """
+        mode = self._setting("link_mode", "copy")
+        if mode not in LINK_MODES:
+            raise ValueError(f"link_mode must be one of: {LINK_MODES}")
+        return mode
+
 
     @property
     def manifest(self):
-        return TinyDB(self.basedir / "MANIFEST.json")
+        if self._manifest is None:
+            self._manifest = Manifest(self.basedir)
+        return self._manifest
 
     @property
     def slug(self):
@@ -149,20 +278,16 @@ class FreezableAPI(object):
         """
         Returns the available frozen "tags"
         """
-        tag_docs = self.tag_data
-        tags = set([x["tag"] for x in tag_docs])
-        # remove the "thawed" tag
-        tags.discard("thawed")
-        return tags
+        return set(self.manifest.tags())
 
     @property
     def tag_data(self):
-        return self.manifest.search(where("tag").exists())
+        return self.manifest.all()
 
 
     @property
     def thawed_tag(self):
-        tag = self.manifest.get(where("tag") == "thawed")
+        tag = self.manifest.get("thawed")
         if tag is None:
             tag = {"tag": "thawed", "parent": None}
         return dict(tag)
@@ -172,65 +297,296 @@ class FreezableAPI(object):
         tag = self.thawed_tag
         if tag["parent"] is None:
             raise TagDoesNotExistError("parent tag is None")
-        parent = self.manifest.get(where("tag") == tag["parent"])
+        parent = self.manifest.get(tag["parent"])
         if parent is None:  # pragma: no cover
             raise TagDoesNotExistError(
                 'parent tag "{tag["parent"]} is not in manifest"'
             )
         return parent
 
+    @property
+    def blobs(self):
+        """
+        The content addressed store holding the frozen files: the
+        frozen directory of the dataset or, with the shared_blobs
+        setting, a store shared by every dataset in the root directory.
+        """
+        if self._blobs is None:
+            if self.shared_blobs:
+                self._blobs = SharedBlobStore(
+                    self.basedir.parent / "blobs",
+                    chunk_threshold=self.chunk_threshold,
+                    compression=self.compression,
+                )
+                self._blobs.register(self.slug, self.basedir)
+                with self._blobs.lock():
+                    self._update_blob_refs()
+                    # Move over files frozen before the store was shared
+                    moved = self._blobs.adopt(BlobStore(self.frozen_dir))
+                if moved:
+                    log.info(f"Moved {moved} frozen files of {self.slug} to {self._blobs.root}")
+            else:
+                self._blobs = BlobStore(
+                    self.frozen_dir,
+                    chunk_threshold=self.chunk_threshold,
+                    compression=self.compression,
+                )
+        return self._blobs
+
+    @property
+    def chunk_threshold(self):
+        """
+        Files at least this big (bytes) are frozen as content defined
+        chunks (see `configure`), 0 disables chunking
+        """
+        return int(self._setting("chunk_threshold", CHUNK_THRESHOLD) or 0)
+
+    @property
+    def compression(self):
+        """
+        The codec used to compress frozen files (see `configure`)
+        """
+        return self._setting("compression", None)
+
+    @property
+    def pack_max_size(self):
+        """
+        Files smaller than this (bytes) are frozen into pack files
+        (see `configure`), 0 disables packing
+        """
+        return int(self._setting("pack_max_size", PACK_MAX_SIZE) or 0)
+
+    @property
+    def pack_min_files(self):
+        """
+        The number of small files a freeze must add for them to be packed
+        """
+        return int(self._setting("pack_min_files", PACK_MIN_FILES))
+
+    @property
+    def shared_blobs(self):
+        """
+        If files are frozen into the store shared by all datasets
+        in the root directory (see `configure`)
+        """
+        return bool(self._setting("shared_blobs", False))
+
+    @property
+    def checksum_cache(self):
+        """
+        The persistent cache of thawed file checksums
+        """
+        if self._checksum_cache is None:
+            self._checksum_cache = ChecksumCache(self.basedir / "CHECKSUMS.json")
+        return self._checksum_cache
+
+    @property
+    def pending(self):
+        """
+        The files of a lazy thaw that were not materialized yet
+        """
+        if self._pending is None:
+            self._pending = PendingFiles(self.basedir / "PENDING.json")
+        return self._pending
+
     @property
     def checksum(self):
         """
         Calculates the checksum of all the files in the freezable
-        objects database directory
+        objects database directory. Only files whose stat changed
+        since they were last hashed are re-read. The relational db
+        is checksummed through a snapshot (see `relational_db.snapshot`).
+        If the dataset is watched (see `watch`) and no file changed
+        since the parent tag, the directory is not walked at all.
         """
+        return self._checksum()
+
+    def _hasher(self, hasher=file_hash, db_hasher=None):
+        """
+        Wrap hasher so the relational db is hashed through a
+        snapshot, which is passed to db_hasher (defaults to hasher)
+        """
+        db_file = str(self.thawed_dir / "db.sqlite")
+        if db_hasher is None:
+            db_hasher = hasher
+
+        def hash_file(path):
+            if str(path) != db_file:
+                return hasher(path)
+            with self._db_snapshot() as snapshot:
+                return self._hash_db_snapshot(snapshot, db_hasher)
+
+        return hash_file
+
+    def _hash_db_snapshot(self, snapshot, hasher):
+        """
+        The checksum of a snapshot of the relational db. If it has the
+        same contents as the db of the parent tag, that checksum is
+        kept (the bytes of snapshots differ between copies), otherwise
+        the snapshot is passed to hasher.
+        """
+        digest = relational_db.digest(snapshot)
+        parent = self._parent_db_snapshot()
+        if parent is not None and parent["digest"] == digest:
+            checksum, size = parent["checksum"], parent["size"]
+        else:
+            checksum, size = hasher(snapshot), os.path.getsize(snapshot)
+        self._db_snapshots[checksum] = {"size": size, "digest": digest}
+        return checksum
+
+    def _parent_db_snapshot(self):
+        """
+        The {"checksum", "size", "digest"} of the db of the parent
+        tag, None if there is none or it was frozen without a digest
+        """
+        parent = self.thawed_tag["parent"]
+        if parent is None:
+            return None
+        tag = self.manifest.get(parent, files=False)
+        return None if tag is None else tag.get("db_snapshot")
+
+    def _db_snapshot_info(self, checksum):
+        """
+        The {"checksum", "size", "digest"} of a db snapshot
+        """
+        if checksum in self._db_snapshots:
+            return dict(self._db_snapshots[checksum], checksum=checksum)
+        parent = self._parent_db_snapshot()
+        if parent is not None and parent["checksum"] == checksum:
+            return parent
+        return None
+
+    def _checksum(self, hasher=file_hash, db_hasher=None):
+        """
+        Calculates the checksum of the thawed files, files that
+        need to be (re)hashed are passed through hasher and a
+        snapshot of the relational db through db_hasher (which
+        defaults to hasher).
+        """
+        hash_file = self._hasher(hasher, db_hasher)
         checksums = {
             "slug": hashlib.sha256(
                 self.slug.encode("utf-8")
             ).hexdigest(),
             "files": {},
         }
+        delta = self._watched_delta(hash_file)
+        if delta is not None:
+            changes, changed_files = delta
+            parent = self.parent_tag
+            if not any(changes.values()):
+                # Nothing changed since the parent tag
+                checksums["files"] = parent["files"]
+                checksums["total"] = parent["total"]
+                return checksums
+            # Only the paths the watcher saw change were looked at
+            deleted = set(changes["deleted"])
+            checksums["files"] = {
+                rel_path: file_dict
+                for rel_path, file_dict in parent["files"].items()
+                if rel_path not in deleted
+            }
+            checksums["files"].update(changed_files)
+        else:
+            if self._watcher is not None:
+                self._watcher.drain()
+                self._scan_seq = self._dirty.snapshot()[0]
+            cache = self.checksum_cache
+            # iterate over the direcory and calucalte the hashes
+            checksums["files"] = scan_files(
+                self.thawed_dir,
+                cache=cache,
+                workers=self.hash_workers,
+                hasher=hash_file,
+                pending=self.pending,
+                exclude=self._db_journals,
+                companions={"db.sqlite": self._db_companions},
+            )
+            # Forget about files that are no longer here and persist
+            cache.prune(checksums["files"])
+            cache.save()
+            self.checksum_stats = cache.stats
+            log.debug(
+                f"Checksummed {self.slug}: {cache.hashed} files hashed, "
+                f"{cache.cached} from cache"
+            )
+        db_file = checksums["files"].get("db.sqlite")
+        if db_file is not None:
+            # Record the size of the snapshot, not the thawed db
+            snapshot = self._db_snapshot_info(db_file["checksum"])
+            if snapshot is not None:
+                checksums["files"]["db.sqlite"] = dict(db_file, size=snapshot["size"])
+        checksums["total"] = self._total(checksums)
+        if self._watcher is not None and self.thawed_tag["parent"] is not None:
+            # The checksums tell exactly which files differ from the parent
+            parent = self.parent_tag
+            self._dirty.rebase(
+                self._scan_seq,
+                self._differences(checksums["files"], parent["files"]),
+                parent=parent["tag"],
+            )
+        return checksums
+
+    @staticmethod
+    def _differences(files, parent_files):
+        """
+        The paths of the files that differ between two file lists
+        """
+        return [
+            rel_path
+            for rel_path, data in files.items()
+            if rel_path not in parent_files
+            or parent_files[rel_path]["checksum"] != data["checksum"]
+        ] + [rel_path for rel_path in parent_files if rel_path not in files]
 
-        def file_hash(filepath):
-            running_hash = hashlib.sha256()
-            with open(filepath, "rb") as IN:
-                while True:
-                    # Read file in as little chunks.
-                    buf = IN.read(4096)
-                    if not buf:
-                        break
-                    running_hash.update(buf)
-            return running_hash.hexdigest()
-
-        # iterate over the direcory and calucalte the hash
-        for root, dirs, files in os.walk(self.thawed_dir):
-            for file_path in sorted(files):
-                full_path = str(Path(root) / file_path)
-                # Calculate a relative path to the freezable object
-                rel_path = full_path.replace(str(self.thawed_dir) + "/", "")
-                # calculate and store the checksums
-                phash = file_hash(full_path)
-                filesize = os.path.getsize(full_path)
-                checksums["files"][rel_path] = {
-                    "checksum": phash,
-                    "size": filesize,
-                }
-        # calculate the total
+    @staticmethod
+    def _total(checksums):
+        """
+        The checksum over the slug and all the file checksums
+        """
         total = hashlib.sha256(checksums["slug"].encode("utf-8"))
-        # Iterate over filenames AND hashes and update checksum
-        for filename, data in checksums["files"].items():
+        # Iterate over filenames AND hashes and update checksum, in path
+        # order so the total does not depend on how the files were found
+        files = checksums["files"]
+        for filename in sorted(files):
             total.update(filename.encode("utf-8"))
-            total.update(data["checksum"].encode("utf-8"))
-        checksums["total"] = total.hexdigest()
-        return checksums
+            total.update(files[filename]["checksum"].encode("utf-8"))
+        return total.hexdigest()
+
+    @contextmanager
+    def _db_snapshot(self):
+        """
+        A temporary snapshot of the relational db, taken without
+        stopping the connections that write to it
+        """
+        fd, snapshot = tempfile.mkstemp(dir=self.basedir, prefix=".db-snapshot-")
+        os.close(fd)
+        try:
+            relational_db.snapshot(self.thawed_dir / "db.sqlite", snapshot)
+            yield snapshot
+        finally:
+            os.unlink(snapshot)
 
     # Class Methods --------------------------------------------------
 
-    def freeze(self, tagname):
+    def freeze(self, tagname, single_pass=True):
         """
         Freezes the current working (aka "thawed") dataset and freezes its contents
         for posterity.
+
+        Parameters
+        ----------
+        tagname : str
+            The name of the new tag
+        single_pass : bool, default=True
+            If True, changed files are read once: they are hashed while
+            being streamed into the frozen directory. If False, changed
+            files are hashed first and only copied if their checksum is
+            not already frozen (two reads, but no writes for files
+            whose contents are already frozen).
+
+        The relational db is frozen from a snapshot, so connections
+        can keep writing to it while the freeze runs.
         """
         # Create the tag from the current thawed tag
         tag = self.thawed_tag
@@ -239,37 +595,95 @@ class FreezableAPI(object):
         if tagname in self.tags:
             raise TagExistsError(f"Tag already exists: {tagname}")
         tag["tag"] = tagname
-        # Update the tag with current file checksums
-        tag.update(self.checksum)
-
-        # Check to see what files need to be frozen
-        for relative_path, file_dict in tag["files"].items():
-            phash = file_dict["checksum"]
-
-            if not (self.frozen_dir / phash).exists():
-                log.info(f"Found a new file: {relative_path}")
-                shutil.copyfile(
-                    self.thawed_dir / relative_path, self.frozen_dir / phash
-                )
-            else:
-                log.info(f"Using cached file: {relative_path}")
-
-        # Add a datetime to the document
-        tag["timestamp"] = datetime.now().timestamp()
-
-        # Add the tag to the manifest
-        self.manifest.insert(tag)
-        # Update the current thawed tag
-        self._update_thawed_tag({"parent": tagname})
-
-    def file_changes(self):
+        # Blobs written by a freeze are not referenced by a tag until the
+        # end, a shared lock keeps gc() from collecting them in between
+        with self.lock():
+            link_mode = self.link_mode
+            # Files held open by this instance are written in place,
+            # they cannot share an inode with a blob
+            held_open = set()
+            if self._doc is not None:
+                held_open.add(str(self.thawed_dir / "documentDB.json"))
+
+            def file_mode(path):
+                if link_mode == "hardlink" and str(path) in held_open:
+                    return "reflink"
+                return link_mode
+
+            pack_max_size = self.pack_max_size
+            with self.blobs.packer(min_files=self.pack_min_files) as packer:
+
+                def freeze_file(path, checksum=None):
+                    # Small copied files are bundled into packs
+                    mode = file_mode(path)
+                    if mode == "copy" and os.path.getsize(path) < pack_max_size:
+                        return packer.ingest(path)
+                    if checksum is None:
+                        return self.blobs.ingest(path, mode=mode)
+                    self.blobs.add(path, checksum, mode=mode)
+                    return checksum
+
+                # Update the tag with current file checksums, changed files
+                # are frozen as they are hashed in single pass mode
+                # The db snapshot is temporary, it is always frozen right away
+                if single_pass:
+                    tag.update(self._checksum(hasher=freeze_file))
+                else:
+                    tag.update(self._checksum(db_hasher=freeze_file))
+
+                def stored(checksum):
+                    # Packed objects are only indexed when the packer
+                    # is flushed, until then the packer holds them
+                    return checksum in packer or self.blobs.exists(checksum)
+
+                # Check to see what files still need to be frozen
+                for relative_path, file_dict in tag["files"].items():
+                    phash = file_dict["checksum"]
+
+                    if not stored(phash) and relative_path == "db.sqlite":
+                        # The checksum came from the cache, freeze a new snapshot
+                        log.info(f"Found a new file: {relative_path}")
+                        with self._db_snapshot() as snapshot:
+                            file_dict["checksum"] = self._hash_db_snapshot(
+                                snapshot, freeze_file
+                            )
+                        file_dict["size"] = self._db_snapshots[file_dict["checksum"]]["size"]
+                        tag["total"] = self._total(tag)
+                    elif not stored(phash):
+                        log.info(f"Found a new file: {relative_path}")
+                        freeze_file(self.thawed_dir / relative_path, phash)
+                    else:
+                        log.info(f"Using cached file: {relative_path}")
+
+            # Keep the contents of the db, to tell if later snapshots changed
+            tag.pop("db_snapshot", None)
+            if "db.sqlite" in tag["files"]:
+                snapshot = self._db_snapshot_info(tag["files"]["db.sqlite"]["checksum"])
+                if snapshot is not None:
+                    tag["db_snapshot"] = snapshot
+
+            # Add a datetime to the document
+            tag["timestamp"] = datetime.now().timestamp()
+
+            # Add the tag to the manifest
+            self.manifest.insert(tag)
+            self._update_blob_refs()
+            # Update the current thawed tag
+            self._update_thawed_tag({"parent": tagname})
+            if self._watcher is not None:
+                # Everything up to the checksum is in the new tag
+                self._dirty.rebase(self._scan_seq, (), parent=tagname)
+
+    def file_changes(self, checksum=None):
         """
         Calculate the files that are "new", "changed", or "deleted" compared
         to the last frozen tag (parent tag)
 
         Paremeters
         ----------
-        None
+        checksum : dict, default=None
+            A precomputed checksum of the thawed dataset,
+            if None, it is calculated.
 
         Returns
         -------
@@ -280,34 +694,110 @@ class FreezableAPI(object):
         changed = []
         deleted = []
         parent = self.parent_tag
+        if checksum is None:
+            # Only the paths that changed need to be looked at
+            changes = self._watched_changes()
+            if changes is not None:
+                return changes
+            checksum = self.checksum
+        current_files = checksum["files"]
         # Loop through the files and find the ones that have changed
-        for relative_path, file_dict in self.checksum["files"].items():
+        for relative_path, file_dict in current_files.items():
             if relative_path not in parent["files"]:
                 new.append(relative_path)
             elif file_dict["checksum"] != parent["files"][relative_path]["checksum"]:
                 changed.append(relative_path)
         # Loop through the parent files and see which files have been deleted
         for relative_path in parent["files"].keys():
-            if relative_path not in self.checksum["files"]:
+            if relative_path not in current_files:
                 deleted.append(relative_path)
         return {"new": new, "changed": changed, "deleted": deleted}
 
-    def thaw(self, tagname, force=False):
+    def diff(self, tag_a, tag_b, deep=False):
+        """
+        Calculate the files that are "new", "changed" or "deleted" in
+        tag_b compared to tag_a. Only the manifest is read (directories
+        that are the same in both tags are skipped), nothing is thawed.
+
+        Parameters
+        ----------
+        tag_a : str
+            The tag to compare against, e.g. the previous release
+        tag_b : str
+            The tag to compare
+        deep : bool, default=False
+            If True, the sqlite and parquet files that differ are
+            opened read-only (straight from the frozen blobs) to
+            report the tables that differ, under the "tables" key:
+            path -> table -> {"change": new/changed/deleted,
+            "rows": [rows in tag_a, rows in tag_b]}
+
+        Returns
+        -------
+        dictionary with keys: new, changed, deleted (and tables
+        if deep) and values containing the list of files in each category
+        """
+        for tagname in (tag_a, tag_b):
+            tagname = FreezableAPI.validate_tagname(tagname)
+            if tagname == "thawed" or tagname not in self.tags:
+                raise TagDoesNotExistError(f"{tagname} is not in frozen datasets")
+        delta = self.manifest.diff(tag_a, tag_b)
+        if not deep:
+            return delta
+        delta["tables"] = {}
+        with self.open_tag(tag_a) as a, self.open_tag(tag_b) as b:
+            for change in ("new", "changed", "deleted"):
+                for rel_path in delta[change]:
+                    kind = table_kind(rel_path)
+                    if kind is None:
+                        continue
+                    name = Path(rel_path).stem
+                    tables = [
+                        describe_tables(kind, view.path(rel_path), name)
+                        if rel_path in view.files
+                        else {}
+                        for view in (a, b)
+                    ]
+                    changed = diff_tables(*tables)
+                    if changed:
+                        delta["tables"][rel_path] = changed
+        return delta
+
+    def thaw(self, tagname, force=False, lazy=False):
+        """
+        Thaw a frozen tag into the working (aka "thawed") dataset. Only
+        the files whose checksums differ between the thawed dataset and
+        the tag are removed, added or replaced.
+
+        Parameters
+        ----------
+        tagname : str
+            The tag to thaw
+        force : bool, default=False
+            If True, unsaved changes in the thawed dataset are discarded
+        lazy : bool, default=False
+            If True, only the directories of the tag are created. Files
+            are written when they are first accessed through the db,
+            col and doc accessors or `path`, or prefetched with
+            `materialize`. Files that are not written yet still count
+            as part of the thawed dataset (see `lazy_report`).
+        """
         # Validate tag name
         tagname = FreezableAPI.validate_tagname(tagname)
         # Check that tag exists
-        tag_data = self.manifest.get(where("tag") == tagname)
+        tag_data = self.manifest.get(tagname)
         if tag_data is None:
             raise TagDoesNotExistError(f"{tagname} is not in frozen datasets")
         # Check to see that current thawed dataset doesnt have unsaved work
-        current_checksum = self.checksum["total"]
+        current_checksum = self.checksum
         parent = self.parent_tag
         # If we are not forcing a thaw and the thawed checksum is not
         # the same as the last frozen tag (parent tag), we have
-        # unsaved changes.
-        if not force and current_checksum != parent["total"]:
+        # unsaved changes. The files are compared as the totals of
+        # older tags depend on the order their files were found in.
+        if not force and self._differences(current_checksum["files"], parent["files"]):
             # populate a list of files that changed
-            delta = self.file_changes()
+            delta = self.file_changes(checksum=current_checksum)
             raise UnsavedChangesInThawedError(
                 'freeze your current changes or use "force" to dispose '
                 "of any unsaved changes in current thawed dataset",
@@ -317,25 +807,547 @@ class FreezableAPI(object):
             )
 
         # Thaw it out
-        # Remove the current files in the thawed directory
-        for root, dirs, files in os.walk(self.thawed_dir):
-            for f in files:
-                os.unlink(os.path.join(root, f))
-            for d in dirs:
-                shutil.rmtree(os.path.join(root, d))
-
-        for rel_path, file_dict in tag_data["files"].items():
-            phash = file_dict["checksum"]
-            (self.thawed_dir / rel_path).parent.mkdir(parents=True, exist_ok=True)
-            shutil.copyfile(
-                self.frozen_dir / phash,
-                self.thawed_dir / rel_path,
+        # Close any handles on the current files
+        self._close()
+        current_files = current_checksum["files"]
+        target_files = tag_data["files"]
+
+        def unchanged(rel_path):
+            return (
+                rel_path in current_files
+                and rel_path in target_files
+                and current_files[rel_path]["checksum"]
+                == target_files[rel_path]["checksum"]
             )
 
+        pending = self.pending
+        # Remove the files that differ from the tag
+        removed = 0
+        for rel_path in current_files:
+            if not unchanged(rel_path):
+                try:
+                    os.unlink(self.thawed_dir / rel_path)
+                except FileNotFoundError:
+                    # A pending file was never written
+                    if rel_path not in pending:
+                        raise
+                removed += 1
+        if not unchanged("db.sqlite"):
+            # Left over journals would be replayed onto the new db
+            for journal in self._db_journals:
+                try:
+                    os.unlink(self.thawed_dir / journal)
+                except FileNotFoundError:
+                    pass
+        # Remove directories that are now empty
+        for root, dirs, files in os.walk(self.thawed_dir, topdown=False):
+            if root != str(self.thawed_dir) and not os.listdir(root):
+                os.rmdir(root)
+
+        # Files that still need to be written: the ones that differ
+        # and the pending files of a previous lazy thaw
+        to_write = {
+            rel_path: file_dict
+            for rel_path, file_dict in target_files.items()
+            if not unchanged(rel_path)
+            or (rel_path in pending and not (self.thawed_dir / rel_path).exists())
+        }
+        pending.reset(tagname, to_write)
+        pending.save()
+        cache = self.checksum_cache
+        if lazy:
+            # Only create the directory skeleton
+            for rel_path in to_write:
+                (self.thawed_dir / rel_path).parent.mkdir(parents=True, exist_ok=True)
+            written = 0
+        else:
+            written = len(self.materialize())
+            pending.reset()
+            pending.save()
+        cache.prune(target_files)
+        cache.save()
+        log.info(
+            f"Thawed {self.slug}:{tagname} ({removed} removed, {written} written, "
+            f"{len(to_write) - written} pending, "
+            f"{len(target_files) - len(to_write)} unchanged)"
+        )
         self._update_thawed_tag({"parent": tagname})
+        if self._watcher is not None:
+            # The thawed dir now matches the tag, the changes the
+            # watcher saw were made by the thaw itself
+            self._watcher.drain()
+            self._dirty.rebase(self._dirty.snapshot()[0], (), parent=tagname)
+
+    def materialize(self, paths=None):
+        """
+        Write pending files of a lazy thaw to the thawed directory.
+
+        Parameters
+        ----------
+        paths : list of str, default=None
+            Files or directories (relative to the thawed directory)
+            to write, None writes all the pending files. Paths that
+            are not pending are ignored.
+
+        Returns
+        -------
+        list
+            The files that were written
+        """
+        pending = self.pending
+        selected = pending.select(paths)
+        if not selected:
+            return []
+        cache = self.checksum_cache
+        link_mode = self.link_mode
+        written = []
+        with self.lock():
+            for rel_path in selected:
+                dest = self.thawed_dir / rel_path
+                if dest.exists():
+                    # The file was replaced before it was ever read
+                    pending.done(rel_path, written=False)
+                    continue
+                phash = pending.get(rel_path)["checksum"]
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                method = self.blobs.checkout(phash, dest, mode=link_mode)
+                if method != "hardlink":
+                    # Carry over the blob times, the contents are the same
+                    # and an old mtime lets the checksum cache trust it
+                    blob_stat = self.blobs.stat(phash)
+                    os.utime(dest, ns=(blob_stat.st_atime_ns, blob_stat.st_mtime_ns))
+                # We already know the checksum of the file
+                cache.put(
+                    rel_path, os.stat(dest), phash, companions=self._companion_stats(rel_path)
+                )
+                pending.done(rel_path)
+                written.append(rel_path)
+        pending.save()
+        cache.save()
+        if written:
+            log.debug(f"Materialized {len(written)} files of {self.slug}")
+        return written
+
+    def path(self, relative_path):
+        """
+        The path of a file (or directory) in the thawed directory. A
+        pending file of a lazy thaw is written first, and files that
+        share their inode with a frozen blob (hardlink mode) are
+        replaced with private copies, so the path is safe to write to.
+        """
+        self.materialize([relative_path])
+        path = self.thawed_dir / relative_path
+        self._break_link(path)
+        return path
+
+    def lazy_report(self):
+        """
+        What a lazy thaw has written to the thawed directory so far
+
+        Returns
+        -------
+        dict
+            tag: the lazily thawed tag (None if the last thaw was not lazy)
+            materialized: the files written since the thaw
+            pending: the files that were not written yet
+            materialized_bytes, pending_bytes: their total sizes
+        """
+        pending = self.pending
+        return {
+            "tag": pending.tag,
+            "materialized": sorted(pending.materialized),
+            "pending": sorted(pending),
+            "materialized_bytes": sum(pending.materialized.values()),
+            "pending_bytes": sum(
+                pending.get(rel_path)["size"] for rel_path in pending
+            ),
+        }
+
+    def lock(self, exclusive=False):
+        """
+        Lock the blob store of the dataset: shared for operations that
+        add blobs (freeze, pull) and exclusive for ones that remove them (gc)
+        """
+        return self.blobs.lock(exclusive=exclusive)
+
+    def watch(self, polling=False, interval=1.0):
+        """
+        Track the files that change in the thawed directory, so that
+        `checksum`, `file_changes`, `freeze` and `thaw` only look at
+        the paths that changed since the parent tag instead of walking
+        the whole directory. Changes are tracked with inotify on Linux
+        and by polling the stat of the files elsewhere. The paths that
+        changed are persisted to DIRTY.json in the dataset directory.
+
+        A full scan is done when the watcher starts and whenever it
+        loses track of changes (e.g. an inotify queue overflow).
+
+        Parameters
+        ----------
+        polling : bool, default=False
+            If True, poll for changes even if inotify is available
+        interval : float, default=1.0
+            The seconds between polls, with polling changes can take
+            this long to be noticed
+
+        Returns
+        -------
+        The watcher, stop it with `unwatch`
+        """
+        if self._watcher is None:
+            self._dirty = DirtySet(self.basedir / "DIRTY.json")
+            self._watcher = start_watcher(
+                self.thawed_dir, self._dirty, polling=polling, interval=interval
+            )
+            # Find the changes made before the watcher started
+            self._checksum()
+        return self._watcher
+
+    def unwatch(self):
+        """
+        Stop tracking changes in the thawed directory
+        """
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._dirty.clear()
+            self._watcher = None
+            self._dirty = None
+
+    def open_tag(self, tagname):
+        """
+        Open a frozen tag read-only, without thawing it.
+
+        Parameters
+        ----------
+        tagname : str
+            The tag to open
+
+        Returns
+        -------
+        FrozenTag
+            A view of the tag with read-only db, col and doc
+            accessors. Use it as a context manager (or call close)
+            to release it.
+
+        Usage:
+        >>> with x.m80.open_tag("v1") as v1:
+                v1.db.query("SELECT * FROM samples")
+        """
+        tagname = FreezableAPI.validate_tagname(tagname)
+        tag_data = self.manifest.get(tagname)
+        if tag_data is None or tagname == "thawed":
+            raise TagDoesNotExistError(f"{tagname} is not in frozen datasets")
+        return FrozenTag(self, tag_data)
+
+    def delete_tag(self, tagname):
+        """
+        Delete a frozen tag. Tags that were frozen on top of it are
+        re-parented onto its parent. The blobs of the tag are not
+        removed until the next `gc()`.
+
+        Parameters
+        ----------
+        tagname : str
+            The tag to delete
+        """
+        tagname = FreezableAPI.validate_tagname(tagname)
+        if tagname not in self.tags:
+            raise TagDoesNotExistError(f"{tagname} is not in frozen datasets")
+        if self.thawed_tag.get("parent") == tagname:
+            raise TagInUseError(
+                f"{tagname} is the parent of the thawed dataset, "
+                "thaw or freeze another tag before deleting it"
+            )
+        self.manifest.remove(tagname)
+        self._update_blob_refs()
+        log.info(f"Deleted tag {self.slug}:{tagname}")
+
+    def gc(self, dry_run=False, grace=3600):
+        """
+        Reclaim the space used by frozen blobs that are no longer
+        referenced by any tag (mark and sweep).
+
+        Freezes hold a shared lock on the dataset while they write
+        blobs, gc waits for an exclusive one. Blobs and temporary
+        files younger than grace are kept as well, for processes
+        that cannot take the lock (e.g. on network filesystems).
+
+        Parameters
+        ----------
+        dry_run : bool, default=False
+            If True, only report what would be removed
+        grace : int, default=3600
+            Blobs changed within this many seconds are not removed
+
+        Returns
+        -------
+        dict
+            blobs: the number of unreferenced blobs removed
+            bytes: the number of bytes reclaimed
+            incoming: the number of stale temporary files removed
+            kept: the number of referenced blobs
+        """
+        with self.lock(exclusive=True):
+            # Mark
+            reachable = self.blobs.closure(self._reachable_blobs())
+            # Sweep
+            report = self.blobs.sweep(reachable, time.time() - grace, dry_run=dry_run)
+        log.info(
+            f"{'Found' if dry_run else 'Removed'} {report['blobs']} unreferenced blobs "
+            f"and {report['incoming']} stale temporary files in {self.slug}"
+        )
+        return report
+
+    def verify(self, tags=None, workers=None, incremental=True):
+        """
+        Check that the frozen files of tags are intact: every blob
+        is re-hashed (in parallel) and compared with its checksum.
+
+        Parameters
+        ----------
+        tags : list of str, default=None
+            The tags to verify, defaults to all the frozen tags
+        workers : int, default=None
+            The number of blobs verified concurrently, defaults
+            to the hash_workers of the dataset
+        incremental : bool, default=True
+            Skip the blobs that were found intact by a previous
+            verify, unless their files changed since
+
+        Returns
+        -------
+        dict
+            tags: tag -> {"missing": [paths], "corrupt": [paths]}
+            blobs: the number of blobs checked
+            verified: the number of blobs that were re-hashed
+            skipped: the number of blobs skipped (see incremental)
+        """
+        if tags is None:
+            tags = sorted(self.tags - {"thawed"})
+        tag_files = {}
+        for tagname in tags:
+            tag_data = self.manifest.get(FreezableAPI.validate_tagname(tagname))
+            if tag_data is None or tagname == "thawed":
+                raise TagDoesNotExistError(f"{tagname} is not in frozen datasets")
+            tag_files[tagname] = tag_data["files"]
+        checksums = {
+            file_dict["checksum"]
+            for files in tag_files.values()
+            for file_dict in files.values()
+        }
+        verify_log = None
+        if incremental:
+            verify_log = VerifyLog(self.blobs.root / ".verified.json")
+        # Keep gc() from removing blobs while they are checked
+        with self.lock():
+            status = verify_blobs(
+                self.blobs,
+                checksums,
+                workers=workers or self.hash_workers,
+                verify_log=verify_log,
+            )
+        report = {"tags": {}, "blobs": len(status), "verified": 0, "skipped": 0}
+        for result in status.values():
+            if result == "skipped":
+                report["skipped"] += 1
+            elif result != "missing":
+                report["verified"] += 1
+        for tagname, files in tag_files.items():
+            problems = report["tags"][tagname] = {"missing": [], "corrupt": []}
+            for rel_path, file_dict in files.items():
+                result = status[file_dict["checksum"]]
+                if result in problems:
+                    problems[result].append(rel_path)
+            if problems["missing"] or problems["corrupt"]:
+                log.warning(
+                    f"{self.slug}:{tagname} has {len(problems['missing'])} missing "
+                    f"and {len(problems['corrupt'])} corrupt files"
+                )
+        return report
+
+    def migrate_layout(self, layout="sharded"):
+        """
+        Move the frozen files of the dataset (or of the shared store)
+        to a new directory layout, see `BlobStore.migrate`.
+
+        Parameters
+        ----------
+        layout : str, default="sharded"
+            One of: flat, sharded
+
+        Returns
+        -------
+        int
+            The number of files moved
+        """
+        with self.lock(exclusive=True):
+            if self.blobs.layout == layout:
+                return 0
+            return self.blobs.migrate(layout)
 
     # Class internal methods---------------------------------------------
 
+    def _watched_changes(self, hasher=None):
+        """
+        The files that are new, changed or deleted compared to the
+        parent tag, found by only looking at the paths the watcher
+        saw change. Returns None if the dataset is not watched or
+        the watcher cannot tell (then the whole directory is scanned).
+        """
+        delta = self._watched_delta(hasher)
+        return None if delta is None else delta[0]
+
+    def _watched_delta(self, hasher=None):
+        """
+        The changes (see `_watched_changes`) and the
+        {"checksum", "size"} of the new and changed files
+        """
+        if self._watcher is None:
+            return None
+        self._watcher.drain()
+        seq, paths, complete = self._dirty.snapshot()
+        if not complete or self.thawed_tag["parent"] is None:
+            return None
+        parent = self.parent_tag
+        if parent["tag"] != self._dirty.parent:
+            return None
+        if hasher is None:
+            hasher = self._hasher()
+        parent_files = parent["files"]
+        # The files a changed path could affect
+        candidates = set()
+        for rel_path in paths:
+            if rel_path in self._db_journals:
+                # Transactions committed to a journal change the db
+                rel_path = "db.sqlite"
+            full_path = self.thawed_dir / rel_path
+            if full_path.is_dir():
+                for root, dirs, files in os.walk(full_path):
+                    candidates.update(
+                        os.path.relpath(os.path.join(root, name), self.thawed_dir)
+                        for name in files
+                    )
+            else:
+                candidates.add(rel_path)
+            if rel_path not in parent_files and not full_path.is_file():
+                # A directory that was moved or removed
+                prefix = rel_path + "/"
+                candidates.update(f for f in parent_files if f.startswith(prefix))
+        new = []
+        changed = []
+        deleted = []
+        files = {}
+        cache = self.checksum_cache
+        pending = self.pending
+        hashed = cached = 0
+        for rel_path in sorted(candidates):
+            if rel_path in self._db_journals:
+                continue
+            companions = self._companion_stats(rel_path)
+            full_path = self.thawed_dir / rel_path
+            try:
+                st = os.stat(full_path)
+            except FileNotFoundError:
+                entry = pending.get(rel_path)
+                if entry is None:
+                    if rel_path in parent_files:
+                        deleted.append(rel_path)
+                    continue
+                phash, size = entry["checksum"], entry["size"]
+            else:
+                if stat.S_ISDIR(st.st_mode):
+                    continue
+                size = st.st_size
+                phash = cache.get(rel_path, st, companions)
+                if phash is None:
+                    phash = hasher(str(full_path))
+                    cache.put(rel_path, st, phash, companions=companions)
+                    hashed += 1
+                else:
+                    cached += 1
+            if rel_path not in parent_files:
+                new.append(rel_path)
+            elif parent_files[rel_path]["checksum"] != phash:
+                changed.append(rel_path)
+            else:
+                continue
+            files[rel_path] = {"checksum": phash, "size": size}
+        cache.save()
+        self.checksum_stats = {"hashed": hashed, "cached": cached}
+        self._scan_seq = seq
+        return {"new": new, "changed": changed, "deleted": deleted}, files
+
+    def _companion_stats(self, rel_path):
+        """
+        The stats of the files that are part of the contents of a
+        thawed file, see `ChecksumCache.get`
+        """
+        if rel_path != "db.sqlite":
+            return ()
+        return companion_stats(self.thawed_dir, self._db_companions)
+
+    def _update_blob_refs(self):
+        """
+        Record the blobs used by the tags of the dataset in the shared store
+        """
+        if isinstance(self.blobs, SharedBlobStore):
+            self.blobs.set_refs(self.slug, self.manifest.checksums())
+
+    def _reachable_blobs(self):
+        """
+        The checksums of the blobs used by a tag. For a shared store,
+        the references of every dataset using it are refreshed from
+        their manifests first.
+        """
+        if not isinstance(self.blobs, SharedBlobStore):
+            return self.manifest.checksums()
+        for slug, basedir in self.blobs.datasets().items():
+            if slug == self.slug:
+                self._update_blob_refs()
+            elif not (basedir / "MANIFEST.sqlite").exists():
+                log.info(f"Releasing the frozen files of deleted dataset {slug}")
+                self.blobs.forget(slug)
+            else:
+                manifest = Manifest(basedir)
+                self.blobs.set_refs(slug, manifest.checksums())
+                manifest.close()
+        return self.blobs.referenced()
+
+
+    def _close(self):
+        """
+        Close the open database handles, they are reopened on next access
+        """
+        if self._db is not None:
+            self._db.db.close()
+        if self._doc is not None:
+            self._doc.close()
+        self._db = None
+        self._doc = None
+        self._col = None
+
+    @staticmethod
+    def _break_link(path):
+        """
+        If path shares its inode with a frozen blob (hardlink mode),
+        replace it with a private copy so it can be safely written to.
+        The files in a directory are copied as needed.
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+        if stat.S_ISDIR(st.st_mode):
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    FreezableAPI._break_link(Path(root) / name)
+            return
+        if st.st_nlink > 1:
+            log.debug(f"Copying linked file before writing: {path}")
+            tmp = path.with_name(f".{path.name}.unlinked")
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, path)
+
     def _update_thawed_tag(self, doc=None):
         """
         Updates the tag for "thawed" in the manifest
@@ -348,7 +1360,7 @@ class FreezableAPI(object):
         if doc is not None:
             tag.update(doc)
         # Upsert the database
-        self.manifest.upsert(tag, where("tag") == "thawed")
+        self.manifest.upsert(tag)
 
     # Class static methods---------------------------------------------
 
@@ -0,0 +1,127 @@
+"""Read-only views of frozen tags."""
+
+import os
+import shutil
+import logging
+import tempfile
+
+from pathlib import Path
+from contextlib import ExitStack
+
+from .RelationalDB import relational_db
+from .ColumnDB import frozen_parquet_db
+
+__all__ = ["FrozenTag"]
+
+log = logging.getLogger("minus80")
+
+
+class FrozenTag(object):
+    """
+    A read-only view of a frozen tag (see `FreezableAPI.open_tag`).
+
+    Files are read straight from the frozen blobs, so opening a tag
+    copies nothing and leaves the thawed dataset alone. Only blobs that
+    are not stored as plain files (compressed, chunked or packed) are
+    written to a temporary directory, which is removed on `close`.
+
+    The view holds a shared lock on the blob store until it is closed,
+    so gc() cannot remove the blobs it is reading (close views before
+    running gc() from the same process).
+    """
+
+    def __init__(self, api, tag):
+        self.api = api
+        self.tag = tag
+        self.files = tag["files"]
+        self._tmpdir = None
+        self._db = None
+        self._col = None
+        self._doc = None
+        self._stack = ExitStack()
+        self._stack.enter_context(api.lock())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return f"FrozenTag({self.api.slug}:{self.tag['tag']})"
+
+    def path(self, relative_path):
+        """
+        The path of a file of the tag, it must not be modified
+        """
+        try:
+            checksum = self.files[relative_path]["checksum"]
+        except KeyError:
+            raise FileNotFoundError(
+                f"{relative_path} is not in {self.api.slug}:{self.tag['tag']}"
+            ) from None
+        return self._blob_path(checksum)
+
+    def open(self, relative_path, mode="rb"):
+        """
+        Open a file of the tag for reading
+        """
+        if mode not in ("r", "rb"):
+            raise ValueError("Files of frozen tags can only be opened for reading")
+        return open(self.path(relative_path), mode)
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = relational_db.open_readonly(self.path("db.sqlite"))
+        return self._db
+
+    @property
+    def col(self):
+        if self._col is None:
+            tables = {
+                path[len("pq/") : -len(".pq")]: data["checksum"]
+                for path, data in self.files.items()
+                if path.startswith("pq/") and path.endswith(".pq")
+            }
+            self._col = frozen_parquet_db(tables, self._blob_path)
+        return self._col
+
+    @property
+    def doc(self):
+        if self._doc is None:
+            from tinydb import TinyDB
+
+            self._doc = TinyDB(self.path("documentDB.json"), access_mode="r")
+        return self._doc
+
+    def close(self):
+        """
+        Close the databases and release the lock on the blob store
+        """
+        if self._db is not None:
+            self._db.db.close()
+            self._db = None
+        if self._doc is not None:
+            self._doc.close()
+            self._doc = None
+        self._col = None
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+        self._stack.close()
+
+    def _blob_path(self, checksum):
+        blobs = self.api.blobs
+        path = blobs.path(checksum)
+        if path.exists():
+            return path
+        # Compressed, chunked or packed blobs are checked out once
+        if self._tmpdir is None:
+            self._tmpdir = Path(tempfile.mkdtemp(prefix="m80-tag-"))
+        dest = self._tmpdir / checksum
+        if not dest.exists():
+            log.debug(f"Checking out {checksum} to read {self}")
+            blobs.checkout(checksum, dest)
+            os.chmod(dest, 0o444)
+        return dest
@@ -0,0 +1,126 @@
+"""Book keeping for lazily thawed datasets."""
+
+import os
+import json
+import logging
+
+from pathlib import Path
+
+from .Tools import write_json
+
+__all__ = ["PendingFiles"]
+
+log = logging.getLogger("minus80")
+
+
+class PendingFiles(object):
+    """
+    The files of a lazy thaw that have not been written to the thawed
+    directory yet, along with the ones that were materialized since.
+
+    Pending files are part of the thawed dataset: they are listed by
+    checksums (with the checksum and size recorded in the tag) and
+    are written from the frozen blobs when they are first accessed.
+    """
+
+    VERSION = 1
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        self.tag = None
+        # relative path -> {"checksum": str, "size": int}
+        self.entries = {}
+        # relative path -> size, of the files written since the thaw
+        self.materialized = {}
+        self._load()
+
+    def __contains__(self, rel_path):
+        return rel_path in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def get(self, rel_path):
+        return self.entries.get(rel_path)
+
+    def reset(self, tag=None, entries=None):
+        """
+        Start tracking the pending files of a new thaw
+        """
+        self.tag = tag
+        self.entries = dict(entries or {})
+        self.materialized = {}
+
+    def done(self, rel_path, written=True):
+        """
+        Stop tracking a file: it was materialized or, if written
+        is False, replaced by a new file
+        """
+        entry = self.entries.pop(rel_path)
+        if written:
+            self.materialized[rel_path] = entry["size"]
+
+    def by_directory(self):
+        """
+        The names of the pending files in each directory,
+        keyed by the directory path relative to the thawed dir
+        """
+        dirs = {}
+        for rel_path in self.entries:
+            dirname, name = os.path.split(rel_path)
+            dirs.setdefault(dirname, set()).add(name)
+        return dirs
+
+    def select(self, paths=None):
+        """
+        The pending files matching paths: files or directories
+        relative to the thawed dir (None selects everything)
+        """
+        if paths is None:
+            return list(self.entries)
+        if isinstance(paths, (str, os.PathLike)):
+            paths = [paths]
+        prefixes = [os.path.normpath(str(path)) for path in paths]
+        return [
+            rel_path
+            for rel_path in self.entries
+            if any(
+                prefix in (".", rel_path) or rel_path.startswith(prefix + "/")
+                for prefix in prefixes
+            )
+        ]
+
+    def save(self):
+        """
+        Atomically write the pending files to disk, the
+        file is removed when nothing was thawed lazily
+        """
+        if self.tag is None:
+            try:
+                os.unlink(self.filename)
+            except FileNotFoundError:
+                pass
+            return
+        write_json(
+            self.filename,
+            {
+                "version": self.VERSION,
+                "tag": self.tag,
+                "entries": self.entries,
+                "materialized": self.materialized,
+            },
+        )
+
+    def _load(self):
+        try:
+            with open(self.filename, "r") as IN:
+                data = json.load(IN)
+            if data["version"] == self.VERSION:
+                self.tag = data["tag"]
+                self.entries = data["entries"]
+                self.materialized = data["materialized"]
+        except FileNotFoundError:
+            pass
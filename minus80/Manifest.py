@@ -0,0 +1,471 @@
+"""The manifest of tags for a Freezable dataset."""
+
+import os
+import json
+import hashlib
+import logging
+
+from .RelationalDB import apsw
+from .Exceptions import TagExistsError, TagDoesNotExistError
+
+__all__ = ["Manifest"]
+
+log = logging.getLogger("minus80")
+
+
+class Manifest(object):
+    """
+    The Manifest keeps track of the frozen tags of a dataset, the files
+    (and their checksums) in each tag, and the special "thawed" tag which
+    records the parent of the working dataset.
+
+    Tags are stored in an indexed sqlite database (MANIFEST.sqlite) so
+    looking up or adding a tag never reads or rewrites the whole history.
+    Datasets with a (legacy) TinyDB MANIFEST.json are migrated the first
+    time they are opened.
+
+    Like git, the files of a tag are stored as content addressed trees:
+    each directory is a tree whose id is the checksum of its entries
+    (files and sub-trees). A new tag only adds rows for the directories
+    that changed, and identical sub-trees are skipped when diffing tags.
+    """
+
+    # The version of the sqlite schema (PRAGMA user_version)
+    #   1: per tag file lists (tag_files)
+    #   2: content addressed trees
+    SCHEMA_VERSION = 2
+
+    # Tag fields that have their own column, everything else is
+    # kept as JSON in the extra column
+    _columns = ("tag", "parent", "timestamp", "total", "slug")
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.filename = basedir / "MANIFEST.sqlite"
+        self.db = apsw.Connection(str(self.filename))
+        # Wait on other processes (e.g. concurrent freezes)
+        self.db.setbusytimeout(30000)
+        self._initialize_tables()
+        self._migrate_json(basedir / "MANIFEST.json")
+
+    def get(self, tag, files=True):
+        """
+        Fetch the document for a tag.
+
+        Parameters
+        ----------
+        tag : str
+            The name of the tag
+        files : bool, default=True
+            If False, the (potentially large) "files" entry is not loaded
+
+        Returns
+        -------
+        dict or None
+            The tag document or None if the tag does not exist
+        """
+        row = (
+            self.db.cursor()
+            .execute(
+                "SELECT tag, parent, timestamp, total, slug, extra "
+                "FROM tags WHERE tag = ?",
+                (tag,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        doc = self._to_doc(row)
+        if files and doc["tag"] != "thawed":
+            doc["files"] = self._files(tag)
+        return doc
+
+    def __contains__(self, tag):
+        return (
+            self.db.cursor()
+            .execute("SELECT 1 FROM tags WHERE tag = ?", (tag,))
+            .fetchone()
+            is not None
+        )
+
+    def tags(self):
+        """
+        The names of the frozen tags (the "thawed" tag is excluded)
+        """
+        return [
+            x
+            for (x,) in self.db.cursor().execute(
+                "SELECT tag FROM tags WHERE tag != 'thawed' ORDER BY timestamp"
+            )
+        ]
+
+    def all(self, files=True):
+        """
+        Return the documents of every tag (including "thawed").
+
+        Parameters
+        ----------
+        files : bool, default=True
+            If False, the "files" entries are not loaded
+        """
+        rows = self.db.cursor().execute(
+            "SELECT tag, parent, timestamp, total, slug, extra "
+            "FROM tags ORDER BY timestamp"
+        ).fetchall()
+        docs = [self._to_doc(row) for row in rows]
+        if files:
+            for doc in docs:
+                if doc["tag"] != "thawed":
+                    doc["files"] = self._files(doc["tag"])
+        return docs
+
+    def insert(self, doc):
+        """
+        Add a new tag document, raises a TagExistsError if
+        the tag already exists.
+        """
+        with self.db:
+            if doc["tag"] in self:
+                raise TagExistsError(f"Tag already exists: {doc['tag']}")
+            self._write(doc)
+
+    def upsert(self, doc):
+        """
+        Add a tag document, replacing it if it already exists
+        """
+        with self.db:
+            self._write(doc)
+
+    def remove(self, tag):
+        """
+        Remove a tag from the manifest. Tags that were frozen on top
+        of the removed tag are re-parented onto its parent and trees
+        that are no longer used by any tag are dropped.
+        """
+        with self.db:
+            cur = self.db.cursor()
+            row = cur.execute("SELECT parent FROM tags WHERE tag = ?", (tag,)).fetchone()
+            if row is None:
+                raise TagDoesNotExistError(f"{tag} is not in the manifest")
+            cur.execute("UPDATE tags SET parent = ? WHERE parent = ?", (row[0], tag))
+            cur.execute("DELETE FROM tags WHERE tag = ?", (tag,))
+            self.prune_trees()
+
+    def prune_trees(self):
+        """
+        Delete the trees that are not reachable from any tag
+
+        Returns
+        -------
+        int
+            The number of trees removed
+        """
+        cur = self.db.cursor()
+        unreachable = [
+            x
+            for (x,) in cur.execute(
+                """
+                WITH RECURSIVE reachable(tree) AS (
+                    SELECT tree FROM tags WHERE tree IS NOT NULL
+                    UNION
+                    SELECT trees.checksum
+                    FROM trees JOIN reachable ON trees.tree = reachable.tree
+                    WHERE trees.kind = 'tree'
+                )
+                SELECT DISTINCT tree FROM trees
+                WHERE tree NOT IN (SELECT tree FROM reachable)
+                """
+            ).fetchall()
+        ]
+        cur.executemany("DELETE FROM trees WHERE tree = ?", ((x,) for x in unreachable))
+        return len(unreachable)
+
+    def checksums(self):
+        """
+        The set of blob checksums referenced by any tag (the "mark"
+        phase of garbage collection)
+        """
+        return {
+            x
+            for (x,) in self.db.cursor().execute(
+                """
+                WITH RECURSIVE reachable(tree) AS (
+                    SELECT tree FROM tags WHERE tree IS NOT NULL
+                    UNION
+                    SELECT trees.checksum
+                    FROM trees JOIN reachable ON trees.tree = reachable.tree
+                    WHERE trees.kind = 'tree'
+                )
+                SELECT DISTINCT trees.checksum
+                FROM trees JOIN reachable ON trees.tree = reachable.tree
+                WHERE trees.kind = 'blob'
+                """
+            )
+        }
+
+    def close(self):
+        self.db.close()
+
+    # Internal Methods -----------------------------------------------
+
+    def _to_doc(self, row):
+        doc = json.loads(row[-1]) if row[-1] else {}
+        doc.update(
+            {k: v for k, v in zip(self._columns, row[:-1]) if v is not None}
+        )
+        doc.setdefault("parent", None)
+        return doc
+
+    def _files(self, tag):
+        return self.tree_files(self.tree(tag))
+
+    def tree(self, tag):
+        """
+        The id of the root tree of a tag
+        """
+        row = (
+            self.db.cursor()
+            .execute("SELECT tree FROM tags WHERE tag = ?", (tag,))
+            .fetchone()
+        )
+        if row is None:
+            raise TagDoesNotExistError(f"{tag} is not in the manifest")
+        return row[0]
+
+    def diff(self, tag_a, tag_b):
+        """
+        The paths that are new, changed or deleted in tag_b compared
+        to tag_a (see `diff_trees`)
+        """
+        return self.diff_trees(self.tree(tag_a), self.tree(tag_b))
+
+    def tree_files(self, tree):
+        """
+        Expand a tree (recursively) into a dict of
+        path -> {"checksum": str, "size": int}
+        """
+        if tree is None:
+            return {}
+        return {
+            path: {"checksum": checksum, "size": size}
+            for path, checksum, size in self.db.cursor().execute(
+                """
+                WITH RECURSIVE walk(tree, prefix) AS (
+                    SELECT ?, ''
+                    UNION ALL
+                    SELECT trees.checksum, walk.prefix || trees.name || '/'
+                    FROM trees JOIN walk ON trees.tree = walk.tree
+                    WHERE trees.kind = 'tree'
+                )
+                SELECT walk.prefix || trees.name, trees.checksum, trees.size
+                FROM walk JOIN trees ON trees.tree = walk.tree
+                WHERE trees.kind = 'blob'
+                ORDER BY 1
+                """,
+                (tree,),
+            )
+        }
+
+    def tree_entries(self, tree):
+        """
+        The entries of a single tree: name -> (kind, checksum, size)
+        """
+        return {
+            name: (kind, checksum, size)
+            for name, kind, checksum, size in self.db.cursor().execute(
+                "SELECT name, kind, checksum, size FROM trees WHERE tree = ?",
+                (tree,),
+            )
+        }
+
+    def diff_trees(self, tree_a, tree_b, prefix=""):
+        """
+        Compare two trees, skipping sub-trees that are identical.
+
+        Returns
+        -------
+        dict with keys: new, changed, deleted containing the
+        paths that are new/changed in tree_b or deleted from tree_a
+        """
+        delta = {"new": [], "changed": [], "deleted": []}
+        if tree_a == tree_b:
+            return delta
+        a = self.tree_entries(tree_a) if tree_a else {}
+        b = self.tree_entries(tree_b) if tree_b else {}
+        for name in sorted(set(a) | set(b)):
+            path = prefix + name
+            kind_a, sum_a, _ = a.get(name, (None, None, None))
+            kind_b, sum_b, _ = b.get(name, (None, None, None))
+            if sum_a == sum_b and kind_a == kind_b:
+                continue
+            if kind_a == "tree" or kind_b == "tree":
+                sub = self.diff_trees(
+                    sum_a if kind_a == "tree" else None,
+                    sum_b if kind_b == "tree" else None,
+                    prefix=path + "/",
+                )
+                for k in delta:
+                    delta[k].extend(sub[k])
+            if kind_a == "blob" and kind_b == "blob":
+                delta["changed"].append(path)
+            elif kind_a == "blob":
+                delta["deleted"].append(path)
+            elif kind_b == "blob":
+                delta["new"].append(path)
+        return delta
+
+    def _write_tree(self, files):
+        """
+        Store the trees for a dict of files, only directories
+        that are not already stored are written.
+
+        Returns
+        -------
+        str
+            The id of the root tree
+        """
+        # Nest the files by directory
+        root = {}
+        for path, data in files.items():
+            node = root
+            *dirs, name = path.split("/")
+            for d in dirs:
+                node = node.setdefault(d, {})
+            node[name] = (data["checksum"], data["size"])
+
+        cur = self.db.cursor()
+
+        def write(node):
+            entries = []
+            for name, child in sorted(node.items()):
+                if isinstance(child, tuple):
+                    entries.append((name, "blob", *child))
+                else:
+                    subtree, size = write(child)
+                    entries.append((name, "tree", subtree, size))
+            tree = hashlib.sha256(
+                "".join(f"{k} {n} {c} {s}\n" for n, k, c, s in entries).encode("utf-8")
+            ).hexdigest()
+            exists = cur.execute(
+                "SELECT 1 FROM trees WHERE tree = ? LIMIT 1", (tree,)
+            ).fetchall()
+            if not exists:
+                cur.executemany(
+                    "INSERT OR IGNORE INTO trees (tree, name, kind, checksum, size) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    ((tree, *entry) for entry in entries),
+                )
+            return tree, sum(x[3] for x in entries)
+
+        return write(root)[0]
+
+    def _write(self, doc):
+        """
+        Write a tag document (callers handle the transaction)
+        """
+        extra = {
+            k: v for k, v in doc.items() if k not in self._columns and k != "files"
+        }
+        cur = self.db.cursor()
+        cur.execute(
+            "INSERT OR REPLACE INTO tags (tag, parent, timestamp, total, slug, extra) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                doc["tag"],
+                doc.get("parent"),
+                doc.get("timestamp"),
+                doc.get("total"),
+                doc.get("slug"),
+                json.dumps(extra) if extra else None,
+            ),
+        )
+        if "files" in doc:
+            cur.execute(
+                "UPDATE tags SET tree = ? WHERE tag = ?",
+                (self._write_tree(doc["files"]), doc["tag"]),
+            )
+
+    def _initialize_tables(self):
+        cur = self.db.cursor()
+        cur.execute("PRAGMA journal_mode = WAL").fetchall()
+        with self.db:
+            (version,) = cur.execute("PRAGMA user_version").fetchone()
+            if version < 1:
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS tags (
+                        tag TEXT PRIMARY KEY,
+                        parent TEXT,
+                        timestamp REAL,
+                        total TEXT,
+                        slug TEXT,
+                        -- Any other fields of the tag document as JSON
+                        extra TEXT
+                    );
+                """
+                )
+                cur.execute("CREATE INDEX IF NOT EXISTS tags_parent ON tags (parent);")
+            if version < 2:
+                cur.execute("ALTER TABLE tags ADD COLUMN tree TEXT;")
+                cur.execute(
+                    """
+                    CREATE TABLE trees (
+                        -- The checksum of the entries in the tree
+                        tree TEXT NOT NULL,
+                        name TEXT NOT NULL,
+                        -- Either a 'blob' (file) or a (sub) 'tree'
+                        kind TEXT NOT NULL,
+                        -- The blob checksum or the sub-tree id
+                        checksum TEXT NOT NULL,
+                        -- The file size or total size of the sub-tree
+                        size INTEGER NOT NULL,
+                        PRIMARY KEY (tree, name)
+                    ) WITHOUT ROWID;
+                """
+                )
+                self._migrate_tag_files()
+            cur.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    def _migrate_tag_files(self):
+        """
+        Convert the per tag file lists of schema version 1 into trees
+        """
+        cur = self.db.cursor()
+        has_tag_files = cur.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tag_files'"
+        ).fetchall()
+        if not has_tag_files:
+            return
+        for (tag,) in cur.execute("SELECT DISTINCT tag FROM tag_files").fetchall():
+            files = {
+                path: {"checksum": checksum, "size": size}
+                for path, checksum, size in self.db.cursor().execute(
+                    "SELECT path, checksum, size FROM tag_files WHERE tag = ?",
+                    (tag,),
+                )
+            }
+            self.db.cursor().execute(
+                "UPDATE tags SET tree = ? WHERE tag = ?",
+                (self._write_tree(files), tag),
+            )
+        cur.execute("DROP TABLE tag_files")
+
+    def _migrate_json(self, json_file):
+        """
+        Import the tags of a TinyDB MANIFEST.json, the JSON file is
+        renamed to MANIFEST.json.migrated afterwards.
+        """
+        if not json_file.exists():
+            return
+        log.info(f"Migrating {json_file} to {self.filename.name}")
+        with open(json_file, "r") as IN:
+            try:
+                tables = json.load(IN)
+            except ValueError:
+                # An empty TinyDB file
+                tables = {}
+        with self.db:
+            for doc in tables.get("_default", {}).values():
+                if "tag" in doc and doc["tag"] not in self:
+                    self._write(doc)
+        os.replace(json_file, json_file.with_name("MANIFEST.json.migrated"))
@@ -0,0 +1,225 @@
+"""Typed Accession metadata and the conditions used to search it."""
+
+import re
+import sys
+import math
+import numbers
+import datetime
+
+__all__ = ["TYPES", "infer_type", "encode", "decode", "Meta", "Condition"]
+
+# The types of metadata values, which are stored in sqlite as:
+#   integer, real: numbers
+#   text: strings
+#   bool: 0 or 1
+#   date: ISO 8601 strings, which sort chronologically
+TYPES = ("integer", "real", "text", "bool", "date")
+
+# The types whose values can be compared with each other
+_COMPARABLE = {
+    "integer": ("integer", "real"),
+    "real": ("integer", "real"),
+    "text": ("text",),
+    "bool": ("bool",),
+    "date": ("date",),
+}
+
+# Integers with leading zeros (e.g. barcodes) are kept as text
+_INTEGER = re.compile(r"-?(0|[1-9][0-9]*)")
+_REAL = re.compile(r"[-+]?(([0-9]+\.[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?|[0-9]+[eE][-+]?[0-9]+)")
+_DATE = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+
+
+def infer_type(value):
+    """
+    The type of a metadata value. Strings are parsed when they are
+    the exact text of a number or date, so "30" is an integer and
+    "2020-01-31" is a date, but "1.10", "+5" and "True" are text.
+
+    Returns
+    -------
+    str
+        One of TYPES
+    """
+    return encode(value)[0]
+
+
+def encode(value):
+    """
+    The (type, stored value) of a metadata value. Strings are only
+    stored as another type if they are decoded to the same text,
+    nothing is lost when they are parsed.
+
+    Raises
+    ------
+    ValueError
+        If value is a NaN or infinite number
+    """
+    if isinstance(value, bool) or _is_numpy_bool(value):
+        return "bool", int(value)
+    if isinstance(value, numbers.Integral):
+        return _integer(int(value))
+    if isinstance(value, numbers.Real):
+        value = float(value)
+        if not math.isfinite(value):
+            raise ValueError(f"Cannot store {value} as metadata")
+        return "real", value
+    if isinstance(value, datetime.date):
+        return "date", value.isoformat()
+    value = str(value)
+    if _INTEGER.fullmatch(value) and str(int(value)) == value:
+        return _integer(int(value), value)
+    if _REAL.fullmatch(value) and repr(float(value)) == value:
+        return "real", float(value)
+    if _DATE.fullmatch(value):
+        try:
+            if datetime.date.fromisoformat(value).isoformat() == value:
+                return "date", value
+        except ValueError:
+            pass
+    return "text", value
+
+
+def decode(type, value):
+    """
+    The python value of a stored metadata value
+    """
+    if type == "bool":
+        return bool(value)
+    if type == "real":
+        return float(value)
+    if type == "date":
+        if len(value) == 10:
+            return datetime.date.fromisoformat(value)
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+
+def _is_numpy_bool(value):
+    # e.g. from a DataFrame, numpy is not imported to check
+    numpy = sys.modules.get("numpy")
+    return numpy is not None and isinstance(value, numpy.bool_)
+
+
+def _integer(value, text=None):
+    # sqlite integers are 64 bit
+    if -(2**63) <= value < 2**63:
+        return "integer", value
+    return "text", str(value) if text is None else text
+
+
+class Condition(object):
+    """
+    A condition on the metadata of Accessions. Conditions
+    are combined with & (and) and | (or).
+    """
+
+    def __and__(self, other):
+        return _Compound("INTERSECT", self, other)
+
+    def __or__(self, other):
+        return _Compound("UNION", self, other)
+
+    def compile(self):
+        """
+        The (sql, parameters) of a query that selects
+        the AIDs of the Accessions meeting the condition
+        """
+        raise NotImplementedError()  # pragma: no cover
+
+
+class _Compare(Condition):
+    def __init__(self, key, op, values):
+        self.key = key
+        self.op = op
+        self.values = [encode(value) for value in values]
+
+    def compile(self):
+        if len(self.values) == 0:
+            return "SELECT AID FROM metadata WHERE 0", []
+        types = sorted({t for type, _ in self.values for t in _COMPARABLE[type]})
+        values = [value for _, value in self.values]
+        if self.op == "BETWEEN" and types != sorted(_COMPARABLE[self.values[0][0]]):
+            raise ValueError(f"Cannot compare {values[0]} and {values[1]}")
+        if self.op == "IN":
+            test = f"val IN ({', '.join('?' * len(values))})"
+        elif self.op == "BETWEEN":
+            test = "val BETWEEN ? AND ?"
+        else:
+            test = f"val {self.op} ?"
+        test = f"{test} AND type IN ({', '.join('?' * len(types))})"
+        if self.op == "!=":
+            # Values of other types are not equal either
+            test = f"NOT (val = ? AND type IN ({', '.join('?' * len(types))}))"
+        return (
+            f"SELECT AID FROM metadata WHERE key = ? AND {test}",
+            [self.key] + values + types,
+        )
+
+
+class _Compound(Condition):
+    def __init__(self, op, a, b):
+        self.op = op
+        self.conditions = (a, b)
+
+    def compile(self):
+        sql, params = [], []
+        for condition in self.conditions:
+            condition_sql, condition_params = condition.compile()
+            # Compound selects cannot be nested with parentheses
+            sql.append(f"SELECT AID FROM ({condition_sql})")
+            params.extend(condition_params)
+        return f" {self.op} ".join(sql), params
+
+
+class Meta(object):
+    """
+    A metadata key in a search. Comparing it with a value builds a
+    Condition, which is compiled to a parameterized query that uses
+    the metadata index:
+
+    >>> Meta("age") > 30
+    >>> Meta("age").between(20, 30) & (Meta("tissue") == "leaf")
+    >>> Meta("tissue").isin(["leaf", "root"]) | (Meta("age") < 10)
+
+    Values are typed the same way as the metadata (see `encode`), so
+    `Meta("age") > "30"` compares numbers. Values are only compared
+    with values of a comparable type: numbers with numbers, dates
+    with dates and so on.
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, value):
+        return _Compare(self.key, "=", [value])
+
+    def __ne__(self, value):
+        return _Compare(self.key, "!=", [value])
+
+    def __lt__(self, value):
+        return _Compare(self.key, "<", [value])
+
+    def __le__(self, value):
+        return _Compare(self.key, "<=", [value])
+
+    def __gt__(self, value):
+        return _Compare(self.key, ">", [value])
+
+    def __ge__(self, value):
+        return _Compare(self.key, ">=", [value])
+
+    def between(self, low, high):
+        """
+        Values from low to high (inclusive)
+        """
+        return _Compare(self.key, "BETWEEN", [low, high])
+
+    def isin(self, values):
+        """
+        Values equal to any of values
+        """
+        return _Compare(self.key, "IN", list(values))
+
+    def __repr__(self):
+        return f'Meta("{self.key}")'
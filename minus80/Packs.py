@@ -0,0 +1,325 @@
+"""Pack files that bundle many small frozen blobs."""
+
+import os
+import uuid
+import hashlib
+import logging
+import threading
+
+from pathlib import Path
+
+__all__ = ["PackIndex", "PackWriter", "PACK_MAX_SIZE", "PACK_MIN_FILES"]
+
+log = logging.getLogger("minus80")
+
+# Files smaller than this are packed ...
+PACK_MAX_SIZE = 64 * 1024
+# ... when a freeze adds at least this many of them
+PACK_MIN_FILES = 1000
+# A new pack file is started once a pack reaches this size
+PACK_FILE_SIZE = 256 * 1024 * 1024
+# Packs with less live data than this are rewritten by repack()
+REPACK_RATIO = 0.5
+
+
+class PackIndex(object):
+    """
+    The index of the objects stored in the pack files of a blob store.
+
+    Pack files (packs/pack-<uuid>.pack) are only ever appended to by
+    the writer that created them. An object is added to the index
+    (packs/INDEX.sqlite) once its data is safely on disk, so a pack
+    may contain data that is not indexed (e.g. from an interrupted
+    freeze) but the index never points at missing data.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.filename = self.root / "INDEX.sqlite"
+        self._db = None
+        # Open file descriptors of packs that are read from, objects
+        # are read concurrently (e.g. by verify)
+        self._fds = {}
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        if self._db is None:
+            from .RelationalDB import apsw
+
+            os.makedirs(self.root, exist_ok=True)
+            self._db = apsw.Connection(str(self.filename))
+            self._db.setbusytimeout(30000)
+            cur = self._db.cursor()
+            cur.execute("PRAGMA journal_mode = WAL").fetchall()
+            with self._db:
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS objects (
+                        checksum TEXT PRIMARY KEY,
+                        pack TEXT NOT NULL,
+                        offset INTEGER NOT NULL,
+                        size INTEGER NOT NULL
+                    ) WITHOUT ROWID;
+                    CREATE INDEX IF NOT EXISTS objects_pack ON objects (pack);
+                """
+                )
+        return self._db
+
+    def __bool__(self):
+        # Stores without packs never create the index
+        return self._db is not None or self.filename.exists()
+
+    def __iter__(self):
+        if not self:
+            return iter(())
+        return (x for (x,) in self.db.cursor().execute("SELECT checksum FROM objects"))
+
+    def get(self, checksum):
+        """
+        The (pack, offset, size) of an object or None
+        """
+        if not self:
+            return None
+        return (
+            self.db.cursor()
+            .execute(
+                "SELECT pack, offset, size FROM objects WHERE checksum = ?", (checksum,)
+            )
+            .fetchone()
+        )
+
+    def path(self, pack):
+        return self.root / pack
+
+    def read(self, checksum):
+        """
+        Read the contents of a packed object
+        """
+        pack, offset, size = self.get(checksum)
+        with self._lock:
+            fd = self._fds.get(pack)
+            if fd is None:
+                fd = self._fds[pack] = os.open(self.path(pack), os.O_RDONLY)
+        return os.pread(fd, size, offset)
+
+    def add(self, objects):
+        """
+        Index objects: a list of (checksum, pack, offset, size)
+        """
+        with self.db:
+            self.db.cursor().executemany(
+                "INSERT OR IGNORE INTO objects (checksum, pack, offset, size) "
+                "VALUES (?, ?, ?, ?)",
+                objects,
+            )
+
+    def remove(self, checksum):
+        """
+        Remove an object from the index, the pack file is deleted
+        once none of its objects are left.
+
+        Returns
+        -------
+        int
+            The number of bytes freed
+        """
+        pack, _, _ = self.get(checksum)
+        with self.db:
+            cur = self.db.cursor()
+            cur.execute("DELETE FROM objects WHERE checksum = ?", (checksum,))
+            left = cur.execute(
+                "SELECT 1 FROM objects WHERE pack = ? LIMIT 1", (pack,)
+            ).fetchall()
+        if left:
+            return 0
+        return self._unlink(pack)
+
+    def packs(self):
+        """
+        The indexed packs: pack -> number of bytes of live objects
+        """
+        if not self:
+            return {}
+        return dict(
+            self.db.cursor().execute(
+                "SELECT pack, SUM(size) FROM objects GROUP BY pack"
+            )
+        )
+
+    def orphans(self):
+        """
+        The pack files with no indexed objects
+        """
+        if not self.root.exists():
+            return []
+        packs = self.packs()
+        return [
+            self.root / name
+            for name in os.listdir(self.root)
+            if name.endswith(".pack") and name not in packs
+        ]
+
+    def repack(self, ratio=REPACK_RATIO):
+        """
+        Rewrite the packs whose live objects make up less than ratio
+        of the pack file, reclaiming the space of removed objects.
+
+        Returns
+        -------
+        int
+            The number of bytes freed
+        """
+        freed = 0
+        for pack, live in self.packs().items():
+            size = self.path(pack).stat().st_size
+            if live >= size * ratio:
+                continue
+            objects = self.db.cursor().execute(
+                "SELECT checksum FROM objects WHERE pack = ?", (pack,)
+            ).fetchall()
+            writer = PackWriter(self)
+            for (checksum,) in objects:
+                writer.append(self.read(checksum), checksum)
+            moved = writer.flush()
+            with self.db:
+                self.db.cursor().executemany(
+                    "UPDATE objects SET pack = ?, offset = ? WHERE checksum = ?",
+                    ((p, o, c) for c, p, o, _ in moved),
+                )
+            freed += size - live
+            self._unlink(pack)
+        return freed
+
+    def close(self):
+        with self._lock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds = {}
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _unlink(self, pack):
+        with self._lock:
+            fd = self._fds.pop(pack, None)
+            if fd is not None:
+                os.close(fd)
+        path = self.path(pack)
+        size = path.stat().st_size
+        os.unlink(path)
+        return size
+
+
+class PackWriter(object):
+    """
+    Appends objects to new pack files. Objects are indexed by
+    `flush`, after the packs have been synced to disk.
+
+    Parameters
+    ----------
+    index : PackIndex
+        The index the packs are added to
+    min_files : int, default=0
+        Objects are held in memory until at least this many were
+        added. If fewer are added, they are left in pending by flush
+        and the caller stores them as loose blobs.
+    exists : callable, default=None
+        Returns True for checksums that are already stored,
+        those objects are skipped
+    """
+
+    def __init__(self, index, min_files=0, exists=None):
+        self.index = index
+        self.min_files = min_files
+        self.exists = exists
+        self.pending = []
+        self.written = []
+        self._seen = set()
+        self._handle = None
+        self._pack = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, checksum):
+        """
+        If an object was added: it is held by the writer (written to
+        a pack that is not indexed until `flush`, or still pending)
+        or it was already stored
+        """
+        with self._lock:
+            return checksum in self._seen
+
+    def ingest(self, src):
+        """
+        Add a (small) file, returns its checksum
+        """
+        with open(src, "rb") as IN:
+            data = IN.read()
+        checksum = hashlib.sha256(data).hexdigest()
+        self.add(data, checksum)
+        return checksum
+
+    def add(self, data, checksum):
+        """
+        Add an object, unless it was already added
+        """
+        with self._lock:
+            if checksum in self._seen:
+                return
+            self._seen.add(checksum)
+            if self.exists is not None and self.exists(checksum):
+                return
+            if self._handle is None and len(self.pending) + 1 < self.min_files:
+                self.pending.append((data, checksum))
+                return
+            for pending_data, pending_checksum in self.pending:
+                self.append(pending_data, pending_checksum)
+            self.pending = []
+            self.append(data, checksum)
+
+    def append(self, data, checksum):
+        """
+        Write an object to the current pack file (callers
+        handle locking)
+        """
+        if self._handle is None or self._handle.tell() >= PACK_FILE_SIZE:
+            self._close_pack()
+            os.makedirs(self.index.root, exist_ok=True)
+            self._pack = f"pack-{uuid.uuid4().hex}.pack"
+            self._handle = open(self.index.path(self._pack), "ab")
+        offset = self._handle.tell()
+        self._handle.write(data)
+        self.written.append((checksum, self._pack, offset, len(data)))
+
+    def flush(self):
+        """
+        Sync the packs to disk and index their objects
+
+        Returns
+        -------
+        list
+            The (checksum, pack, offset, size) of the packed objects
+        """
+        with self._lock:
+            self._close_pack()
+            if self.written:
+                self.index.add(self.written)
+            written, self.written = self.written, []
+            return written
+
+    def abort(self):
+        """
+        Stop writing without indexing anything, the data already
+        written is left in (orphaned) packs for gc to remove
+        """
+        with self._lock:
+            self._close_pack()
+            self.pending = []
+            self.written = []
+
+    def _close_pack(self):
+        if self._handle is not None:
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+            self._handle.close()
+            self._handle = None
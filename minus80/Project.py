@@ -8,8 +8,24 @@ class Project(Freezable):
         # create the internal data dir
         (self.m80.thawed_dir / "data").mkdir(exist_ok=True)
 
+    def data_path(self, *parts):
+        """
+        The path of a file in the data dir of the project, it is
+        written first if the project was thawed lazily
+        """
+        return self.m80.path(Path("data", *parts))
+
     def create_link(self, path):
         path = Path(path)
         if path.exists():
             raise ValueError(f'"{path}" already exists.')
-        path.symlink_to(self.m80.thawed_dir / "data")
+        # Files used through the link cannot be thawed (or copied
+        # before they are written) on access, hard links to frozen
+        # blobs would be written to in place
+        if self.m80.link_mode == "hardlink":
+            raise ValueError(
+                f"{self.m80.slug} uses the hardlink link mode, its files cannot be "
+                'used through a link: configure(link_mode="reflink") it first'
+            )
+        data = self.m80.path("data")
+        path.symlink_to(data)
@@ -0,0 +1,154 @@
+"""Composable, lazily evaluated searches of the Accessions in a Cohort."""
+
+import copy
+
+from .Metadata import Meta, Condition
+
+__all__ = ["Query"]
+
+
+class Query(object):
+    """
+    A search of the Accessions in a Cohort, built by chaining
+    methods (each returns a new Query):
+
+    >>> q = cohort.query().where(Meta("age") > 30, tissue="leaf")
+    >>> for accession in q.select("age").limit(1000):
+    ...     print(accession.name, accession["age"])
+
+    Nothing is read until the query is iterated. Results come in
+    AID order, a batch at a time. The statements only depend on the
+    shape of the query (values are bound as parameters), so the
+    connection's statement cache reuses them across batches and
+    queries.
+    """
+
+    def __init__(self, cohort):
+        self.cohort = cohort
+        self.condition = None
+        # The metadata keys of the results (None for all of them)
+        self.keys = None
+        self.files = True
+        self.max_results = None
+        self.batch_size = cohort.HYDRATE_BATCH
+
+    def where(self, *conditions, **kwargs):
+        """
+        Only match Accessions meeting all of the conditions (and
+        those of the query so far).
+
+        Parameters
+        ----------
+        *conditions : Condition
+            Conditions built from `Meta`, e.g. `Meta("age") > 30`
+        **kwargs : key=value
+            Metadata that must equal value, or be any of value
+            if it is a list, tuple or set
+        """
+        condition = self.condition
+        conditions = list(conditions)
+        for key, value in kwargs.items():
+            if isinstance(value, (list, tuple, set, frozenset)):
+                conditions.append(Meta(key).isin(value))
+            else:
+                conditions.append(Meta(key) == value)
+        for c in conditions:
+            if not isinstance(c, Condition):
+                raise TypeError(f"{c!r} is not a metadata condition")
+            condition = c if condition is None else condition & c
+        return self._copy(condition=condition)
+
+    def select(self, *keys, files=True):
+        """
+        Only read the given metadata keys (and the AID) of the
+        results, and their files unless files is False
+        """
+        return self._copy(keys=keys, files=files)
+
+    def limit(self, n):
+        """
+        Return at most n results
+        """
+        if n < 0:
+            raise ValueError(f"Cannot limit a query to {n} results")
+        return self._copy(max_results=n)
+
+    def batch(self, size):
+        """
+        Read size results at a time
+        """
+        if size < 1:
+            raise ValueError(f"Cannot read batches of {size} results")
+        return self._copy(batch_size=size)
+
+    def compile(self):
+        """
+        The (sql, parameters) selecting the (AID, name) of the
+        matching Accessions. Two more parameters are bound for each
+        batch: the last AID of the previous batch and the batch size.
+        """
+        where, params = "", []
+        if self.condition is not None:
+            query, params = self.condition.compile()
+            where = f"AID IN ({query}) AND "
+        return (
+            f"SELECT AID, name FROM accessions WHERE {where}AID > ? "
+            "ORDER BY AID LIMIT ?",
+            params,
+        )
+
+    def count(self):
+        """
+        The number of matching Accessions
+        """
+        if self.condition is None:
+            query, params = "SELECT COUNT(*) FROM accessions", []
+        else:
+            query, params = self.condition.compile()
+            query = f"SELECT COUNT(*) FROM ({query})"
+        (n,) = self.cohort.m80.db.cursor().execute(query, params).fetchone()
+        return n if self.max_results is None else min(n, self.max_results)
+
+    def first(self):
+        """
+        The first matching Accession, or None
+        """
+        return next(iter(self.limit(1)), None)
+
+    def batches(self):
+        """
+        Yield the matching Accessions in lists of (up to) batch_size
+        """
+        for rows in self._pages():
+            yield list(self.cohort._hydrate(rows, keys=self.keys, files=self.files))
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from batch
+
+    def __repr__(self):
+        return f"Query({self.cohort.m80.name!r}, {self.compile()!r})"
+
+    def _pages(self):
+        """
+        The (AID, name) rows of the results, a batch at a time. Pages are
+        read by AID so no statement stays active between batches.
+        """
+        sql, params = self.compile()
+        cur = self.cohort.m80.db.cursor()
+        last, remaining = -1, self.max_results
+        while remaining is None or remaining > 0:
+            size = self.batch_size if remaining is None else min(self.batch_size, remaining)
+            page = cur.execute(sql, params + [last, size]).fetchall()
+            if len(page) > 0:
+                yield page
+            if len(page) < size:
+                return
+            last = page[-1][0]
+            if remaining is not None:
+                remaining -= len(page)
+
+    def _copy(self, **changes):
+        query = copy.copy(self)
+        query.__dict__.update(changes)
+        return query
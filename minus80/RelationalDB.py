@@ -1,4 +1,5 @@
 import os
+import hashlib
 
 from contextlib import contextmanager
 
@@ -16,6 +17,72 @@ class relational_db(object):
         self.filename = os.path.expanduser(os.path.join(rootdir, "db.sqlite"))
         self.db = apsw.Connection(self.filename)
 
+    @classmethod
+    def open_readonly(cls, filename):
+        """
+        Open a database file that never changes (e.g. a frozen blob)
+        read-only. The file is opened as immutable, so sqlite takes
+        no locks and never creates journal files next to it.
+        """
+        from urllib.request import pathname2url
+
+        self = cls.__new__(cls)
+        self.filename = os.path.abspath(os.path.expanduser(filename))
+        self.db = apsw.Connection(
+            f"file:{pathname2url(self.filename)}?immutable=1",
+            flags=apsw.SQLITE_OPEN_READONLY | apsw.SQLITE_OPEN_URI,
+        )
+        return self
+
+    @staticmethod
+    def snapshot(filename, dest):
+        """
+        Write a compact, consistent copy of a database to dest (which
+        must not exist or be empty) while other connections keep
+        writing to it. The copy only contains committed transactions.
+
+        VACUUM INTO lays out the pages afresh, but the schema cookie in
+        the header of the copy depends on the history of the database
+        (e.g. a snapshot of a thawed snapshot differs from it). Compare
+        the `digest` of snapshots to tell if their contents are the same.
+        """
+        src = apsw.Connection(str(filename), flags=apsw.SQLITE_OPEN_READONLY)
+        try:
+            src.setbusytimeout(30000)
+            src.cursor().execute("VACUUM INTO ?", (str(dest),)).fetchall()
+        finally:
+            src.close()
+
+    @staticmethod
+    def digest(filename):
+        """
+        The sha256 of the contents of a database that is not being
+        written to (e.g. a snapshot): its user_version, its schema and
+        the rows of every table. Databases with the same contents have
+        the same digest, whatever the bytes of their files.
+        """
+        db = relational_db.open_readonly(filename)
+        try:
+            cur = db.cursor()
+            digest = hashlib.sha256()
+            (version,) = cur.execute("PRAGMA user_version").fetchone()
+            digest.update(repr(version).encode("utf-8"))
+            schema = cur.execute(
+                "SELECT type, name, tbl_name, sql FROM sqlite_master ORDER BY type, name"
+            ).fetchall()
+            for kind, name, tbl_name, sql in schema:
+                digest.update(repr((kind, name, tbl_name, sql)).encode("utf-8"))
+                # The rows of virtual tables are kept in their shadow tables
+                if kind != "table" or (sql or "").upper().startswith("CREATE VIRTUAL"):
+                    continue
+                quoted = '"' + name.replace('"', '""') + '"'
+                # Tables are scanned in key order, so equal contents hash equally
+                for row in cur.execute(f"SELECT * FROM {quoted}"):
+                    digest.update(repr(row).encode("utf-8"))
+            return digest.hexdigest()
+        finally:
+            db.db.close()
+
     def cursor(self):
         return self.db.cursor()
 
@@ -1,7 +1,10 @@
 """Utilities and tools for minus80."""
 
-import gzip
+import os
 import bz2
+import json
+import gzip
+import tempfile
 from subprocess import check_call
 
 
@@ -36,6 +39,30 @@ def human_sizeof(num, suffix="B"):  # pragma: no cover
     return "%.1f%s%s" % (num, "Yi", suffix)
 
 
+def write_text(filename, text):
+    """
+    Atomically write text to filename: readers either see the
+    old contents or the new ones, never a partial file.
+    """
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)), prefix=".tmp-"
+    )
+    try:
+        with os.fdopen(fd, "w") as OUT:
+            OUT.write(text)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def write_json(filename, data):
+    """
+    Atomically write data as JSON to filename (see `write_text`)
+    """
+    write_text(filename, json.dumps(data))
+
+
 class rawFile(object):  # pragma no cover
     def __init__(self, filename):  # pragma no cover
         self.filename = filename
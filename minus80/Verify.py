@@ -0,0 +1,166 @@
+"""Verification of frozen blobs against their content addresses."""
+
+import json
+import time
+import logging
+import hashlib
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from .Checksum import BUFFER_SIZE
+from .Tools import write_json
+
+__all__ = ["VerifyLog", "verify_blob", "verify_blobs"]
+
+log = logging.getLogger("minus80")
+
+
+class VerifyLog(object):
+    """
+    A persistent record of the blobs that were verified, so that
+    incremental verifications skip blobs whose files did not change
+    since they were last found intact.
+
+    Like the ChecksumCache, a record is only trusted if the stat of
+    every file storing the blob (pack, recipe and chunk files) is
+    unchanged and was not modified within RACY_WINDOW_NS of the
+    verification.
+    """
+
+    VERSION = 1
+    RACY_WINDOW_NS = 2 * 10**9
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        self.entries = {}
+        self._load()
+
+    def fresh(self, checksum, stats):
+        """
+        If the blob was verified since its files last changed
+        """
+        entry = self.entries.get(checksum)
+        if entry is None or entry["stat"] != stats:
+            return False
+        newest = max(mtime_ns for _, mtime_ns, _ in stats)
+        return newest < entry["verified_at"] - self.RACY_WINDOW_NS
+
+    def record(self, checksum, stats, verified_at):
+        self.entries[checksum] = {"stat": stats, "verified_at": verified_at}
+
+    def forget(self, checksum):
+        self.entries.pop(checksum, None)
+
+    def save(self):
+        """
+        Atomically write the log to disk
+        """
+        write_json(self.filename, {"version": self.VERSION, "entries": self.entries})
+
+    def _load(self):
+        try:
+            with open(self.filename, "r") as IN:
+                data = json.load(IN)
+            if data["version"] == self.VERSION:
+                self.entries = data["entries"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError):
+            log.warning(f"Discarding unreadable verification log: {self.filename}")
+            self.entries = {}
+
+
+def _stats(store, checksum):
+    """
+    The [size, mtime_ns, inode] of the files storing a blob
+    """
+    stats = []
+    for part in [checksum] + [chunk for chunk, _ in store.chunks(checksum) or ()]:
+        st = store.stat(part)
+        stats.append([st.st_size, st.st_mtime_ns, st.st_ino])
+    return stats
+
+
+def verify_blob(store, checksum):
+    """
+    Re-hash the (uncompressed, reassembled) contents of a blob
+
+    Returns
+    -------
+    str
+        "ok", "missing" (the blob or one of its chunks is not in
+        the store) or "corrupt" (the contents do not match the
+        checksum or cannot be read)
+    """
+    if not store.exists(checksum):
+        return "missing"
+    running_hash = hashlib.sha256()
+    try:
+        chunks = store.chunks(checksum)
+        parts = [checksum] if chunks is None else [chunk for chunk, _ in chunks]
+        for part in parts:
+            with store.open(part) as IN:
+                while True:
+                    data = IN.read(BUFFER_SIZE)
+                    if not data:
+                        break
+                    running_hash.update(data)
+    except FileNotFoundError:
+        return "missing"
+    except Exception as e:
+        # Any error decompressing or parsing a blob means it is damaged
+        log.debug(f"Could not read {checksum}: {e}")
+        return "corrupt"
+    if running_hash.hexdigest() != checksum:
+        return "corrupt"
+    return "ok"
+
+
+def verify_blobs(store, checksums, workers=1, verify_log=None):
+    """
+    Verify many blobs on a bounded thread pool.
+
+    Parameters
+    ----------
+    store : BlobStore
+        The store holding the blobs
+    checksums : iterable of str
+        The blobs to verify
+    workers : int, default=1
+        The number of blobs verified concurrently
+    verify_log : VerifyLog, default=None
+        If provided, blobs it recorded as intact (and whose files
+        did not change since) are skipped, and intact blobs are
+        recorded in it
+
+    Returns
+    -------
+    dict
+        checksum -> "ok", "missing", "corrupt" or "skipped"
+    """
+
+    def check(checksum):
+        try:
+            stats = _stats(store, checksum)
+        except FileNotFoundError:
+            return checksum, "missing", None
+        if verify_log is not None and verify_log.fresh(checksum, stats):
+            return checksum, "skipped", None
+        started = time.time_ns()
+        status = verify_blob(store, checksum)
+        return checksum, status, (stats, started) if status == "ok" else None
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for checksum, status, seen in pool.map(check, sorted(set(checksums))):
+            results[checksum] = status
+            if verify_log is None:
+                continue
+            if seen is not None:
+                verify_log.record(checksum, *seen)
+            elif status != "skipped":
+                verify_log.forget(checksum)
+    if verify_log is not None:
+        verify_log.save()
+    return results
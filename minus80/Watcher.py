@@ -0,0 +1,358 @@
+"""Tracking of the files that change in a thawed directory."""
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+from pathlib import Path
+
+from .Tools import write_json
+
+__all__ = ["DirtySet", "InotifyWatcher", "PollingWatcher", "start_watcher"]
+
+log = logging.getLogger("minus80")
+
+# inotify(7) constants
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+_EVENT = struct.Struct("iIII")
+
+# The dirty set is written to disk at most this often (seconds)
+SAVE_INTERVAL = 1.0
+
+
+class DirtySet(object):
+    """
+    The paths (relative to the thawed directory) that may differ from
+    the parent tag of a dataset. Every change is numbered, so changes
+    that happen while a scan runs are not lost when the set is rebased
+    on the result of that scan.
+
+    The set is persisted (atomically) to filename along with the pid
+    of the watching process, for other processes to inspect.
+    """
+
+    VERSION = 1
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        self.paths = {}
+        self.seq = 0
+        # The change number of a lost event (the set is incomplete)
+        self.overflow = None
+        self.parent = None
+        self._lock = threading.Lock()
+        self._saved = 0.0
+        self._changed = False
+
+    def add(self, rel_path):
+        with self._lock:
+            self.seq += 1
+            self.paths[rel_path] = self.seq
+            self._changed = True
+
+    def lost(self):
+        """
+        Record that events were lost, the set is incomplete
+        until the next rebase
+        """
+        with self._lock:
+            self.seq += 1
+            self.overflow = self.seq
+            self._changed = True
+
+    def snapshot(self):
+        """
+        The current (change number, paths, complete) of the set
+        """
+        with self._lock:
+            return self.seq, set(self.paths), self.overflow is None
+
+    def rebase(self, seq, paths, parent=None):
+        """
+        Replace the changes numbered up to seq with paths, the
+        paths found to differ from the parent tag by a scan that
+        started at change seq.
+        """
+        with self._lock:
+            self.paths = {p: s for p, s in self.paths.items() if s > seq}
+            for rel_path in paths:
+                self.paths.setdefault(rel_path, seq)
+            if self.overflow is not None and self.overflow <= seq:
+                self.overflow = None
+            if parent is not None:
+                self.parent = parent
+            self._changed = True
+        self.save()
+
+    def save(self, force=True):
+        """
+        Write the set to disk, unless it was saved within
+        SAVE_INTERVAL and force is False
+        """
+        with self._lock:
+            if not self._changed:
+                return
+            if not force and time.monotonic() - self._saved < SAVE_INTERVAL:
+                return
+            data = {
+                "version": self.VERSION,
+                "pid": os.getpid(),
+                "parent": self.parent,
+                "complete": self.overflow is None,
+                "dirty": sorted(self.paths),
+            }
+            self._changed = False
+            self._saved = time.monotonic()
+        write_json(self.filename, data)
+
+    def clear(self):
+        """
+        Stop tracking, the file on disk is removed
+        """
+        try:
+            os.unlink(self.filename)
+        except FileNotFoundError:
+            pass
+
+
+class _Watcher(object):
+    """
+    Base class of the watchers: a daemon thread that adds the
+    paths that change in directory to a DirtySet. Subclasses
+    define the thread's loop as _run.
+    """
+
+    def __init__(self, directory, dirty):
+        self.directory = str(directory)
+        self.dirty = dirty
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f"m80-watch:{self.directory}", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.dirty.save()
+
+    def drain(self):
+        """
+        Process the changes that already happened
+        """
+
+    def _rel(self, path):
+        if path == self.directory:
+            return "."
+        return path.replace(self.directory + "/", "", 1)
+
+
+class InotifyWatcher(_Watcher):
+    """
+    Tracks changes with inotify (Linux). Events are queued by the kernel
+    as files are written, so `drain` accounts for every change made
+    before it was called. If the kernel queue overflows, the dirty set
+    is marked incomplete.
+    """
+
+    def __init__(self, directory, dirty):
+        super().__init__(directory, dirty)
+        self._libc = self.libc()
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # watch descriptor -> watched directory
+        self._wds = {}
+        self._lock = threading.Lock()
+        self._add_tree(self.directory)
+
+    @staticmethod
+    def libc():
+        """
+        The C library if it provides inotify, otherwise None
+        """
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            libc.inotify_init1
+        except (OSError, AttributeError):
+            return None
+        return libc
+
+    def drain(self):
+        with self._lock:
+            while True:
+                try:
+                    data = os.read(self._fd, 64 * 1024)
+                except BlockingIOError:
+                    break
+                self._handle(data)
+        self.dirty.save(force=False)
+
+    def stop(self):
+        super().stop()
+        with self._lock:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _run(self):
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._fd], [], [], 0.5)
+            if ready:
+                self.drain()
+            else:
+                self.dirty.save(force=False)
+
+    def _add_tree(self, top):
+        for root, dirs, files in os.walk(top):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                # e.g. the inotify watch limit was reached
+                log.warning(f"Cannot watch {root}: {os.strerror(err)}")
+                self.dirty.lost()
+                continue
+            self._wds[wd] = root
+
+    def _remove_tree(self, top):
+        for wd, path in list(self._wds.items()):
+            if path == top or path.startswith(top + "/"):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._wds[wd]
+
+    def _handle(self, data):
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                log.warning(f"Lost track of changes in {self.directory}")
+                self.dirty.lost()
+                continue
+            directory = self._wds.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._wds[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if directory == self.directory:
+                    self.dirty.lost()
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(path)
+                elif mask & IN_MOVED_FROM:
+                    self._remove_tree(path)
+            self.dirty.add(self._rel(path))
+
+
+class PollingWatcher(_Watcher):
+    """
+    Tracks changes by comparing the stat of every file in the
+    directory every interval seconds. Changes show up in the dirty
+    set with a delay of up to interval, `drain` polls right away.
+    """
+
+    def __init__(self, directory, dirty, interval=1.0):
+        super().__init__(directory, dirty)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stats = self._scan()
+
+    def poll(self):
+        """
+        Compare the directory with the last poll
+        """
+        with self._lock:
+            stats = self._scan()
+            for path, st in stats.items():
+                if self._stats.get(path) != st:
+                    self.dirty.add(self._rel(path))
+            for path in self._stats.keys() - stats.keys():
+                self.dirty.add(self._rel(path))
+            self._stats = stats
+        self.dirty.save(force=False)
+
+    def drain(self):
+        self.poll()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.poll()
+
+    def _scan(self):
+        stats = {}
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.lstat(path)
+                except FileNotFoundError:
+                    continue
+                stats[path] = (st.st_size, st.st_mtime_ns, st.st_ino)
+        return stats
+
+
+def start_watcher(directory, dirty, polling=False, interval=1.0):
+    """
+    Start watching directory for changes, with inotify unless polling
+    is True or inotify is not available.
+
+    Parameters
+    ----------
+    directory : str or Path
+        The directory to watch (recursively)
+    dirty : DirtySet
+        The set the changed paths are added to
+    polling : bool, default=False
+        Poll for changes instead of using inotify
+    interval : float, default=1.0
+        The number of seconds between polls
+    """
+    if not polling and InotifyWatcher.libc() is not None:
+        return InotifyWatcher(directory, dirty).start()
+    return PollingWatcher(directory, dirty, interval=interval).start()
@@ -23,25 +23,8 @@ ch.setFormatter(formatter)
 ch.setLevel(logging.INFO)
 log.addHandler(ch)
 
-# Initialize the Minus80 Freezer
-def _init():  # pragma: no cover
-    import os
-    from .Config import cf
-
-    rootdir = os.path.realpath(os.path.expanduser(cf.options.rootdir))
-
-    # Create the rootdir if not exists
-    try:
-        os.makedirs(rootdir, exist_ok=True)
-        os.makedirs(os.path.join(rootdir, "datasets"), exist_ok=True)
-        os.makedirs(os.path.join(rootdir, "tmp"), exist_ok=True)
-        os.makedirs(os.path.join(rootdir, "Raw"), exist_ok=True)
-    except Exception:
-        raise
-
-
-_init()
-
+# The Minus80 directories are created when the config is
+# first read (see Config), not when minus80 is imported
 
 
 def exists(dtype, name, rootdir=None):
@@ -5,7 +5,6 @@ import sys
 import json
 import click
 import random
-import asyncio
 
 import minus80 as m80
 
@@ -13,6 +12,7 @@ from collections import defaultdict
 from datetime import datetime
 from pathlib import Path
 from minus80.Freezable import FreezableAPI
+from minus80.Tools import human_sizeof
 
 from minus80.Exceptions import (
     TagInvalidError,
@@ -20,13 +20,13 @@ from minus80.Exceptions import (
     FreezableNameInvalidError,
     TagExistsError,
     TagDoesNotExistError,
+    TagInUseError,
     UserNotLoggedInError,
     UnsavedChangesInThawedError,
     CloudDatasetDoesNotExistError,
     CloudTagDoesNotExistError,
     CloudPullFailedError,
 )
-from requests.exceptions import HTTPError
 
 
 class NaturalOrderGroup(click.Group):
@@ -167,7 +167,7 @@ def ls(name, dtype, tags):
             if tags:
                 thawed_tag = None
                 tags = []
-                for t in self.tag_data:
+                for t in self.manifest.all(files=False):
                     if t["tag"] == "thawed":
                         # TODO: add thawed info into ls
                         thawed_tag = t
@@ -191,7 +191,7 @@ cli.add_command(ls)
 # ----------------------------
 #    delete Commands
 # ----------------------------
-@click.command(help="Delete a minus80 dataset")
+@click.command(help="Delete a minus80 dataset or one of its tags")
 @click.argument("slug", metavar="<slug>")
 @click.option(
     "--force",
@@ -205,15 +205,10 @@ def delete(slug, force):
         click.confirm(f'Are you sure you want to delete "{slug}"')
     try:
         dtype, name, tag = FreezableAPI.parse_slug(slug)
-        if tag is not None:
-            raise TagInvalidError()
-    except TagInvalidError:
-        click.echo("Cannot delete tags, only entire datasets.")
-        sys.exit(1)
-    except FreezableNameInvalidError:
+    except (TagInvalidError, FreezableNameInvalidError):
         click.echo(
-            "Please provide a valid dataset name: <dtype>.<name>. E.g. Project.foobar"
-            "Note: do not include tags"
+            "Please provide a valid dataset name: <dtype>.<name>[:<tag>]. "
+            "E.g. Project.foobar or Project.foobar:v1"
         )
         sys.exit(1)
     # Make sure that the dataset is available
@@ -223,13 +218,190 @@ def delete(slug, force):
             "check available datasets with the ls command"
         )
         sys.exit(1)
-    else:
+    elif tag is None:
         FreezableAPI.delete(dtype, name)
         sys.exit(0)
+    else:
+        try:
+            FreezableAPI(dtype, name).delete_tag(tag)
+        except TagDoesNotExistError:
+            click.echo(f'tag "{tag}" does not exist for {dtype}.{name}')
+            sys.exit(1)
+        except TagInUseError as e:
+            click.echo(e.message)
+            sys.exit(1)
+        click.echo(
+            "Tag deleted, run the gc command to reclaim the space used by its files"
+        )
+        sys.exit(0)
 
 
 cli.add_command(delete)
 
+# ----------------------------
+#    gc Command
+# ----------------------------
+
+
+@click.command(help="Remove frozen files that are not used by any tag")
+@click.argument("slug", metavar="<slug>", required=False)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="Only report how much space would be reclaimed",
+)
+@click.option(
+    "--grace",
+    default=3600,
+    show_default=True,
+    help="Keep files that were frozen within this many seconds",
+)
+def gc(slug, dry_run, grace):
+    if slug is None:
+        # Collect every dataset
+        slugs = FreezableAPI.datasets()
+    else:
+        slugs = [slug]
+    total_blobs = total_bytes = 0
+    for slug in slugs:
+        try:
+            dtype, name, tag = FreezableAPI.parse_slug(slug)
+            if tag is not None:
+                raise TagInvalidError()
+        except (TagInvalidError, FreezableNameInvalidError):
+            click.echo(
+                "Please provide a valid dataset name: <dtype>.<name>. E.g. Project.foobar"
+            )
+            sys.exit(1)
+        if not FreezableAPI.exists(dtype, name):
+            click.echo(
+                f'"{dtype}.{name}" not in minus80 datasets! '
+                "check available datasets with the ls command"
+            )
+            sys.exit(1)
+        report = FreezableAPI(dtype, name).gc(dry_run=dry_run, grace=grace)
+        click.echo(
+            f"{dtype}.{name}: {report['blobs']} unused files, "
+            f"{report['incoming']} stale temporary files "
+            f"({human_sizeof(report['bytes'])})"
+        )
+        total_blobs += report["blobs"] + report["incoming"]
+        total_bytes += report["bytes"]
+    verb = "Would reclaim" if dry_run else "Reclaimed"
+    click.echo(f"{verb} {human_sizeof(total_bytes)} from {total_blobs} files")
+
+
+cli.add_command(gc)
+
+# ----------------------------
+#    verify Command
+# ----------------------------
+
+
+@click.command(help="Check that frozen files match their checksums")
+@click.argument("slug", metavar="<slug>", required=False)
+@click.option(
+    "--workers",
+    default=None,
+    type=int,
+    help="The number of files checked concurrently",
+)
+@click.option(
+    "--full",
+    is_flag=True,
+    default=False,
+    help="Re-check files that were found intact by a previous verify",
+)
+def verify(slug, workers, full):
+    if slug is None:
+        # Verify every dataset
+        slugs = FreezableAPI.datasets()
+    else:
+        slugs = [slug]
+    damaged = 0
+    for slug in slugs:
+        try:
+            dtype, name, tag = FreezableAPI.parse_slug(slug)
+        except (TagInvalidError, FreezableNameInvalidError):
+            click.echo(
+                "Please provide a valid dataset name: <dtype>.<name>[:<tag>]. "
+                "E.g. Project.foobar"
+            )
+            sys.exit(1)
+        if not FreezableAPI.exists(dtype, name):
+            click.echo(
+                f'"{dtype}.{name}" not in minus80 datasets! '
+                "check available datasets with the ls command"
+            )
+            sys.exit(1)
+        try:
+            report = FreezableAPI(dtype, name).verify(
+                tags=None if tag is None else [tag],
+                workers=workers,
+                incremental=not full,
+            )
+        except TagDoesNotExistError:
+            click.echo(f'tag "{tag}" does not exist for {dtype}.{name}')
+            sys.exit(1)
+        click.echo(
+            f"{dtype}.{name}: checked {report['blobs']} files "
+            f"({report['skipped']} verified previously)"
+        )
+        for tagname, problems in report["tags"].items():
+            for status in ("missing", "corrupt"):
+                for path in problems[status]:
+                    click.secho(f"    {tagname}: {status}: {path}", fg="red")
+                    damaged += 1
+    if damaged:
+        sys.exit(1)
+    click.echo(click.style("OK", fg="green", bold=True))
+
+
+cli.add_command(verify)
+
+# ----------------------------
+#    migrate Command
+# ----------------------------
+
+
+@click.command(help="Move frozen files to the sharded directory layout")
+@click.argument("slug", metavar="<slug>", required=False)
+@click.option(
+    "--layout",
+    type=click.Choice(["sharded", "flat"]),
+    default="sharded",
+    show_default=True,
+    help="The layout to move the frozen files to",
+)
+def migrate(slug, layout):
+    if slug is None:
+        # Migrate every dataset
+        slugs = FreezableAPI.datasets()
+    else:
+        slugs = [slug]
+    for slug in slugs:
+        try:
+            dtype, name, tag = FreezableAPI.parse_slug(slug)
+            if tag is not None:
+                raise TagInvalidError()
+        except (TagInvalidError, FreezableNameInvalidError):
+            click.echo(
+                "Please provide a valid dataset name: <dtype>.<name>. E.g. Project.foobar"
+            )
+            sys.exit(1)
+        if not FreezableAPI.exists(dtype, name):
+            click.echo(
+                f'"{dtype}.{name}" not in minus80 datasets! '
+                "check available datasets with the ls command"
+            )
+            sys.exit(1)
+        moved = FreezableAPI(dtype, name).migrate_layout(layout)
+        click.echo(f"{dtype}.{name}: moved {moved} files")
+
+
+cli.add_command(migrate)
+
 # ----------------------------
 #    Freeze Command
 # ----------------------------
@@ -282,7 +454,13 @@ cli.add_command(freeze)
     default=False,
     help="forces a thaw, even if there are unsaved changes",
 )
-def thaw(slug, force):
+@click.option(
+    "--lazy",
+    is_flag=True,
+    default=False,
+    help="only write files when they are first accessed",
+)
+def thaw(slug, force, lazy):
     try:
         cwd = Path.cwd().resolve()
     except FileNotFoundError:  # pragma: no cover
@@ -309,7 +487,7 @@ def thaw(slug, force):
             click.echo(f"Could not build {dtype}.{name}")
         # Freeze with tag
         try:
-            dataset.m80.thaw(tag, force=force)
+            dataset.m80.thaw(tag, force=force, lazy=lazy)
             click.echo(click.style("SUCCESS!", fg="green", bold=True))
             sys.exit(0)
         except TagDoesNotExistError:
@@ -367,6 +545,8 @@ def login(username, password, force, reset_password):
     """
     Log into your cloud account at minus80.linkage.io
     """
+    from requests.exceptions import HTTPError
+
     cloud = m80.CloudData()
     # check to see if we are doing a reset
     if reset_password == True:
@@ -447,6 +627,9 @@ def ls(dtype, name, tags=False):
     """
     List available datasets
     """
+    import asyncio
+    from requests.exceptions import HTTPError
+
     cloud = m80.CloudData()
     try:
         cloud.user
@@ -493,6 +676,8 @@ def push(slug):
     Positional Arguments:
     <slug> - A slug of a frozen minus80 dataset
     """
+    import asyncio
+
     cloud = m80.CloudData()
     try:
         cloud.user
@@ -542,6 +727,8 @@ def pull(slug):
     Positional Arguments:
     <slug> - The slug of the frozen minus80 dataset (e.g. Project.foo:v1)
     """
+    import asyncio
+
     cloud = m80.CloudData()
     try:
         cloud.user
@@ -1,7 +1,11 @@
+import time
 import pytest
+import datetime
 import tempfile
+import numpy as np
 
 from minus80 import Accession, Cohort
+from minus80.Metadata import Meta, encode
 
 
 def test_init(simpleCohort, RNACohort):
@@ -187,3 +191,382 @@ def test_get_name_from_AID(simpleCohort):
 
 def test_get_aliases(simpleCohort):
     assert simpleCohort.get_aliases("Sample1")
+
+
+def test_iter_matches_getitem(simpleCohort, monkeypatch):
+    # Hydrate across several batches
+    monkeypatch.setattr(simpleCohort, "HYDRATE_BATCH", 3)
+    accessions = list(simpleCohort)
+    assert len(accessions) == len(simpleCohort)
+    for a in accessions:
+        b = simpleCohort[a.name]
+        assert a.metadata == b.metadata
+        assert a.files == b.files
+
+
+def test_get_many(simpleCohort):
+    AID = simpleCohort["Sample1"]["AID"]
+    x = simpleCohort.get_many(["Sample3", AID, "Sample3"])
+    assert [a.name for a in x] == ["Sample3", "Sample1", "Sample3"]
+    assert x[0]["type"] == "CHIP"
+    assert x[0].files == {"file1.txt", "file2.txt"}
+
+
+def test_get_many_missing(simpleCohort):
+    with pytest.raises(NameError):
+        simpleCohort.get_many(["Sample1", "NOT_A_SAMPLE"])
+
+
+def test_get_many_keeps_durability():
+    tmpdir = tempfile.TemporaryDirectory()
+    Cohort("readCohort", rootdir=tmpdir.name).add_accessions([Accession("A1")])
+    x = Cohort("readCohort", rootdir=tmpdir.name)
+    cur = x.m80.db.cursor()
+
+    def settings():
+        return [
+            cur.execute(f"PRAGMA {pragma}").fetchall()[0][0]
+            for pragma in ("synchronous", "journal_mode")
+        ]
+
+    before = settings()
+    assert [a.name for a in x.get_many(["A1"])] == ["A1"]
+    assert settings() == before
+    tmpdir.cleanup()
+
+
+def test_schema_migration():
+    tmpdir = tempfile.TemporaryDirectory()
+    x = Cohort("oldCohort", rootdir=tmpdir.name)
+    # Roll the database back to the unindexed, unversioned schema
+    x.m80.db.cursor().execute(
+        """
+        DROP INDEX metadata_key_val;
+        DROP INDEX aliases_AID;
+        DROP INDEX aid_files_FID;
+        PRAGMA user_version = 0;
+    """
+    )
+    x = Cohort("oldCohort", rootdir=tmpdir.name)
+    cur = x.m80.db.cursor()
+    assert cur.execute("PRAGMA user_version").fetchone()[0] == Cohort.SCHEMA_VERSION
+    indexes = {
+        name
+        for (name,) in cur.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        ).fetchall()
+    }
+    assert {"metadata_key_val", "aliases_AID", "aid_files_FID"} <= indexes
+
+
+@pytest.mark.parametrize(
+    "query,index",
+    [
+        ("SELECT AID FROM metadata WHERE key = 'type' AND val = 'WGS'", "metadata_key_val"),
+        ("SELECT DISTINCT(key) FROM metadata", "metadata_key_val"),
+        (
+            "SELECT AID FROM metadata WHERE key = 'age' AND val > 30 "
+            "AND type IN ('integer', 'real')",
+            "metadata_key_val",
+        ),
+        (
+            "SELECT key, type, val FROM metadata WHERE AID = 1",
+            "sqlite_autoindex_metadata_1",
+        ),
+        ("SELECT alias FROM aliases WHERE AID = 1", "aliases_AID"),
+        ("SELECT AID FROM aid_files WHERE FID = 1", "aid_files_FID"),
+    ],
+)
+def test_query_plans(simpleCohort, query, index):
+    plan = " ".join(
+        row[-1]
+        for row in simpleCohort.m80.db.cursor()
+        .execute(f"EXPLAIN QUERY PLAN {query}")
+        .fetchall()
+    )
+    assert f"COVERING INDEX {index}" in plan
+
+
+def test_search_latency_is_flat():
+    def latency(n):
+        tmpdir = tempfile.TemporaryDirectory()
+        x = Cohort("benchCohort", rootdir=tmpdir.name)
+        x.add_accessions(
+            [
+                Accession(f"S{i}", files=[f"S{i}.fastq"], idx=str(i), group=str(i % 10))
+                for i in range(n)
+            ]
+        )
+        # The best of several rounds, to keep the noise down
+        best = float("inf")
+        for _ in range(5):
+            start = time.perf_counter()
+            for i in range(0, n, n // 100):
+                x.search_metadata(idx=str(i))
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    small = latency(500)
+    large = latency(20000)
+    # Without indexes every search scans 40x the rows
+    assert large < 4 * small
+
+
+@pytest.fixture(scope="module")
+def typedCohort():
+    tmpdir = tempfile.TemporaryDirectory()
+    x = Cohort("typedCohort", rootdir=tmpdir.name)
+    x.add_accessions(
+        [
+            Accession("P1", age=23, height=1.8, tissue="leaf", control=True),
+            Accession("P2", age="30", height="1.65", tissue="root", control=False),
+            Accession("P3", age=41, tissue="leaf", sown=datetime.date(2020, 3, 1)),
+            Accession("P4", age=55, tissue="stem", barcode="0042", sown="2021-06-15"),
+        ]
+    )
+    yield x
+    tmpdir.cleanup()
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        (30, ("integer", 30)),
+        ("30", ("integer", 30)),
+        ("-1.5", ("real", -1.5)),
+        ("1e3", ("text", "1e3")),
+        ("1.10", ("text", "1.10")),
+        ("+5", ("text", "+5")),
+        ("-0", ("text", "-0")),
+        ("0042", ("text", "0042")),
+        ("True", ("text", "True")),
+        (False, ("bool", 0)),
+        (np.True_, ("bool", 1)),
+        ("2020-01-31", ("date", "2020-01-31")),
+        ("2020-13-31", ("text", "2020-13-31")),
+        (datetime.date(2020, 1, 31), ("date", "2020-01-31")),
+        ("leaf", ("text", "leaf")),
+    ],
+)
+def test_encode(value, expected):
+    assert encode(value) == expected
+
+
+def test_metadata_text_round_trip():
+    tmpdir = tempfile.TemporaryDirectory()
+    x = Cohort("roundTripCohort", rootdir=tmpdir.name)
+    values = ["1.10", "1e3", "+5", "True", "false", "0042", "nan"]
+    x.add_accessions(
+        [
+            Accession("A1", **{f"k{i}": v for i, v in enumerate(values)}),
+            Accession("A2", k0="1.1"),
+        ]
+    )
+    assert [x["A1"][f"k{i}"] for i in range(len(values))] == values
+    assert x["A2"]["k0"] == 1.1
+    assert names(x.search_metadata(k0="1.10")) == ["A1"]
+    assert names(x.search_metadata(k0="1.1")) == ["A2"]
+    tmpdir.cleanup()
+
+
+def test_encode_nan():
+    with pytest.raises(ValueError):
+        encode(float("nan"))
+
+
+def test_typed_metadata(typedCohort):
+    p2 = typedCohort["P2"]
+    assert p2["age"] == 30
+    assert p2["height"] == 1.65
+    assert p2["control"] is False
+    assert typedCohort["P3"]["sown"] == datetime.date(2020, 3, 1)
+    assert typedCohort["P4"]["barcode"] == "0042"
+
+
+def names(accessions):
+    return [x.name for x in accessions]
+
+
+def test_search_metadata_conditions(typedCohort):
+    search = typedCohort.search_metadata
+    assert names(search(Meta("age") > 30)) == ["P3", "P4"]
+    assert names(search(Meta("age") > "30")) == ["P3", "P4"]
+    assert names(search(Meta("age").between(23, 41))) == ["P1", "P2", "P3"]
+    assert names(search(Meta("height") <= 1.7)) == ["P2"]
+    assert names(search(Meta("tissue").isin(["leaf", "stem"]))) == ["P1", "P3", "P4"]
+    assert names(search(tissue=["root", "stem"])) == ["P2", "P4"]
+    assert names(search(Meta("tissue") != "leaf")) == ["P2", "P4"]
+    assert names(search(Meta("sown") >= datetime.date(2021, 1, 1))) == ["P4"]
+    assert names(search(Meta("control") == True)) == ["P1"]
+    assert names(search(Meta("age") < 40, tissue="leaf")) == ["P1"]
+    assert names(search((Meta("age") < 25) | (Meta("tissue") == "stem"))) == ["P1", "P4"]
+    assert names(
+        search(((Meta("age") < 25) | (Meta("age") > 50)) & (Meta("tissue") == "leaf"))
+    ) == ["P1"]
+    # Text never compares with numbers
+    assert search(Meta("tissue") > 5) == []
+    assert search(Meta("age").isin([])) == []
+
+
+def test_search_metadata_bad_range(typedCohort):
+    with pytest.raises(ValueError):
+        typedCohort.search_metadata(Meta("age").between(1, "leaf"))
+
+
+def test_typed_metadata_migration():
+    tmpdir = tempfile.TemporaryDirectory()
+    x = Cohort("untypedCohort", rootdir=tmpdir.name)
+    # Roll the metadata back to text values
+    x.m80.db.cursor().execute(
+        """
+        DROP TABLE metadata;
+        CREATE TABLE metadata (
+            AID NOT NULL,
+            key TEXT NOL NULL,
+            val TEXT NOT NULL,
+            FOREIGN KEY(AID) REFERENCES accessions(AID)
+            UNIQUE(AID, key, val)
+        );
+        CREATE INDEX metadata_key_val ON metadata (key, val, AID);
+        INSERT INTO accessions (name) VALUES ('A1');
+        INSERT INTO metadata (AID, key, val) VALUES (1, 'age', 30), (1, 'tissue', 'leaf');
+        PRAGMA user_version = 2;
+    """
+    )
+    x = Cohort("untypedCohort", rootdir=tmpdir.name)
+    assert x["A1"]["age"] == 30
+    assert names(x.search_metadata(Meta("age") > 29, tissue="leaf")) == ["A1"]
+
+
+def test_query(typedCohort):
+    q = typedCohort.query().where(Meta("age") > 25)
+    assert names(q) == ["P2", "P3", "P4"]
+    # Queries are immutable
+    assert names(q.where(tissue="leaf")) == ["P3"]
+    assert names(q) == ["P2", "P3", "P4"]
+    assert names(q.limit(2)) == ["P2", "P3"]
+    assert q.count() == 3
+    assert q.limit(2).count() == 2
+    assert q.first().name == "P2"
+    assert q.where(tissue="flower").first() is None
+    assert typedCohort.query().count() == len(typedCohort)
+
+
+def test_query_batches(typedCohort):
+    q = typedCohort.query().batch(3)
+    assert [names(batch) for batch in q.batches()] == [["P1", "P2", "P3"], ["P4"]]
+    assert [names(batch) for batch in q.limit(2).batches()] == [["P1", "P2"]]
+    assert list(q.limit(0)) == []
+
+
+def test_query_select(typedCohort):
+    p1 = typedCohort.query().where(tissue="leaf").select("age", "tissue").first()
+    assert p1.metadata == {"AID": 1, "age": 23, "tissue": "leaf"}
+    p1 = typedCohort.query().select(files=False).first()
+    assert p1.metadata == {"AID": 1}
+
+
+def test_query_is_parameterized(typedCohort):
+    q = typedCohort.query().where(Meta("tissue") == "it's")
+    sql, params = q.compile()
+    assert "it's" not in sql and "it's" in params
+    assert list(q) == []
+    # The same statements are reused for every value
+    db = typedCohort.m80.db.db
+    list(typedCohort.query().where(Meta("age") > 1).batch(1))
+    misses = db.cache_stats()["misses"]
+    for age in range(10):
+        list(typedCohort.query().where(Meta("age") > age).batch(1))
+    assert db.cache_stats()["misses"] == misses
+
+
+def test_query_bad_condition(typedCohort):
+    with pytest.raises(TypeError):
+        typedCohort.query().where("age > 30")
+
+
+@pytest.fixture(scope="module")
+def namedCohort():
+    tmpdir = tempfile.TemporaryDirectory()
+    x = Cohort("namedCohort", rootdir=tmpdir.name)
+    x.add_accessions(
+        [
+            Accession("M7956_Fat_shoulder_1", files=["/data/M7956_R1.fastq"]),
+            Accession("M7956_Fat_shoulder_10", files=["/data/M7956_10_R1.fastq"]),
+            Accession("Sample1", tag="leaf_sample_one"),
+            Accession("Sample10"),
+        ]
+    )
+    x.alias_column("tag")
+    yield x
+    tmpdir.cleanup()
+
+
+def test_search_accessions_ranked(namedCohort):
+    assert namedCohort.search_accessions("sample", include_scores=True) == [
+        ("Sample1", 85.7),
+        ("Sample10", 75.0),
+        ("leaf_sample_one", 40.0),
+    ]
+    assert namedCohort.search_accessions("Sample1") == ["Sample1", "Sample10"]
+
+
+def test_search_accessions_fuzzy(namedCohort):
+    search = namedCohort.search_accessions
+    assert search("M7956_Fat_shoulder_1_R1.fastq") == ["M7956_Fat_shoulder_1"]
+    assert search("M7956_Fat_shoulder_1_R1.fastq", recurse=False) == []
+    assert search("zz") == []
+
+
+def test_batch_search_accessions(namedCohort):
+    results = namedCohort.batch_search_accessions(
+        ["Sample10", "M7956_Fat_shoulder_10.fastq", "Sample10"]
+    )
+    assert results == {
+        "Sample10": ["Sample10"],
+        "M7956_Fat_shoulder_10.fastq": ["M7956_Fat_shoulder_10"],
+    }
+    files = ["/raw/M7956_Fat_shoulder_10.fastq", "/raw/Sample10.fastq", "/raw/zz"]
+    assert namedCohort.assimilate_files(files) == {
+        "M7956_Fat_shoulder_10": {files[0]},
+        "Sample10": {files[1]},
+        "unmatched": {files[2]},
+    }
+
+
+def test_search_indexes_follow_changes(namedCohort):
+    namedCohort.add_accession(Accession("Temporary_1"))
+    namedCohort.add_raw_file("/data/temporary.fastq", scheme=None, hostname="h", username="u")
+    assert namedCohort.search_accessions("porary") == ["Temporary_1"]
+    assert namedCohort.search_files("temporary") == ["//u@h/data/temporary.fastq"]
+    del namedCohort["Temporary_1"]
+    namedCohort.ignore_files(["//u@h/data/temporary.fastq"])
+    assert namedCohort.search_accessions("porary", recurse=False) == []
+    assert namedCohort.search_files("temporary") == []
+
+
+def test_search_index_migration():
+    tmpdir = tempfile.TemporaryDirectory()
+    x = Cohort("unindexedCohort", rootdir=tmpdir.name)
+    # Roll the aliases back to the unindexed schema
+    cur = x.m80.db.cursor()
+    for table in ("accessions", "aliases", "raw_files"):
+        for trigger in ("insert", "delete", "update"):
+            cur.execute(f"DROP TRIGGER {table}_fts_{trigger}")
+        cur.execute(f"DROP TABLE {table}_fts")
+    cur.execute(
+        """
+        DROP TABLE aliases;
+        CREATE TABLE aliases (
+            alias TEXT UNIQUE,
+            AID INTEGER,
+            FOREIGN KEY(AID) REFERENCES accessions(AID)
+        );
+        INSERT INTO accessions (name) VALUES ('A1');
+        INSERT INTO aliases (alias, AID) VALUES ('first', 1);
+        PRAGMA user_version = 3;
+    """
+    )
+    x = Cohort("unindexedCohort", rootdir=tmpdir.name)
+    assert x.search_accessions("irs") == ["first"]
+    assert x.get_aliases("first") == ["A1", "first"]
@@ -0,0 +1,156 @@
+import json
+import pytest
+
+from minus80.Manifest import Manifest
+from minus80.Exceptions import TagExistsError, TagDoesNotExistError
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    return Manifest(tmp_path)
+
+
+def make_tag(tag, parent=None, files=None):
+    if files is None:
+        files = {"a.txt": {"checksum": "abc", "size": 3}}
+    return {
+        "tag": tag,
+        "parent": parent,
+        "slug": "xyz",
+        "total": f"total_{tag}",
+        "timestamp": 1.0,
+        "files": files,
+    }
+
+
+def test_insert_get(manifest):
+    manifest.insert(make_tag("v1"))
+    assert manifest.get("v1") == make_tag("v1")
+    assert "files" not in manifest.get("v1", files=False)
+    assert manifest.get("nope") is None
+
+
+def test_insert_duplicate(manifest):
+    manifest.insert(make_tag("v1"))
+    with pytest.raises(TagExistsError):
+        manifest.insert(make_tag("v1"))
+
+
+def test_tags_exclude_thawed(manifest):
+    manifest.insert(make_tag("v1"))
+    manifest.upsert({"tag": "thawed", "parent": "v1", "timestamp": 2.0})
+    assert manifest.tags() == ["v1"]
+    assert manifest.get("thawed")["parent"] == "v1"
+    assert len(manifest.all()) == 2
+
+
+def test_nested_files(manifest):
+    files = {
+        "z.txt": {"checksum": "1", "size": 1},
+        "data/a.txt": {"checksum": "2", "size": 2},
+        "data/deep/b.txt": {"checksum": "3", "size": 3},
+    }
+    manifest.insert(make_tag("v1", files=files))
+    assert manifest.get("v1")["files"] == files
+
+
+def num_tree_rows(manifest):
+    return manifest.db.cursor().execute("SELECT COUNT(*) FROM trees").fetchone()[0]
+
+
+def test_trees_are_shared(manifest):
+    files = {
+        "z.txt": {"checksum": "1", "size": 1},
+        "data/a.txt": {"checksum": "2", "size": 2},
+    }
+    manifest.insert(make_tag("v1", files=files))
+    before = num_tree_rows(manifest)
+    # Only the root tree changes
+    files["z.txt"] = {"checksum": "4", "size": 4}
+    manifest.insert(make_tag("v2", files=files))
+    assert num_tree_rows(manifest) == before + 2
+
+
+def test_diff_trees(manifest):
+    files = {
+        "z.txt": {"checksum": "1", "size": 1},
+        "data/a.txt": {"checksum": "2", "size": 2},
+        "data/b.txt": {"checksum": "3", "size": 3},
+    }
+    manifest.insert(make_tag("v1", files=dict(files)))
+    files["data/a.txt"] = {"checksum": "5", "size": 5}
+    del files["data/b.txt"]
+    files["new/c.txt"] = {"checksum": "6", "size": 6}
+    manifest.insert(make_tag("v2", files=files))
+    assert manifest.diff("v1", "v2") == {
+        "new": ["new/c.txt"],
+        "changed": ["data/a.txt"],
+        "deleted": ["data/b.txt"],
+    }
+
+
+def test_remove_reparents_and_prunes(manifest):
+    manifest.insert(make_tag("v1", files={"a.txt": {"checksum": "abc", "size": 3}}))
+    manifest.insert(
+        make_tag("v2", parent="v1", files={"b/c.txt": {"checksum": "def", "size": 3}})
+    )
+    manifest.insert(make_tag("v3", parent="v2"))
+    manifest.remove("v2")
+    assert manifest.get("v3")["parent"] == "v1"
+    assert manifest.checksums() == {"abc"}
+    # Only the tree shared by v1 and v3 is left
+    (n,) = manifest.db.cursor().execute("SELECT COUNT(*) FROM trees").fetchone()
+    assert n == 1
+    with pytest.raises(TagDoesNotExistError):
+        manifest.remove("v2")
+
+
+def test_migrate_tag_files(tmp_path):
+    import apsw
+
+    db = apsw.Connection(str(tmp_path / "MANIFEST.sqlite"))
+    cur = db.cursor()
+    cur.execute(
+        """
+        CREATE TABLE tags (
+            tag TEXT PRIMARY KEY, parent TEXT, timestamp REAL,
+            total TEXT, slug TEXT, extra TEXT
+        );
+        CREATE TABLE tag_files (
+            tag TEXT NOT NULL, idx INTEGER NOT NULL, path TEXT NOT NULL,
+            checksum TEXT NOT NULL, size INTEGER NOT NULL,
+            PRIMARY KEY (tag, path)
+        ) WITHOUT ROWID;
+        INSERT INTO tags VALUES ('v1', NULL, 1.0, 'total_v1', 'xyz', NULL);
+        INSERT INTO tag_files VALUES ('v1', 0, 'a.txt', 'abc', 3);
+        INSERT INTO tags VALUES ('v2', 'v1', 2.0, 'total_v2', 'xyz', NULL);
+        INSERT INTO tag_files VALUES ('v2', 0, 'a.txt', 'abc', 3);
+        """
+    )
+    db.close()
+    manifest = Manifest(tmp_path)
+    assert manifest.get("v1") == make_tag("v1")
+    assert manifest.get("v2")["files"] == make_tag("v1")["files"]
+
+
+def test_extra_fields(manifest):
+    tag = make_tag("v1")
+    tag["note"] = "from the cloud"
+    manifest.insert(tag)
+    assert manifest.get("v1")["note"] == "from the cloud"
+
+
+def test_migrate_json(tmp_path):
+    docs = {
+        "_default": {
+            "1": make_tag("v1"),
+            "2": {"tag": "thawed", "parent": "v1", "timestamp": 2.0},
+        }
+    }
+    with open(tmp_path / "MANIFEST.json", "w") as OUT:
+        json.dump(docs, OUT)
+    manifest = Manifest(tmp_path)
+    assert manifest.get("v1") == make_tag("v1")
+    assert manifest.get("thawed")["parent"] == "v1"
+    assert not (tmp_path / "MANIFEST.json").exists()
+    assert (tmp_path / "MANIFEST.json.migrated").exists()
@@ -1,3 +1,7 @@
+import os
+import sys
+import json
+import time
 import pytest
 import shutil
 import tempfile
@@ -8,10 +12,16 @@ import numpy as np
 from pathlib import Path
 from minus80 import Project
 from minus80.Freezable import FreezableAPI
+from minus80.BlobStore import BlobStore
+from minus80.Packs import PackWriter
+from minus80.Checksum import ChecksumCache
+from minus80.RelationalDB import apsw
 
 from minus80.Exceptions import (
     TagDoesNotExistError,
     TagExistsError,
+    TagInUseError,
+    TagReadOnlyError,
     UnsavedChangesInThawedError,
 )
 
@@ -125,3 +135,744 @@ def test_thaw_with_unsaved_changes(simpleProject,test_data_dir):
     simpleProject.m80.col["x"] = np.array([1, 2, 3, 4])
     with pytest.raises(UnsavedChangesInThawedError):
         simpleProject.m80.thaw("v1")
+
+
+def test_checksum_cache(simpleProject, test_data_dir):
+    import os
+    import time
+
+    dst = simpleProject.m80.thawed_dir / "Sample1_ATGTCA_L007_R1_001.fastq"
+    shutil.copyfile(src=test_data_dir / "Sample1_ATGTCA_L007_R1_001.fastq", dst=dst)
+    # Files modified right before hashing are never cached, so age the file
+    old = time.time_ns() - 10 * 10**9
+    os.utime(dst, ns=(old, old))
+    first = simpleProject.m80.checksum
+    assert simpleProject.m80.checksum_stats == {"hashed": 1, "cached": 0}
+    second = simpleProject.m80.checksum
+    assert simpleProject.m80.checksum_stats == {"hashed": 0, "cached": 1}
+    assert first == second
+    # Changing the file invalidates the entry
+    with open(dst, "a") as OUT:
+        print("@extra", file=OUT)
+    third = simpleProject.m80.checksum
+    assert simpleProject.m80.checksum_stats["hashed"] == 1
+    assert third["total"] != first["total"]
+
+
+def test_parallel_checksum(simpleProject, test_data_dir):
+    for f in test_data_dir.glob("*.fastq"):
+        shutil.copyfile(src=f, dst=simpleProject.m80.thawed_dir / "data" / f.name)
+    simpleProject.m80.checksum_cache.clear()
+    simpleProject.m80.hash_workers = 1
+    serial = simpleProject.m80.checksum
+    simpleProject.m80.checksum_cache.clear()
+    simpleProject.m80.hash_workers = 4
+    parallel = simpleProject.m80.checksum
+    assert simpleProject.m80.checksum_stats["hashed"] == 8
+    assert serial == parallel
+
+
+@pytest.mark.parametrize("single_pass", [True, False])
+def test_freeze_single_pass(simpleProject, test_data_dir, single_pass):
+    src = test_data_dir / "Sample1_ATGTCA_L007_R1_001.fastq"
+    shutil.copyfile(src=src, dst=simpleProject.m80.thawed_dir / "data" / src.name)
+    simpleProject.m80.freeze("v1", single_pass=single_pass)
+    phash = simpleProject.m80.parent_tag["files"][f"data/{src.name}"]["checksum"]
+    assert simpleProject.m80.blobs.path(phash).read_bytes() == src.read_bytes()
+    # No temporary blobs are left behind
+    assert list(simpleProject.m80.blobs) == [phash]
+    assert simpleProject.m80.blobs.incoming() == []
+
+
+def test_link_mode_setting(simpleProject):
+    assert simpleProject.m80.link_mode == "copy"
+    simpleProject.m80.configure(link_mode="hardlink")
+    assert simpleProject.m80.link_mode == "hardlink"
+    with pytest.raises(ValueError):
+        simpleProject.m80.configure(link_mode="teleport")
+
+
+@pytest.mark.parametrize("link_mode", ["copy", "reflink", "hardlink"])
+def test_thaw_link_modes(simpleProject, test_data_dir, link_mode):
+    simpleProject.m80.configure(link_mode=link_mode)
+    src = test_data_dir / "Sample1_ATGTCA_L007_R1_001.fastq"
+    dst = simpleProject.m80.thawed_dir / src.name
+    shutil.copyfile(src=src, dst=dst)
+    simpleProject.m80.freeze("v1")
+    simpleProject.m80.thaw("v1")
+    phash = simpleProject.m80.parent_tag["files"][src.name]["checksum"]
+    blob = simpleProject.m80.blobs.path(phash)
+    assert dst.read_bytes() == src.read_bytes()
+    # Only hard links share the blob inode
+    assert (dst.stat().st_ino == blob.stat().st_ino) == (link_mode == "hardlink")
+
+
+def test_hardlink_db_is_copied_before_write(simpleProject):
+    simpleProject.m80.configure(link_mode="hardlink")
+    simpleProject.m80.db.cursor().execute("CREATE TABLE x (a INT)")
+    simpleProject.m80.freeze("v1")
+    simpleProject.m80.thaw("v1")
+    phash = simpleProject.m80.parent_tag["files"]["db.sqlite"]["checksum"]
+    before = simpleProject.m80.blobs.path(phash).read_bytes()
+    simpleProject.m80.db.cursor().execute("INSERT INTO x VALUES (1)")
+    # The frozen blob was not modified through the thawed database
+    assert simpleProject.m80.blobs.path(phash).read_bytes() == before
+    assert simpleProject.m80.file_changes()["changed"] == ["db.sqlite"]
+
+
+def test_hardlink_path_is_copied(simpleProject, test_data_dir):
+    simpleProject.m80.configure(link_mode="hardlink")
+    r1 = "Sample1_ATGTCA_L007_R1_001.fastq"
+    shutil.copyfile(src=test_data_dir / r1, dst=simpleProject.m80.thawed_dir / "data" / r1)
+    simpleProject.m80.freeze("v1")
+    simpleProject.m80.thaw("v1")
+    phash = simpleProject.m80.parent_tag["files"][f"data/{r1}"]["checksum"]
+    blob = simpleProject.m80.blobs.path(phash)
+    path = simpleProject.m80.thawed_dir / "data" / r1
+    assert path.stat().st_ino == blob.stat().st_ino
+    # Paths handed out never share an inode with a blob
+    assert simpleProject.data_path(r1).stat().st_ino != blob.stat().st_ino
+    assert blob.stat().st_nlink == 1
+    with open(simpleProject.data_path(r1), "a") as OUT:
+        OUT.write("more")
+    assert simpleProject.m80.file_changes()["changed"] == [f"data/{r1}"]
+    # Directories are copied file by file
+    simpleProject.m80.thaw("v1", force=True)
+    simpleProject.m80.path("data")
+    assert blob.stat().st_nlink == 1
+
+
+def test_hardlink_create_link(simpleProject):
+    simpleProject.m80.configure(link_mode="hardlink")
+    tmpdir = tempfile.TemporaryDirectory()
+    # Files used through the link cannot share an inode with a blob
+    with pytest.raises(ValueError):
+        simpleProject.create_link(Path(tmpdir.name) / "link")
+    assert simpleProject.m80.link_mode == "hardlink"
+    assert not (Path(tmpdir.name) / "link").exists()
+
+
+def test_hardlink_freeze_keeps_files_writable(simpleProject):
+    simpleProject.m80.configure(link_mode="hardlink")
+    path = simpleProject.m80.thawed_dir / "data" / "a.txt"
+    path.write_text("a")
+    mode = path.stat().st_mode
+    simpleProject.m80.freeze("v1")
+    assert path.stat().st_mode == mode
+
+
+def test_delta_thaw(simpleProject, test_data_dir):
+    thawed = simpleProject.m80.thawed_dir
+    r1 = "Sample1_ATGTCA_L007_R1_001.fastq"
+    r2 = "Sample1_ATGTCA_L007_R2_001.fastq"
+    shutil.copyfile(src=test_data_dir / r1, dst=thawed / "data" / r1)
+    simpleProject.m80.freeze("v1")
+    (thawed / "sub").mkdir()
+    shutil.copyfile(src=test_data_dir / r2, dst=thawed / "sub" / r2)
+    simpleProject.m80.freeze("v2")
+    inode = (thawed / "data" / r1).stat().st_ino
+    simpleProject.m80.thaw("v1")
+    # Shared files are left alone, the others are removed
+    assert (thawed / "data" / r1).stat().st_ino == inode
+    assert not (thawed / "sub").exists()
+    simpleProject.m80.thaw("v2")
+    assert (thawed / "sub" / r2).read_bytes() == (test_data_dir / r2).read_bytes()
+    assert simpleProject.m80.checksum["total"] == simpleProject.m80.parent_tag["total"]
+    # Thawed files keep the times of their blobs
+    phash = simpleProject.m80.parent_tag["files"][f"sub/{r2}"]["checksum"]
+    blob = simpleProject.m80.blobs.path(phash)
+    assert (thawed / "sub" / r2).stat().st_mtime_ns == blob.stat().st_mtime_ns
+
+
+def test_delete_tag(simpleProject, test_data_dir):
+    simpleProject.m80.freeze("v1")
+    simpleProject.m80.freeze("v2")
+    with pytest.raises(TagInUseError):
+        simpleProject.m80.delete_tag("v2")
+    simpleProject.m80.delete_tag("v1")
+    assert simpleProject.m80.tags == {"v2"}
+    with pytest.raises(TagDoesNotExistError):
+        simpleProject.m80.delete_tag("v1")
+
+
+def test_gc(simpleProject, test_data_dir):
+    thawed = simpleProject.m80.thawed_dir
+    r1 = "Sample1_ATGTCA_L007_R1_001.fastq"
+    shutil.copyfile(src=test_data_dir / r1, dst=thawed / "data" / r1)
+    simpleProject.m80.freeze("v1")
+    phash = simpleProject.m80.parent_tag["files"][f"data/{r1}"]["checksum"]
+    os.unlink(thawed / "data" / r1)
+    simpleProject.m80.freeze("v2")
+    simpleProject.m80.delete_tag("v1")
+    # Blobs within the grace period are kept
+    assert simpleProject.m80.gc()["blobs"] == 0
+    report = simpleProject.m80.gc(dry_run=True, grace=0)
+    assert report["blobs"] == 1
+    assert report["bytes"] == (test_data_dir / r1).stat().st_size
+    assert simpleProject.m80.blobs.exists(phash)
+    simpleProject.m80.gc(grace=0)
+    assert not simpleProject.m80.blobs.exists(phash)
+    # Everything in v2 is still there
+    simpleProject.m80.thaw("v2", force=True)
+    assert simpleProject.m80.checksum["total"] == simpleProject.m80.parent_tag["total"]
+
+
+def test_shared_blobs(test_data_dir):
+    rootdir = tempfile.mkdtemp()
+    r1 = "Sample1_ATGTCA_L007_R1_001.fastq"
+    first = FreezableAPI("Project", "first", rootdir=rootdir)
+    shutil.copyfile(src=test_data_dir / r1, dst=first.thawed_dir / r1)
+    first.freeze("v1")
+    # Files frozen before sharing are moved to the shared store
+    first.configure(shared_blobs=True)
+    phash = first.parent_tag["files"][r1]["checksum"]
+    assert first.blobs.root == Path(rootdir) / "blobs"
+    assert first.blobs.exists(phash)
+    assert list(BlobStore(first.frozen_dir)) == []
+    second = FreezableAPI("Project", "second", rootdir=rootdir)
+    second.configure(shared_blobs=True)
+    shutil.copyfile(src=test_data_dir / r1, dst=second.thawed_dir / r1)
+    second.freeze("v1")
+    assert first.blobs.refcount(phash) == 2
+    # The blob is kept while any dataset uses it
+    (first.thawed_dir / "other").write_text("other")
+    os.unlink(first.thawed_dir / r1)
+    first.freeze("v2")
+    first.delete_tag("v1")
+    assert first.blobs.refcount(phash) == 1
+    first.gc(grace=0)
+    assert first.blobs.exists(phash)
+    FreezableAPI.delete("Project", "second", rootdir=rootdir)
+    first.gc(grace=0)
+    assert not first.blobs.exists(phash)
+    first.thaw("v2", force=True)
+    assert first.checksum["total"] == first.parent_tag["total"]
+
+
+def test_chunked_freeze(simpleProject):
+    simpleProject.m80.configure(chunk_threshold=1024 * 1024)
+    data = np.random.default_rng(0).integers(0, 256, size=8 * 1024 * 1024, dtype=np.uint8)
+    big = simpleProject.m80.thawed_dir / "big.bin"
+    v1 = data.tobytes()
+    big.write_bytes(v1)
+    simpleProject.m80.freeze("v1")
+    phash = simpleProject.m80.parent_tag["files"]["big.bin"]["checksum"]
+    assert simpleProject.m80.blobs.recipe_path(phash).exists()
+    chunks_v1 = {c for c, _ in simpleProject.m80.blobs.chunks(phash)}
+    assert len(chunks_v1) > 1
+    # Insert some data in the middle of the file
+    v2 = v1[: len(v1) // 2] + b"some new rows" + v1[len(v1) // 2 :]
+    big.write_bytes(v2)
+    simpleProject.m80.freeze("v2")
+    phash2 = simpleProject.m80.parent_tag["files"]["big.bin"]["checksum"]
+    chunks_v2 = {c for c, _ in simpleProject.m80.blobs.chunks(phash2)}
+    # Only the chunk(s) around the change are new
+    assert len(chunks_v2 - chunks_v1) <= 2
+    simpleProject.m80.thaw("v1")
+    assert big.read_bytes() == v1
+    simpleProject.m80.thaw("v2")
+    assert big.read_bytes() == v2
+    # Chunks are only collected once no recipe uses them
+    simpleProject.m80.thaw("v1")
+    simpleProject.m80.delete_tag("v2")
+    simpleProject.m80.gc(grace=0)
+    assert all(simpleProject.m80.blobs.exists(c) for c in chunks_v1)
+    assert not any(simpleProject.m80.blobs.exists(c) for c in chunks_v2 - chunks_v1)
+
+
+@pytest.mark.parametrize("compression", ["gzip", True])
+def test_compressed_freeze(simpleProject, compression):
+    simpleProject.m80.configure(compression=compression)
+    thawed = simpleProject.m80.thawed_dir
+    text = b"chr1\t12345\tA\tT\n" * 100000
+    noise = np.random.default_rng(0).integers(0, 256, size=100000, dtype=np.uint8).tobytes()
+    (thawed / "calls.tsv").write_bytes(text)
+    (thawed / "noise.bin").write_bytes(noise)
+    simpleProject.m80.freeze("v1")
+    files = simpleProject.m80.parent_tag["files"]
+    # Checksums are of the uncompressed contents
+    assert files["calls.tsv"]["size"] == len(text)
+    stored = simpleProject.m80.blobs.locate(files["calls.tsv"]["checksum"])
+    assert stored.suffix in (".gz", ".zst")
+    assert stored.stat().st_size < len(text) / 4
+    # Incompressible files are stored as is
+    assert simpleProject.m80.blobs.locate(files["noise.bin"]["checksum"]).suffix == ""
+    (thawed / "calls.tsv").write_bytes(b"changed")
+    simpleProject.m80.thaw("v1", force=True)
+    assert (thawed / "calls.tsv").read_bytes() == text
+    assert simpleProject.m80.file_changes() == {"new": [], "changed": [], "deleted": []}
+
+
+def test_compression_setting(simpleProject):
+    with pytest.raises(ValueError):
+        simpleProject.m80.configure(compression="lzma")
+
+
+def test_packed_freeze(simpleProject):
+    simpleProject.m80.configure(pack_max_size=1024, pack_min_files=10)
+    thawed = simpleProject.m80.thawed_dir
+    (thawed / "many").mkdir()
+    for i in range(50):
+        (thawed / "many" / f"{i}.txt").write_text(f"file {i}\n")
+    simpleProject.m80.freeze("v1")
+    blobs = simpleProject.m80.blobs
+    # The small files were packed instead of stored one blob each
+    assert len(list(blobs.packs)) >= 50
+    assert len([x for x in blobs.root.iterdir() if x.is_file()]) < 10
+    for i in range(50):
+        (thawed / "many" / f"{i}.txt").write_text(f"changed {i}\n")
+    simpleProject.m80.freeze("v2")
+    simpleProject.m80.thaw("v1")
+    assert (thawed / "many" / "7.txt").read_text() == "file 7\n"
+    assert simpleProject.m80.file_changes() == {"new": [], "changed": [], "deleted": []}
+    # Removing a tag frees its pack
+    simpleProject.m80.delete_tag("v2")
+    packs = len(blobs.packs.packs())
+    simpleProject.m80.gc(grace=0)
+    assert len(blobs.packs.packs()) == packs - 1
+    simpleProject.m80.thaw("v1", force=True)
+    assert (thawed / "many" / "7.txt").read_text() == "file 7\n"
+
+
+def test_concurrent_pack_reads(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from minus80.Packs import PackIndex, PackWriter
+
+    tmpdir = tempfile.TemporaryDirectory()
+    index = PackIndex(tmpdir.name)
+    writer = PackWriter(index)
+    writer.add(b"data", "checksum")
+    writer.flush()
+    opened = []
+    real_open = os.open
+
+    def slow_open(*args, **kwargs):
+        opened.append(args[0])
+        time.sleep(0.05)
+        return real_open(*args, **kwargs)
+
+    monkeypatch.setattr(os, "open", slow_open)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        assert set(pool.map(lambda _: index.read("checksum"), range(8))) == {b"data"}
+    # The pack was opened once, no descriptor leaked
+    assert len(opened) == 1
+    index.close()
+
+
+@pytest.mark.parametrize("single_pass", [True, False])
+def test_packed_files_are_read_once(simpleProject, monkeypatch, single_pass):
+    simpleProject.m80.configure(pack_max_size=1024, pack_min_files=10)
+    (simpleProject.m80.thawed_dir / "many").mkdir()
+    for i in range(20):
+        (simpleProject.m80.thawed_dir / "many" / f"{i}.txt").write_text(f"file {i}\n")
+    ingested = []
+    ingest = PackWriter.ingest
+
+    def counting_ingest(self, src):
+        ingested.append(str(src))
+        return ingest(self, src)
+
+    monkeypatch.setattr(PackWriter, "ingest", counting_ingest)
+    simpleProject.m80.freeze("v1", single_pass=single_pass)
+    assert len(ingested) == len(set(ingested)) == 20
+
+
+def test_too_few_files_to_pack(simpleProject):
+    simpleProject.m80.configure(pack_max_size=1024, pack_min_files=10)
+    (simpleProject.m80.thawed_dir / "small.txt").write_text("small")
+    simpleProject.m80.freeze("v1")
+    phash = simpleProject.m80.parent_tag["files"]["small.txt"]["checksum"]
+    assert simpleProject.m80.blobs.path(phash).exists()
+    assert not simpleProject.m80.blobs.packs
+
+
+def test_sharded_layout(simpleProject, test_data_dir):
+    r1 = "Sample1_ATGTCA_L007_R1_001.fastq"
+    shutil.copyfile(src=test_data_dir / r1, dst=simpleProject.m80.thawed_dir / r1)
+    simpleProject.m80.freeze("v1")
+    blobs = simpleProject.m80.blobs
+    phash = simpleProject.m80.parent_tag["files"][r1]["checksum"]
+    assert blobs.layout == "sharded"
+    assert blobs.path(phash) == blobs.root / phash[:2] / phash[2:4] / phash
+    assert blobs.path(phash).exists()
+    # Move to the flat layout and back again
+    assert simpleProject.m80.migrate_layout("flat") > 0
+    assert (blobs.root / phash).exists()
+    assert FreezableAPI("Project", "simpleProject").blobs.layout == "flat"
+    simpleProject.m80.migrate_layout("sharded")
+    assert not (blobs.root / phash).exists()
+    os.unlink(simpleProject.m80.thawed_dir / r1)
+    simpleProject.m80.thaw("v1", force=True)
+    assert (simpleProject.m80.thawed_dir / r1).read_bytes() == (test_data_dir / r1).read_bytes()
+
+
+def test_legacy_flat_layout(tmp_path):
+    (tmp_path / "abc123").write_text("old blob")
+    store = BlobStore(tmp_path)
+    assert store.layout == "flat"
+    assert store.exists("abc123")
+    store.migrate()
+    assert BlobStore(tmp_path).path("abc123") == tmp_path / "ab" / "c1" / "abc123"
+    assert list(BlobStore(tmp_path)) == ["abc123"]
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_open_tag(simpleProject, compression):
+    simpleProject.m80.configure(compression=compression)
+    simpleProject.m80.db.cursor().execute("CREATE TABLE samples (name TEXT)")
+    simpleProject.m80.db.cursor().execute("INSERT INTO samples VALUES ('a')")
+    simpleProject.m80.col["table"] = np.arange(10)
+    simpleProject.m80.doc.insert({"note": "first"})
+    simpleProject.m80.freeze("v1")
+    simpleProject.m80.db.cursor().execute("INSERT INTO samples VALUES ('b')")
+    simpleProject.m80.col["table"] = np.arange(20)
+    simpleProject.m80.freeze("v2")
+    frozen = set(simpleProject.m80.frozen_dir.rglob("*"))
+    with simpleProject.m80.open_tag("v1") as v1:
+        assert list(v1.db.query("SELECT name FROM samples")["name"]) == ["a"]
+        assert len(v1.col["table"]) == 10
+        assert v1.col.list() == ["table"]
+        assert v1.doc.all() == [{"note": "first"}]
+        with pytest.raises(TagReadOnlyError):
+            v1.col["table"] = np.arange(5)
+        with pytest.raises(apsw.ReadOnlyError):
+            v1.db.cursor().execute("INSERT INTO samples VALUES ('c')")
+    # Nothing was written next to the blobs and the thawed data is untouched
+    assert set(simpleProject.m80.frozen_dir.rglob("*")) == frozen
+    assert len(simpleProject.m80.col["table"]) == 20
+    assert simpleProject.m80.parent_tag["tag"] == "v2"
+    with pytest.raises(TagDoesNotExistError):
+        simpleProject.m80.open_tag("v3")
+
+
+def test_lazy_thaw(simpleProject, test_data_dir):
+    thawed = simpleProject.m80.thawed_dir
+    r1 = "Sample1_ATGTCA_L007_R1_001.fastq"
+    r2 = "Sample1_ATGTCA_L007_R2_001.fastq"
+    simpleProject.m80.db.cursor().execute("CREATE TABLE samples (name TEXT)")
+    simpleProject.m80.db.cursor().execute("INSERT INTO samples VALUES ('a')")
+    simpleProject.m80.col["table"] = np.arange(10)
+    shutil.copyfile(src=test_data_dir / r1, dst=thawed / "data" / r1)
+    (thawed / "data" / "sub").mkdir()
+    shutil.copyfile(src=test_data_dir / r2, dst=thawed / "data" / "sub" / r2)
+    simpleProject.m80.freeze("v1")
+    v1 = simpleProject.m80.parent_tag
+    for path in ["db.sqlite", "pq/table.pq", f"data/{r1}", f"data/sub/{r2}"]:
+        os.unlink(thawed / path)
+    simpleProject.m80.freeze("v0")
+    simpleProject.m80.thaw("v1", lazy=True)
+    # Only the directories were created, but the files are part of the dataset
+    assert (thawed / "data" / "sub").is_dir()
+    assert not (thawed / "db.sqlite").exists()
+    assert simpleProject.m80.checksum["total"] == v1["total"]
+    assert len(simpleProject.m80.lazy_report()["pending"]) == 4
+    # Files are written on access
+    assert list(simpleProject.m80.db.query("SELECT name FROM samples")["name"]) == ["a"]
+    assert simpleProject.m80.col.list() == ["table"]
+    assert len(simpleProject.m80.col["table"]) == 10
+    assert simpleProject.data_path(r1).read_bytes() == (test_data_dir / r1).read_bytes()
+    report = simpleProject.m80.lazy_report()
+    assert report["tag"] == "v1"
+    assert report["pending"] == [f"data/sub/{r2}"]
+    assert report["materialized"] == ["data/" + r1, "db.sqlite", "pq/table.pq"]
+    assert report["pending_bytes"] == (test_data_dir / r2).stat().st_size
+    assert not (thawed / "data" / "sub" / r2).exists()
+    # Pending files are frozen from their blobs
+    simpleProject.m80.freeze("v2")
+    assert simpleProject.m80.parent_tag["files"] == v1["files"]
+    assert simpleProject.m80.materialize(["data/sub"]) == [f"data/sub/{r2}"]
+    assert simpleProject.m80.materialize() == []
+    assert simpleProject.m80.checksum["total"] == v1["total"]
+    # A full thaw writes everything that is still pending
+    simpleProject.m80.thaw("v0")
+    simpleProject.m80.thaw("v1", lazy=True)
+    simpleProject.m80.thaw("v2")
+    assert (thawed / "data" / "sub" / r2).exists()
+    assert simpleProject.m80.lazy_report()["tag"] is None
+
+
+def test_freeze_db_snapshot(simpleProject):
+    simpleProject.m80.db.cursor().execute("PRAGMA journal_mode = WAL").fetchall()
+    simpleProject.m80.db.cursor().execute("CREATE TABLE samples (name TEXT)")
+    simpleProject.m80.db.cursor().execute("INSERT INTO samples VALUES ('a')")
+    # A writer is in the middle of a transaction while freezing
+    writer = apsw.Connection(str(simpleProject.m80.thawed_dir / "db.sqlite"))
+    writer.cursor().execute("BEGIN; INSERT INTO samples VALUES ('b')")
+    simpleProject.m80.freeze("v1")
+    writer.cursor().execute("COMMIT")
+    writer.close()
+    files = simpleProject.m80.parent_tag["files"]
+    # The journals are part of the snapshot
+    assert "db.sqlite-wal" not in files
+    with simpleProject.m80.open_tag("v1") as v1:
+        assert list(v1.db.query("SELECT name FROM samples")["name"]) == ["a"]
+    assert simpleProject.m80.file_changes()["changed"] == ["db.sqlite"]
+    # Databases with the same contents have the same checksum
+    simpleProject.m80.db.cursor().execute("DELETE FROM samples WHERE name = 'b'")
+    assert simpleProject.m80.file_changes()["changed"] == []
+    simpleProject.m80.thaw("v1", force=True)
+    assert simpleProject.m80.checksum["total"] == simpleProject.m80.parent_tag["total"]
+
+
+def test_freeze_db_snapshot_contents(simpleProject):
+    db = simpleProject.m80.db
+    db.cursor().execute("CREATE TABLE samples (name TEXT)")
+    with simpleProject.m80.db.bulk_transaction() as cur:
+        cur.executemany("INSERT INTO samples VALUES (?)", [(str(i) * 100,) for i in range(1000)])
+    db.cursor().execute("DELETE FROM samples WHERE name != '1' || ''")
+    simpleProject.m80.freeze("v1")
+    entry = simpleProject.m80.parent_tag["files"]["db.sqlite"]
+    # The size of the stored snapshot is recorded, not that of the thawed db
+    with simpleProject.m80.blobs.materialize(entry["checksum"]) as snapshot:
+        assert os.path.getsize(snapshot) == entry["size"]
+    assert os.path.getsize(simpleProject.m80.thawed_dir / "db.sqlite") > entry["size"]
+    # A schema change that is undone leaves the contents the same
+    db.cursor().execute("CREATE TABLE scratch (x); DROP TABLE scratch")
+    assert simpleProject.m80.file_changes()["changed"] == []
+    simpleProject.m80.freeze("v2")
+    assert simpleProject.m80.parent_tag["files"]["db.sqlite"] == entry
+    db.cursor().execute("INSERT INTO samples VALUES ('b')")
+    assert simpleProject.m80.file_changes()["changed"] == ["db.sqlite"]
+
+
+def test_freeze_db_wal_commit(simpleProject, monkeypatch):
+    db = simpleProject.m80.db
+    db.cursor().execute("PRAGMA journal_mode = WAL").fetchall()
+    db.cursor().execute("CREATE TABLE samples (name TEXT)")
+    simpleProject.m80.freeze("v1")
+    # The files are older than the racy window of the checksum cache
+    monkeypatch.setattr(ChecksumCache, "RACY_WINDOW_NS", -(10**15))
+    assert not any(simpleProject.m80.file_changes().values())
+    # The commit only writes to db.sqlite-wal
+    db.cursor().execute("INSERT INTO samples VALUES ('a')")
+    assert simpleProject.m80.file_changes()["changed"] == ["db.sqlite"]
+    simpleProject.m80.freeze("v2")
+    with simpleProject.m80.open_tag("v2") as v2:
+        assert list(v2.db.query("SELECT name FROM samples")["name"]) == ["a"]
+    assert not any(simpleProject.m80.file_changes().values())
+
+
+def test_thaw_removes_db_journals(simpleProject):
+    db = simpleProject.m80.db
+    db.cursor().execute("PRAGMA journal_mode = WAL").fetchall()
+    db.cursor().execute("CREATE TABLE samples (name TEXT)")
+    simpleProject.m80.freeze("v1")
+    # Another connection keeps the WAL around after the thaw closes the db
+    other = apsw.Connection(str(simpleProject.m80.thawed_dir / "db.sqlite"))
+    try:
+        other.cursor().execute("INSERT INTO samples VALUES ('a')")
+        simpleProject.m80.thaw("v1", force=True)
+        for journal in ("db.sqlite-wal", "db.sqlite-shm", "db.sqlite-journal"):
+            assert not (simpleProject.m80.thawed_dir / journal).exists()
+        cur = simpleProject.m80.db.cursor()
+        assert cur.execute("SELECT name FROM samples").fetchall() == []
+    finally:
+        other.close()
+
+
+@pytest.mark.parametrize("polling", [False, True])
+def test_watch_db_wal_commit(simpleProject, monkeypatch, polling):
+    db = simpleProject.m80.db
+    db.cursor().execute("PRAGMA journal_mode = WAL").fetchall()
+    db.cursor().execute("CREATE TABLE samples (name TEXT)")
+    simpleProject.m80.freeze("v1")
+    monkeypatch.setattr(ChecksumCache, "RACY_WINDOW_NS", -(10**15))
+    watcher = simpleProject.m80.watch(polling=polling, interval=3600)
+    try:
+        assert not any(simpleProject.m80.file_changes().values())
+        db.cursor().execute("INSERT INTO samples VALUES ('a')")
+        if polling:
+            watcher.poll()
+        assert simpleProject.m80.file_changes()["changed"] == ["db.sqlite"]
+        simpleProject.m80.freeze("v2")
+        with simpleProject.m80.open_tag("v2") as v2:
+            assert list(v2.db.query("SELECT name FROM samples")["name"]) == ["a"]
+    finally:
+        simpleProject.m80.unwatch()
+
+
+@pytest.mark.parametrize("polling", [False, True])
+def test_watch(simpleProject, test_data_dir, monkeypatch, polling):
+    thawed = simpleProject.m80.thawed_dir
+    r1 = "Sample1_ATGTCA_L007_R1_001.fastq"
+    r2 = "Sample1_ATGTCA_L007_R2_001.fastq"
+    shutil.copyfile(src=test_data_dir / r1, dst=thawed / "data" / r1)
+    simpleProject.m80.freeze("v1")
+    # An unsaved change made before watching is found by the initial scan
+    (thawed / "data" / "notes.txt").write_text("first")
+    watcher = simpleProject.m80.watch(polling=polling, interval=3600)
+    try:
+        assert simpleProject.m80.file_changes()["new"] == ["data/notes.txt"]
+        simpleProject.m80.freeze("v2")
+        # Clean datasets are checked without walking the thawed dir
+        monkeypatch.setattr(sys.modules["minus80.Freezable"], "scan_files", None)
+        assert simpleProject.m80.checksum["total"] == simpleProject.m80.parent_tag["total"]
+        (thawed / "data" / "sub").mkdir()
+        shutil.copyfile(src=test_data_dir / r2, dst=thawed / "data" / "sub" / r2)
+        (thawed / "data" / "notes.txt").write_text("second")
+        os.unlink(thawed / "data" / r1)
+        if polling:
+            watcher.poll()
+        assert simpleProject.m80.file_changes() == {
+            "new": [f"data/sub/{r2}"],
+            "changed": ["data/notes.txt"],
+            "deleted": [f"data/{r1}"],
+        }
+        assert simpleProject.m80.checksum_stats["hashed"] == 2
+        monkeypatch.undo()
+        simpleProject.m80.freeze("v3")
+        assert not any(simpleProject.m80.file_changes().values())
+        simpleProject.m80.thaw("v1")
+        assert not any(simpleProject.m80.file_changes().values())
+        assert (thawed / "data" / r1).exists()
+        assert not (thawed / "data" / "sub").exists()
+        assert "data/notes.txt" not in simpleProject.m80.checksum["files"]
+        dirty = json.loads((simpleProject.m80.basedir / "DIRTY.json").read_text())
+        assert dirty["parent"] == "v1"
+    finally:
+        simpleProject.m80.unwatch()
+    assert not (simpleProject.m80.basedir / "DIRTY.json").exists()
+
+
+@pytest.mark.parametrize("single_pass", [True, False])
+def test_watched_freeze_reads_dirty_files_once(simpleProject, monkeypatch, single_pass):
+    thawed = simpleProject.m80.thawed_dir
+    for name in ("a.txt", "b.txt"):
+        (thawed / name).write_text(name)
+    simpleProject.m80.freeze("v1")
+    watcher = simpleProject.m80.watch(interval=3600)
+    try:
+        (thawed / "a.txt").write_text("changed")
+        (thawed / "c.txt").write_text("new")
+        if hasattr(watcher, "poll"):
+            watcher.poll()
+        freezable = sys.modules["minus80.Freezable"]
+        hashed = []
+        file_hash = freezable.file_hash
+        ingests = {BlobStore: BlobStore.ingest, PackWriter: PackWriter.ingest}
+
+        def counting_hash(path, *args, **kwargs):
+            hashed.append(os.path.basename(path))
+            return file_hash(path, *args, **kwargs)
+
+        def counting_ingest(self, path, *args, **kwargs):
+            hashed.append(os.path.basename(path))
+            return ingests[type(self)](self, path, *args, **kwargs)
+
+        monkeypatch.setattr(freezable, "scan_files", None)
+        monkeypatch.setattr(FreezableAPI._checksum, "__defaults__", (counting_hash, None))
+        monkeypatch.setattr(BlobStore, "ingest", counting_ingest)
+        monkeypatch.setattr(PackWriter, "ingest", counting_ingest)
+        simpleProject.m80.freeze("v2", single_pass=single_pass)
+        # Two pass freezes hash, then copy the changed files
+        assert sorted(hashed) == sorted(["a.txt", "c.txt"] * (1 if single_pass else 2))
+    finally:
+        monkeypatch.undo()
+        simpleProject.m80.unwatch()
+    v2 = simpleProject.m80.manifest.get("v2")
+    assert sorted(v2["files"]) == ["a.txt", "b.txt", "c.txt"]
+    assert v2["total"] == simpleProject.m80.checksum["total"]
+
+
+def test_polling_watch_sees_writes_right_away(simpleProject):
+    thawed = simpleProject.m80.thawed_dir
+    (thawed / "a.txt").write_text("first")
+    simpleProject.m80.freeze("v1")
+    simpleProject.m80.watch(polling=True, interval=3600)
+    try:
+        (thawed / "a.txt").write_text("second!")
+        assert simpleProject.m80.file_changes()["changed"] == ["a.txt"]
+        simpleProject.m80.freeze("v2")
+    finally:
+        simpleProject.m80.unwatch()
+    v1, v2 = (simpleProject.m80.manifest.get(tag)["files"] for tag in ("v1", "v2"))
+    assert v1["a.txt"]["checksum"] != v2["a.txt"]["checksum"]
+
+
+def test_verify(simpleProject, test_data_dir):
+    thawed = simpleProject.m80.thawed_dir
+    r1 = "Sample1_ATGTCA_L007_R1_001.fastq"
+    r2 = "Sample1_ATGTCA_L007_R2_001.fastq"
+    shutil.copyfile(src=test_data_dir / r1, dst=thawed / "data" / r1)
+    shutil.copyfile(src=test_data_dir / r2, dst=thawed / "data" / r2)
+    simpleProject.m80.freeze("v1")
+    simpleProject.m80.doc.insert({"note": "first"})
+    simpleProject.m80.freeze("v2")
+    # Pretend the blobs were frozen a while ago
+    old = time.time() - 3600
+    for path in simpleProject.m80.frozen_dir.rglob("*"):
+        os.utime(path, (old, old))
+    report = simpleProject.m80.verify(workers=4)
+    assert report["tags"] == {
+        tag: {"missing": [], "corrupt": []} for tag in ("v1", "v2")
+    }
+    assert report["verified"] == report["blobs"]
+    # Intact blobs are not re-read
+    report = simpleProject.m80.verify()
+    assert report["skipped"] == report["blobs"]
+    files = simpleProject.m80.parent_tag["files"]
+    blobs = simpleProject.m80.blobs
+    blobs.path(files[f"data/{r1}"]["checksum"]).write_text("bit rot")
+    os.unlink(blobs.path(files["documentDB.json"]["checksum"]))
+    report = simpleProject.m80.verify()
+    assert report["tags"]["v1"] == {"missing": [], "corrupt": [f"data/{r1}"]}
+    assert report["tags"]["v2"] == {
+        "missing": ["documentDB.json"],
+        "corrupt": [f"data/{r1}"],
+    }
+    assert report["verified"] == 1
+    report = simpleProject.m80.verify(tags=["v1"], incremental=False)
+    assert report["verified"] == report["blobs"] == 2
+    with pytest.raises(TagDoesNotExistError):
+        simpleProject.m80.verify(tags=["v3"])
+
+
+def test_verify_flat_layout(simpleProject):
+    (simpleProject.m80.thawed_dir / "a.txt").write_text("a")
+    simpleProject.m80.freeze("v1")
+    simpleProject.m80.migrate_layout("flat")
+    simpleProject.m80.verify()
+    blobs = simpleProject.m80.blobs
+    assert set(blobs) == {f["checksum"] for f in simpleProject.m80.parent_tag["files"].values()}
+    assert simpleProject.m80.gc(dry_run=True)["blobs"] == 0
+    simpleProject.m80.migrate_layout("sharded")
+    assert (blobs.root / ".verified.json").exists()
+
+
+def test_diff(simpleProject, test_data_dir):
+    thawed = simpleProject.m80.thawed_dir
+    r1 = "Sample1_ATGTCA_L007_R1_001.fastq"
+    simpleProject.m80.db.cursor().execute("CREATE TABLE samples (name TEXT)")
+    simpleProject.m80.db.cursor().execute("CREATE TABLE runs (id INT)")
+    simpleProject.m80.db.cursor().execute("INSERT INTO samples VALUES ('a')")
+    simpleProject.m80.col["expr"] = np.arange(10)
+    simpleProject.m80.col["same"] = np.arange(3)
+    shutil.copyfile(src=test_data_dir / r1, dst=thawed / "data" / r1)
+    simpleProject.m80.freeze("v1")
+    simpleProject.m80.db.cursor().execute("INSERT INTO samples VALUES ('b')")
+    simpleProject.m80.db.cursor().execute("DROP TABLE runs")
+    simpleProject.m80.col["expr"] = np.arange(20)
+    simpleProject.m80.col["new"] = np.arange(5)
+    os.unlink(thawed / "data" / r1)
+    simpleProject.m80.freeze("v2")
+    simpleProject.m80.thaw("v1")
+    delta = simpleProject.m80.diff("v1", "v2")
+    assert delta == {
+        "new": ["pq/new.pq"],
+        "changed": ["db.sqlite", "pq/expr.pq"],
+        "deleted": [f"data/{r1}"],
+    }
+    # Thawed files are not involved
+    assert simpleProject.m80.parent_tag["tag"] == "v1"
+    tables = simpleProject.m80.diff("v1", "v2", deep=True)["tables"]
+    assert tables == {
+        "db.sqlite": {
+            "runs": {"change": "deleted", "rows": [0, None]},
+            "samples": {"change": "changed", "rows": [1, 2]},
+        },
+        "pq/expr.pq": {"expr": {"change": "changed", "rows": [10, 20]}},
+        "pq/new.pq": {"new": {"change": "new", "rows": [None, 5]}},
+    }
+    assert simpleProject.m80.diff("v1", "v1", deep=True)["tables"] == {}
+    with pytest.raises(TagDoesNotExistError):
+        simpleProject.m80.diff("v1", "thawed")
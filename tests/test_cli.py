@@ -143,3 +143,32 @@ def test_delete_project_bad_tag():
     # Now delete the project for real
     subprocess.run("minus80 delete  Project.bizbaz --force".split())
     assert not FreezableAPI.exists("Project", "bizbaz")
+
+
+def test_delete_tag_and_gc():
+    tmpdir = tempfile.mkdtemp()
+    subprocess.run(f"minus80 init --path {tmpdir} bizbaz".split())
+    subprocess.run("minus80 freeze Project.bizbaz:v1".split())
+    subprocess.run("minus80 freeze Project.bizbaz:v2".split())
+    x = subprocess.run("minus80 delete Project.bizbaz:v1 --force".split())
+    assert x.returncode == 0
+    assert m80.Project("bizbaz").m80.tags == {"v2"}
+    x = subprocess.run("minus80 gc Project.bizbaz --dry-run".split())
+    assert x.returncode == 0
+    subprocess.run("minus80 delete  Project.bizbaz --force".split())
+
+
+def test_migrate_layout():
+    x = subprocess.run("minus80 migrate Project.foobar".split())
+    assert x.returncode == 0
+
+
+def test_verify():
+    tmpdir = tempfile.mkdtemp()
+    subprocess.run(f"minus80 init --path {tmpdir} verifyme".split())
+    subprocess.run("minus80 freeze Project.verifyme:v1".split())
+    x = subprocess.run("minus80 verify Project.verifyme".split())
+    assert x.returncode == 0
+    x = subprocess.run("minus80 verify Project.verifyme:nope".split())
+    assert x.returncode == 1
+    subprocess.run("minus80 delete  Project.verifyme --force".split())
@@ -0,0 +1,37 @@
+import sys
+import json
+import subprocess
+
+# Modules that are slow to import, they are only loaded by
+# the features that need them
+HEAVY = ["pandas", "numpy", "h5py", "pyarrow", "asyncssh", "yaml", "tinydb", "requests"]
+# The budget for importing minus80 and its CLI (microseconds)
+IMPORT_BUDGET_US = 500_000
+
+
+def run(*args):
+    return subprocess.run(
+        [sys.executable, *args], capture_output=True, text=True, check=True
+    )
+
+
+def test_import_is_lazy():
+    loaded = run(
+        "-c",
+        "import sys, json\n"
+        "import minus80.cli.minus80\n"
+        "from minus80.Config import cf\n"
+        f"print(json.dumps([[m for m in {HEAVY!r} if m in sys.modules], cf._data is None]))",
+    )
+    assert json.loads(loaded.stdout) == [[], True]
+
+
+def test_import_time():
+    def import_us():
+        # The last line of -X importtime is the module itself:
+        # import time: self [us] | cumulative | name
+        report = run("-X", "importtime", "-c", "import minus80.cli.minus80")
+        last = report.stderr.strip().splitlines()[-1]
+        return int(last.split("|")[1])
+
+    assert min(import_us() for _ in range(3)) < IMPORT_BUDGET_US